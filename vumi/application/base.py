@@ -10,7 +10,9 @@ from twisted.python import log
 from vumi.service import Worker
 from vumi.errors import ConfigError
 from vumi.message import TransportUserMessage, TransportEvent
-from vumi.middleware import MiddlewareStack, setup_middlewares_from_config
+from vumi.middleware import (MiddlewareStack, setup_middlewares_from_config,
+                             setup_middleware_metrics_from_config)
+from vumi.components.keyed_scheduler import KeyedScheduler
 
 
 SESSION_NEW = TransportUserMessage.SESSION_NEW
@@ -53,6 +55,17 @@ class ApplicationWorker(Worker):
     By default :attr:`SEND_TO_TAGS` is empty and all calls to
     :meth:`send_to` will fail (this is to make it easy to identify
     which tags an application requires `send_to` configuration for).
+
+    Messages and events may be consumed concurrently by setting
+    `consumer_concurrency` in the config. Messages that share an
+    ordering key (see :meth:`user_message_ordering_key` and
+    :meth:`event_ordering_key`) are still handled one at a time, in the
+    order they arrive. The optional `max_ordering_lanes` config option
+    limits the number of keys handled at once. Messages waiting for
+    their key keep using one of the consumer's `consumer_concurrency`
+    slots, so `consumer_concurrency` is what bounds the number of
+    messages waiting. Once every slot is in use the consumer stops
+    taking messages, and the broker holds on to the rest.
     """
 
     transport_name = None
@@ -78,6 +91,8 @@ class ApplicationWorker(Worker):
             SESSION_NEW: self.new_session,
             SESSION_CLOSE: self.close_session,
             }
+        self._scheduler = KeyedScheduler(
+            max_lanes=self.config.get('max_ordering_lanes'))
 
         yield self._setup_transport_publisher()
 
@@ -143,7 +158,9 @@ class ApplicationWorker(Worker):
         middleware setup.
         """
         middlewares = yield setup_middlewares_from_config(self, self.config)
-        self._middlewares = MiddlewareStack(middlewares)
+        metrics = yield setup_middleware_metrics_from_config(
+            self, self.config)
+        self._middlewares = MiddlewareStack(middlewares, metrics)
 
     def teardown_middleware(self):
         """
@@ -160,13 +177,25 @@ class ApplicationWorker(Worker):
                                            self.consume_unknown_event)
         return handler(event)
 
-    def dispatch_event(self, event):
-        """Dispatch to event_type specific handlers."""
+    def _dispatch_event_ordered(self, event):
         d = self._middlewares.apply_consume("event", event,
                                             self.transport_name)
         d.addCallback(self._dispatch_event_raw)
         return d
 
+    def event_ordering_key(self, event):
+        """Return the key events are ordered by.
+
+        Events with the same key are handled in the order they arrive.
+        Defaults to the id of the message the event refers to.
+        """
+        return ('event', event.get('user_message_id'))
+
+    def dispatch_event(self, event):
+        """Dispatch to event_type specific handlers."""
+        return self._scheduler.schedule(self.event_ordering_key(event),
+                                        self._dispatch_event_ordered, event)
+
     def consume_unknown_event(self, event):
         log.msg("Unknown event type in message %r" % (event,))
 
@@ -188,13 +217,26 @@ class ApplicationWorker(Worker):
                                              self.consume_user_message)
         return handler(message)
 
-    def dispatch_user_message(self, message):
-        """Dispatch user messages to handler."""
+    def _dispatch_user_message_ordered(self, message):
         d = self._middlewares.apply_consume("inbound", message,
                                             self.transport_name)
         d.addCallback(self._dispatch_user_message_raw)
         return d
 
+    def user_message_ordering_key(self, message):
+        """Return the key user messages are ordered by.
+
+        Messages with the same key are handled in the order they arrive.
+        Defaults to the user (`from_addr`) the message is from.
+        """
+        return ('user', message.user())
+
+    def dispatch_user_message(self, message):
+        """Dispatch user messages to handler."""
+        return self._scheduler.schedule(
+            self.user_message_ordering_key(message),
+            self._dispatch_user_message_ordered, message)
+
     def consume_user_message(self, message):
         """Respond to user message."""
         pass
@@ -247,7 +289,8 @@ class ApplicationWorker(Worker):
         self.transport_consumer = yield self.consume(
             '%(transport_name)s.inbound' % self.config,
             self.dispatch_user_message,
-            message_class=TransportUserMessage)
+            message_class=TransportUserMessage,
+            concurrency=int(self.config.get('consumer_concurrency', 1)))
         self._consumers.append(self.transport_consumer)
 
     @inlineCallbacks
@@ -255,5 +298,6 @@ class ApplicationWorker(Worker):
         self.transport_event_consumer = yield self.consume(
             '%(transport_name)s.event' % self.config,
             self.dispatch_event,
-            message_class=TransportEvent)
+            message_class=TransportEvent,
+            concurrency=int(self.config.get('consumer_concurrency', 1)))
         self._consumers.append(self.transport_event_consumer)
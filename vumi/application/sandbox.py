@@ -510,6 +510,10 @@ class SandboxApi(object):
 
 
 class SandboxCommand(Message):
+    __slots__ = ()
+
+    REQUIRED_FIELDS = ('cmd', 'cmd_id', 'reply')
+
     @staticmethod
     def generate_id():
         return uuid4().get_hex()
@@ -521,14 +525,6 @@ class SandboxCommand(Message):
         fields.setdefault('reply', False)
         return fields
 
-    def validate_fields(self):
-        super(SandboxCommand, self).validate_fields()
-        self.assert_field_present(
-            'cmd',
-            'cmd_id',
-            'reply',
-        )
-
 
 class Sandbox(ApplicationWorker):
     """
@@ -1,4 +1,6 @@
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.task import deferLater
+from twisted.internet import reactor
 
 from vumi.errors import ConfigError
 from vumi.application.base import ApplicationWorker, SESSION_NEW, SESSION_CLOSE
@@ -203,6 +205,94 @@ class TestApplicationWorker(ApplicationTestCase):
         worker.close_session(FakeUserMessage())
 
 
+class TestApplicationWorkerOrdering(ApplicationTestCase):
+
+    application_class = ApplicationWorker
+
+    @inlineCallbacks
+    def test_user_messages_ordered_per_user(self):
+        app = yield self.get_application({'consumer_concurrency': 5})
+        self.assertEqual(app.transport_consumer.concurrency, 5)
+        handled = []
+        pending = {}
+
+        def consume_user_message(msg):
+            handled.append(msg['content'])
+            d = pending[msg['content']] = Deferred()
+            return d
+
+        app.consume_user_message = consume_user_message
+        app.dispatch_user_message(self.mkmsg_in('a1', from_addr='a'))
+        app.dispatch_user_message(self.mkmsg_in('a2', from_addr='a'))
+        app.dispatch_user_message(self.mkmsg_in('b1', from_addr='b'))
+        self.assertEqual(handled, ['a1', 'b1'])
+        pending['a1'].callback(None)
+        self.assertEqual(handled, ['a1', 'b1', 'a2'])
+        pending['a2'].callback(None)
+        pending['b1'].callback(None)
+
+    @inlineCallbacks
+    def test_events_ordered_per_message(self):
+        app = yield self.get_application({})
+        handled = []
+        pending = {}
+
+        def consume_event(event):
+            key = (event['event_type'], event['user_message_id'])
+            handled.append(key)
+            d = pending[key] = Deferred()
+            return d
+
+        app._event_handlers['ack'] = consume_event
+        app._event_handlers['delivery_report'] = consume_event
+        app.dispatch_event(self.mkmsg_ack(user_message_id='1'))
+        app.dispatch_event(self.mkmsg_delivery(user_message_id='1'))
+        app.dispatch_event(self.mkmsg_ack(user_message_id='2'))
+        self.assertEqual(handled, [('ack', '1'), ('ack', '2')])
+        pending[('ack', '1')].callback(None)
+        self.assertEqual(handled, [('ack', '1'), ('ack', '2'),
+                                   ('delivery_report', '1')])
+        pending[('delivery_report', '1')].callback(None)
+        pending[('ack', '2')].callback(None)
+
+    @inlineCallbacks
+    def test_concurrency_bounds_waiting_messages(self):
+        app = yield self.get_application({'consumer_concurrency': 3})
+        handled = []
+        pending = {}
+
+        def consume_user_message(msg):
+            handled.append(msg['content'])
+            d = pending[msg['content']] = Deferred()
+            return d
+
+        app.consume_user_message = consume_user_message
+        for content in ['a1', 'a2', 'a3', 'b1']:
+            self.dispatch(self.mkmsg_in(content, from_addr=content[0]))
+        yield deferLater(reactor, 0, lambda: None)
+        # a2 and a3 wait behind a1 and use up the consumer's other
+        # slots, so b1 stays with the broker.
+        self.assertEqual(handled, ['a1'])
+        self.assertEqual(app._scheduler.queued_count(('user', 'a')), 2)
+        channel = app.transport_consumer.channel
+        self.assertEqual(len(channel.unacked), 3)
+        queue = self._amqp.queues[self.rkey('inbound')]
+        self.assertEqual(len(queue.messages), 1)
+
+        pending['a1'].callback(None)
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual(sorted(handled), ['a1', 'a2', 'b1'])
+        pending['a2'].callback(None)
+        pending['b1'].callback(None)
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual(sorted(handled), ['a1', 'a2', 'a3', 'b1'])
+        pending['a3'].callback(None)
+        yield self._amqp.wait_delivery()
+        self.assertEqual(channel.unacked, [])
+        self.assertEqual(queue.messages, [])
+        self.assertEqual(queue.unacked_messages, {})
+
+
 class TestApplicationMiddlewareHooks(ApplicationTestCase):
 
     transport_name = 'carrier_pigeon'
@@ -55,6 +55,7 @@ class MetricManager(Publisher):
         if self._task:
             self._task.stop()
             self._task = None
+        return super(MetricManager, self).stop()
 
     def _publish_metrics(self):
         msg = MetricMessage()
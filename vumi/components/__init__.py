@@ -1,7 +1,10 @@
 """Various useful components."""
 
-__all__ = ["MessageStore", "SessionManager", "TagpoolManager"]
+__all__ = ["MessageStore", "SessionManager", "TagpoolManager",
+           "KeyedScheduler", "RouteMemory"]
 
 from vumi.components.message_store import MessageStore
 from vumi.components.session import SessionManager
 from vumi.components.tagpool import TagpoolManager
+from vumi.components.keyed_scheduler import KeyedScheduler
+from vumi.components.route_memory import RouteMemory
@@ -0,0 +1,103 @@
+# -*- test-case-name: vumi.components.tests.test_keyed_scheduler -*-
+
+"""Run work serially per key while running different keys concurrently."""
+
+from collections import deque
+
+from twisted.internet.defer import Deferred, maybeDeferred
+
+
+class KeyedScheduler(object):
+    """Schedule tasks in per-key serial lanes.
+
+    Tasks scheduled with the same key are run one at a time, in the order
+    they were scheduled. Tasks with different keys run concurrently. A
+    lane only exists while it has tasks running or waiting.
+
+    Lanes don't limit the number of tasks waiting in them. The Deferred
+    returned by :meth:`schedule` only fires once its task has run, so a
+    consumer scheduling one task per message is bounded by its own
+    concurrency limit.
+
+    :param int max_lanes:
+        Maximum number of lanes that may run at once. Keys that arrive
+        when all lanes are busy wait for a lane to become free, in the
+        order they arrived. Default is None (no limit).
+    """
+
+    def __init__(self, max_lanes=None):
+        self.max_lanes = max_lanes
+        self._lanes = {}
+        self._running = set()
+        self._waiting_keys = deque()
+
+    def lane_count(self):
+        """Return the number of lanes that are running or waiting."""
+        return len(self._lanes)
+
+    def queued_count(self, key):
+        """Return the number of tasks queued in the lane for `key`."""
+        return len(self._lanes.get(key, ()))
+
+    def schedule(self, key, func, *args, **kw):
+        """Schedule `func(*args, **kw)` in the lane for `key`.
+
+        :returns:
+            A Deferred that fires with the result of the call once it has
+            been run.
+        """
+        d = Deferred()
+        task = (d, func, args, kw)
+        self._lanes.setdefault(key, deque()).append(task)
+        if key not in self._running and key not in self._waiting_keys:
+            if self._has_free_lane():
+                self._running.add(key)
+                self._run_lanes(key)
+            else:
+                self._waiting_keys.append(key)
+        return d
+
+    def _has_free_lane(self):
+        if self.max_lanes is None:
+            return True
+        return len(self._running) < self.max_lanes
+
+    def _next_task(self, key):
+        queue = self._lanes[key]
+        if queue:
+            return queue.popleft()
+        return None
+
+    def _run_lane(self, key):
+        """Run tasks from the lane for `key` until one doesn't finish
+        straight away. Return True if the lane is empty and has been
+        closed."""
+        while True:
+            task = self._next_task(key)
+            if task is None:
+                break
+            d, func, args, kw = task
+            finished = []
+            result = maybeDeferred(func, *args, **kw)
+            # A Deferred can be called but still waiting on another one,
+            # so record when the task has really finished.
+            result.addBoth(lambda r: finished.append(True) or r)
+            result.chainDeferred(d)
+            if not finished:
+                result.addCallback(self._task_done, key)
+                return False
+        del self._lanes[key]
+        self._running.discard(key)
+        return True
+
+    def _run_lanes(self, key):
+        # Loop rather than recurse, so that long runs of tasks that
+        # finish synchronously don't exhaust the stack.
+        closed = self._run_lane(key)
+        while closed and self._waiting_keys and self._has_free_lane():
+            key = self._waiting_keys.popleft()
+            self._running.add(key)
+            closed = self._run_lane(key)
+
+    def _task_done(self, _result, key):
+        self._run_lanes(key)
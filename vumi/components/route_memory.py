@@ -0,0 +1,83 @@
+# -*- test-case-name: vumi.components.tests.test_route_memory -*-
+
+"""Remember where outbound messages came from, to route their events."""
+
+from twisted.internet.defer import DeferredList, succeed
+
+from vumi.utils import LRUCache
+from vumi import log
+
+
+class RouteMemory(object):
+    """Store the endpoint each message was routed from, keyed by message id.
+
+    Routes are kept in an in-process :class:`vumi.utils.LRUCache` and
+    written to Redis as a single `SETEX` each. Writes are not waited for
+    by :meth:`store`. Lookups are answered from the cache when possible,
+    and otherwise take one `GET`.
+
+    :param redis:
+        Redis manager to store routes in.
+    :param int expiry:
+        Time in seconds before routes expire from Redis. Default is None
+        (never expire).
+    :param int cache_size:
+        Number of recent routes to keep in process. Default is 10000.
+    """
+
+    def __init__(self, redis, expiry=None, cache_size=10000):
+        self.redis = redis
+        self.expiry = expiry
+        self._cache = LRUCache(cache_size)
+        self._pending_writes = set()
+
+    def route_key(self, message_id):
+        return 'route:%s' % (message_id,)
+
+    def store(self, message_id, endpoint):
+        """
+        Remember that `message_id` was routed from `endpoint`.
+
+        The route can be looked up from this process straight away. It
+        is written to Redis in the background; :meth:`flush` waits for
+        writes that haven't finished.
+
+        :returns:
+            A Deferred that fires once the route has been written, for
+            callers that need other processes to see it.
+        """
+        self._cache[message_id] = endpoint
+        key = self.route_key(message_id)
+        if self.expiry:
+            d = self.redis.setex(key, int(self.expiry), endpoint)
+        else:
+            d = self.redis.set(key, endpoint)
+        self._pending_writes.add(d)
+        d.addErrback(log.err, "Failed to store route for message %s" % (
+            message_id,))
+        d.addBoth(self._write_done, d)
+        return d
+
+    def _write_done(self, _result, d):
+        self._pending_writes.discard(d)
+
+    def flush(self):
+        """Return a Deferred that fires when pending writes have finished."""
+        return DeferredList(list(self._pending_writes))
+
+    def lookup(self, message_id):
+        """
+        Return a Deferred that fires with the endpoint `message_id` was
+        routed from, or None if it isn't known.
+        """
+        endpoint = self._cache.get(message_id)
+        if endpoint is not None:
+            return succeed(endpoint)
+        d = self.redis.get(self.route_key(message_id))
+        d.addCallback(self._cache_lookup, message_id)
+        return d
+
+    def _cache_lookup(self, endpoint, message_id):
+        if endpoint is not None:
+            self._cache[message_id] = endpoint
+        return endpoint
@@ -0,0 +1,89 @@
+"""Tests for vumi.components.keyed_scheduler."""
+
+from twisted.internet.defer import Deferred
+from twisted.trial.unittest import TestCase
+
+from vumi.components.keyed_scheduler import KeyedScheduler
+
+
+class KeyedSchedulerTestCase(TestCase):
+    timeout = 1
+
+    def setUp(self):
+        self.calls = []
+        self.pending = {}
+
+    def task(self, name):
+        self.calls.append(name)
+        d = Deferred()
+        self.pending[name] = d
+        return d
+
+    def finish(self, name, result=None):
+        self.pending.pop(name).callback(result)
+
+    def test_same_key_runs_serially(self):
+        scheduler = KeyedScheduler()
+        d1 = scheduler.schedule('a', self.task, 'a1')
+        d2 = scheduler.schedule('a', self.task, 'a2')
+        self.assertEqual(self.calls, ['a1'])
+        self.assertEqual(scheduler.queued_count('a'), 1)
+        self.finish('a1', 'r1')
+        self.assertEqual(self.calls, ['a1', 'a2'])
+        self.finish('a2', 'r2')
+        self.assertEqual(scheduler.lane_count(), 0)
+        d1.addCallback(self.assertEqual, 'r1')
+        d2.addCallback(self.assertEqual, 'r2')
+        return d2
+
+    def test_different_keys_run_concurrently(self):
+        scheduler = KeyedScheduler()
+        scheduler.schedule('a', self.task, 'a1')
+        scheduler.schedule('b', self.task, 'b1')
+        scheduler.schedule('a', self.task, 'a2')
+        self.assertEqual(self.calls, ['a1', 'b1'])
+        self.assertEqual(scheduler.lane_count(), 2)
+        self.finish('b1')
+        self.finish('a1')
+        self.assertEqual(self.calls, ['a1', 'b1', 'a2'])
+        self.finish('a2')
+        self.assertEqual(scheduler.lane_count(), 0)
+
+    def test_synchronous_tasks(self):
+        scheduler = KeyedScheduler()
+        d = scheduler.schedule('a', lambda x: x * 2, 21)
+        d.addCallback(self.assertEqual, 42)
+        self.assertEqual(scheduler.lane_count(), 0)
+        return d
+
+    def test_failed_task_does_not_block_lane(self):
+        scheduler = KeyedScheduler()
+        d1 = scheduler.schedule('a', lambda: 1 / 0)
+        scheduler.schedule('a', self.task, 'a2')
+        self.assertEqual(self.calls, ['a2'])
+        self.finish('a2')
+        return self.assertFailure(d1, ZeroDivisionError)
+
+    def test_max_lanes(self):
+        scheduler = KeyedScheduler(max_lanes=1)
+        scheduler.schedule('a', self.task, 'a1')
+        scheduler.schedule('b', self.task, 'b1')
+        scheduler.schedule('a', self.task, 'a2')
+        self.assertEqual(self.calls, ['a1'])
+        self.finish('a1')
+        self.assertEqual(self.calls, ['a1', 'a2'])
+        self.finish('a2')
+        self.assertEqual(self.calls, ['a1', 'a2', 'b1'])
+        self.finish('b1')
+        self.assertEqual(scheduler.lane_count(), 0)
+
+    def test_many_synchronous_tasks(self):
+        scheduler = KeyedScheduler(max_lanes=1)
+        scheduler.schedule('a', self.task, 'a1')
+        results = []
+        for i in range(5000):
+            scheduler.schedule('a', results.append, i)
+            scheduler.schedule(i, results.append, i)
+        self.finish('a1')
+        self.assertEqual(len(results), 10000)
+        self.assertEqual(scheduler.lane_count(), 0)
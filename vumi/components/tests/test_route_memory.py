@@ -0,0 +1,61 @@
+"""Tests for vumi.components.route_memory."""
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import TestCase
+
+from vumi.components import RouteMemory
+from vumi.tests.utils import PersistenceMixin
+
+
+class RouteMemoryTestCase(TestCase, PersistenceMixin):
+    timeout = 2
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        yield self.redis._purge_all()  # Just in case
+        self.routes = RouteMemory(self.redis, expiry=60)
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield self.routes.flush()
+        yield self._persist_tearDown()
+
+    @inlineCallbacks
+    def test_store_and_lookup(self):
+        self.routes.store('msg1', 'app1')
+        self.assertEqual('app1', (yield self.routes.lookup('msg1')))
+        self.assertEqual(None, (yield self.routes.lookup('msg2')))
+
+    @inlineCallbacks
+    def test_store_writes_to_redis(self):
+        self.routes.store('msg1', 'app1')
+        yield self.routes.flush()
+        self.assertEqual('app1', (yield self.redis.get('route:msg1')))
+        ttl = yield self.redis.ttl('route:msg1')
+        self.assertTrue(0 < ttl <= 60)
+
+    @inlineCallbacks
+    def test_store_without_expiry(self):
+        routes = RouteMemory(self.redis)
+        routes.store('msg1', 'app1')
+        yield routes.flush()
+        self.assertEqual('app1', (yield self.redis.get('route:msg1')))
+        self.assertEqual(None, (yield self.redis.ttl('route:msg1')))
+
+    @inlineCallbacks
+    def test_lookup_from_redis(self):
+        self.routes.store('msg1', 'app1')
+        yield self.routes.flush()
+        routes = RouteMemory(self.redis)
+        self.assertEqual('app1', (yield routes.lookup('msg1')))
+        yield self.redis.delete('route:msg1')
+        self.assertEqual('app1', (yield routes.lookup('msg1')))
+
+    @inlineCallbacks
+    def test_lookup_from_cache(self):
+        self.routes.store('msg1', 'app1')
+        yield self.routes.flush()
+        yield self.redis.delete('route:msg1')
+        self.assertEqual('app1', (yield self.routes.lookup('msg1')))
@@ -6,23 +6,44 @@ import re
 import functools
 from collections import defaultdict
 
+from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred
 
 from vumi.service import Worker
 from vumi.errors import ConfigError
 from vumi.message import TransportUserMessage, TransportEvent
-from vumi.utils import load_class_by_string, get_first_word
-from vumi.middleware import MiddlewareStack, setup_middlewares_from_config
+from vumi.utils import load_class_by_string, LRUCache
+from vumi.middleware import (MiddlewareStack, setup_middlewares_from_config,
+                             setup_middleware_metrics_from_config)
 from vumi import log
-from vumi.components import SessionManager
+from vumi.components import SessionManager, RouteMemory
 from vumi.persist.txredis_manager import TxRedisManager
 
 
 class BaseDispatchWorker(Worker):
     """Base class for a dispatch worker.
 
+    :param int partition:
+        Optional partition for this dispatcher to consume. Upstream
+        workers publishing with ``publish_partitions`` spread messages
+        over N partitions by a hash of a message field (see
+        :meth:`vumi.service.Worker.publish_to`). Running N dispatchers
+        with `partition` set to 0 to N - 1 then shares the traffic for
+        the same transports and exposed names between them. If omitted,
+        the dispatcher consumes the unpartitioned queues.
+    :param bool lazy_message_decoding:
+        If True, messages are only decoded when a field that isn't in
+        their routing headers is read, and are re-published as received
+        if unchanged. Message bodies aren't validated, so this is only
+        meant for routing-only dispatchers. Default is False.
     """
 
+    # Dispatchers consume from many queues, so their consumers share
+    # channels rather than opening one each.
+    CONSUMER_CHANNEL_GROUP = 'dispatcher'
+
+    partition = None
+
     @inlineCallbacks
     def startWorker(self):
         log.msg('Starting a %s dispatcher with config: %s'
@@ -44,11 +65,24 @@ class BaseDispatchWorker(Worker):
     def setup_endpoints(self):
         self._transport_names = self.config.get('transport_names', [])
         self._exposed_names = self.config.get('exposed_names', [])
+        self._lazy_decoding = self.config.get('lazy_message_decoding', False)
+        self.partition = self.config.get('partition')
+        if self.partition is not None:
+            self.partition = int(self.partition)
+
+    def consume_rkey(self, routing_key):
+        """Return the routing key this dispatcher consumes `routing_key` on.
+        """
+        if self.partition is None:
+            return routing_key
+        return '%s.%d' % (routing_key, self.partition)
 
     @inlineCallbacks
     def setup_middleware(self):
         middlewares = yield setup_middlewares_from_config(self, self.config)
-        self._middlewares = MiddlewareStack(middlewares)
+        metrics = yield setup_middleware_metrics_from_config(
+            self, self.config)
+        self._middlewares = MiddlewareStack(middlewares, metrics)
 
     def teardown_middleware(self):
         return self._middlewares.teardown()
@@ -74,15 +108,19 @@ class BaseDispatchWorker(Worker):
         self.transport_event_consumer = {}
         for transport_name in self._transport_names:
             self.transport_consumer[transport_name] = yield self.consume(
-                '%s.inbound' % (transport_name,),
+                self.consume_rkey('%s.inbound' % (transport_name,)),
                 functools.partial(self.dispatch_inbound_message,
                                   transport_name),
-                message_class=TransportUserMessage)
+                message_class=TransportUserMessage,
+                channel_group=self.CONSUMER_CHANNEL_GROUP,
+                lazy_decoding=self._lazy_decoding)
         for transport_name in self._transport_names:
             self.transport_event_consumer[transport_name] = yield self.consume(
-                '%s.event' % (transport_name,),
+                self.consume_rkey('%s.event' % (transport_name,)),
                 functools.partial(self.dispatch_inbound_event, transport_name),
-                message_class=TransportEvent)
+                message_class=TransportEvent,
+                channel_group=self.CONSUMER_CHANNEL_GROUP,
+                lazy_decoding=self._lazy_decoding)
 
     @inlineCallbacks
     def setup_exposed_publishers(self):
@@ -100,10 +138,12 @@ class BaseDispatchWorker(Worker):
         self.exposed_consumer = {}
         for exposed_name in self._exposed_names:
             self.exposed_consumer[exposed_name] = yield self.consume(
-                '%s.outbound' % (exposed_name,),
+                self.consume_rkey('%s.outbound' % (exposed_name,)),
                 functools.partial(self.dispatch_outbound_message,
                                   exposed_name),
-                message_class=TransportUserMessage)
+                message_class=TransportUserMessage,
+                channel_group=self.CONSUMER_CHANNEL_GROUP,
+                lazy_decoding=self._lazy_decoding)
 
     def dispatch_inbound_message(self, endpoint, msg):
         d = self._middlewares.apply_consume("inbound", msg, endpoint)
@@ -282,6 +322,83 @@ class TransportToTransportRouter(BaseDispatchRouter):
         pass
 
 
+class RegexMappingSet(object):
+    """
+    Find all the names whose regular expressions match a string, using
+    as few regex scans as possible.
+
+    Patterns are combined into a single regex made of optional lookaheads,
+    one per pattern, each wrapped in a capturing group. A single `match`
+    against the combined regex then tries every pattern at the start of
+    the string and records which ones matched. Python 2's `re` allows at
+    most 100 groups per regex, so patterns are combined in chunks of
+    :attr:`CHUNK_SIZE`. Each chunk also gets a plain alternation of its
+    patterns, which is much cheaper to match and lets chunks with no
+    matching pattern be skipped.
+
+    Patterns that have groups of their own (which would renumber any
+    backreferences) or flags (which would apply to the whole combined
+    regex) are matched separately. Matching names are returned in the
+    order they were given.
+    """
+
+    CHUNK_SIZE = 99
+
+    def __init__(self, mappings):
+        self.mappings = [(name, re.compile(pattern))
+                         for name, pattern in mappings]
+        # List of (names, any_regex, regex) tuples. any_regex matches if
+        # any name matches. For combined regexes, group i + 1 is set iff
+        # names[i] matched. Separate patterns have one name and no
+        # any_regex.
+        self._matchers = []
+        chunk = []
+        for name, regex in self.mappings:
+            if self._can_combine(regex):
+                chunk.append((name, regex))
+                if len(chunk) == self.CHUNK_SIZE:
+                    self._add_chunk(chunk)
+                    chunk = []
+            else:
+                self._add_chunk(chunk)
+                chunk = []
+                self._matchers.append(([name], None, regex))
+        self._add_chunk(chunk)
+
+    def _can_combine(self, regex):
+        return regex.groups == 0 and not (regex.flags & ~re.UNICODE)
+
+    def _add_chunk(self, chunk):
+        if not chunk:
+            return
+        if len(chunk) == 1:
+            [(name, regex)] = chunk
+            self._matchers.append(([name], None, regex))
+            return
+        any_regex = re.compile('|'.join(
+            '(?:%s)' % (regex.pattern,) for _name, regex in chunk))
+        combined = re.compile(''.join(
+            '(?:(?=(%s)))?' % (regex.pattern,) for _name, regex in chunk))
+        self._matchers.append(
+            ([name for name, _regex in chunk], any_regex, combined))
+
+    def match(self, value):
+        """Return the names whose patterns match `value`, in order."""
+        matches = []
+        for names, any_regex, regex in self._matchers:
+            if any_regex is not None and any_regex.match(value) is None:
+                continue
+            m = regex.match(value)
+            if m is None:
+                continue
+            if len(names) == 1:
+                matches.append(names[0])
+            else:
+                matches.extend(name for name, group in zip(names, m.groups())
+                               if group is not None)
+        return matches
+
+
 class ToAddrRouter(SimpleDispatchRouter):
     """Router that dispatches based on msg to_addr.
 
@@ -294,18 +411,16 @@ class ToAddrRouter(SimpleDispatchRouter):
     """
 
     def setup_routing(self):
-        self.mappings = []
-        for name, toaddr_pattern in self.config['toaddr_mappings'].items():
-            self.mappings.append((name, re.compile(toaddr_pattern)))
-            # TODO: assert that name is in list of publishers.
+        # TODO: assert that names are in list of publishers.
+        self.mapping_set = RegexMappingSet(
+            self.config['toaddr_mappings'].items())
+        self.mappings = self.mapping_set.mappings
 
     def dispatch_inbound_message(self, msg):
-        toaddr = msg['to_addr']
-        for name, regex in self.mappings:
-            if regex.match(toaddr):
-                # copy message so that the middleware doesn't see a particular
-                # message instance multiple times
-                self.dispatcher.publish_inbound_message(name, msg.copy())
+        for name in self.mapping_set.match(msg['to_addr']):
+            # copy message so that the middleware doesn't see a particular
+            # message instance multiple times
+            self.dispatcher.publish_inbound_message(name, msg.copy())
 
     def dispatch_inbound_event(self, msg):
         pass
@@ -376,8 +491,15 @@ class UserGroupingRouter(SimpleDispatchRouter):
     :param str dispatcher_name:
         The name of the dispatcher, used internally as
         the prefix for Redis keys.
+
+    :param int user_cache_size:
+        Number of user group assignments to keep in process. Users
+        are never moved between groups, so routing messages from
+        these users needs no Redis calls. Default is 10000.
     """
 
+    DEFAULT_USER_CACHE_SIZE = 10000
+
     def setup_routing(self):
         r_config = self.config.get('redis_manager', {})
         r_prefix = self.config['dispatcher_name']
@@ -387,7 +509,10 @@ class UserGroupingRouter(SimpleDispatchRouter):
         self._redis_d.addCallback(self._setup_redis)
 
         self.groups = self.config['group_mappings']
+        self.sorted_groups = sorted(self.groups.items())
         self.nr_of_groups = len(self.groups)
+        self.user_groups = LRUCache(int(self.config.get(
+            'user_cache_size', self.DEFAULT_USER_CACHE_SIZE)))
 
     def _setup_redis(self, redis):
         self.redis = redis
@@ -396,17 +521,22 @@ class UserGroupingRouter(SimpleDispatchRouter):
     def get_next_group(self):
         counter = (yield self.redis.incr('round-robin')) - 1
         current_group_id = counter % self.nr_of_groups
-        sorted_groups = sorted(self.groups.items())
-        group = sorted_groups[current_group_id]
-        returnValue(group)
+        returnValue(self.sorted_groups[current_group_id])
 
     @inlineCallbacks
     def get_group_for_user(self, user_id):
+        group = self.user_groups.get(user_id)
+        if group is not None:
+            returnValue(group)
         user_key = "user:%s" % (user_id,)
         group = yield self.redis.get(user_key)
         if not group:
             group, transport_name = yield self.get_next_group()
-            yield self.redis.set(user_key, group)
+            # Another dispatcher may have assigned this user since the
+            # get() above, in which case its assignment wins.
+            if not (yield self.redis.setnx(user_key, group)):
+                group = yield self.redis.get(user_key)
+        self.user_groups[user_id] = group
         returnValue(group)
 
     @inlineCallbacks
@@ -417,6 +547,53 @@ class UserGroupingRouter(SimpleDispatchRouter):
         self.dispatcher.publish_inbound_message(app, msg)
 
 
+class KeywordRuleIndex(object):
+    """
+    Find the :class:`ContentKeywordRouter` rules that match a message
+    without checking every rule.
+
+    Rules are indexed by keyword, and then by `to_addr` for rules that
+    have one. Rules with a `prefix` are indexed by prefix, so finding
+    them takes one lookup per leading substring of the `from_addr`.
+    Matching rules are returned in the order they were given.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        # keyword -> to_addr -> prefix -> [(position, rule), ...], where
+        # rules without a to_addr or prefix are stored under None.
+        self._index = {}
+        for position, rule in enumerate(self.rules):
+            by_to_addr = self._index.setdefault(rule['keyword'], {})
+            # A rule's to_addr may itself be None, so wrap it in a tuple.
+            to_addr_key = (rule['to_addr'],) if 'to_addr' in rule else None
+            by_prefix = by_to_addr.setdefault(to_addr_key, {})
+            by_prefix.setdefault(rule.get('prefix'), []).append(
+                (position, rule))
+
+    def _match_prefixes(self, by_prefix, from_addr, matches):
+        matches.extend(by_prefix.get(None, ()))
+        if len(by_prefix) == 1 and None in by_prefix:
+            return
+        if not isinstance(from_addr, basestring):
+            return
+        for i in range(len(from_addr) + 1):
+            matches.extend(by_prefix.get(from_addr[:i], ()))
+
+    def match(self, keyword, to_addr, from_addr):
+        """Return the rules matching a message, in rule order."""
+        by_to_addr = self._index.get(keyword)
+        if by_to_addr is None:
+            return []
+        matches = []
+        for to_addr_key in (None, (to_addr,)):
+            by_prefix = by_to_addr.get(to_addr_key)
+            if by_prefix is not None:
+                self._match_prefixes(by_prefix, from_addr, matches)
+        matches.sort()
+        return [rule for _position, rule in matches]
+
+
 class ContentKeywordRouter(SimpleDispatchRouter):
     """Router that dispatches based on the first word of the message
     content. In the context of SMSes the first word is sometimes called
@@ -455,31 +632,35 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         with the transport_name the message came in on and are used to
         route events such as acknowledgements and delivery reports
         back to the application that sent the outgoing
-        message. Default is seven days.
+        message. Default is seven days. Routes stored as sessions by
+        older versions are only looked up for this long after this
+        version first started.
+
+    :param int routing_memory_cache_size:
+        Number of recent outbound message ids to keep in process as
+        well as in redis, so that events for them can be routed without
+        a redis lookup. Default is 10000.
     """
 
     DEFAULT_ROUTING_TIMEOUT = 60 * 60 * 24 * 7  # 7 days
+    DEFAULT_ROUTING_CACHE_SIZE = 10000
+    # Redis key holding the time routes were first stored as route keys
+    # instead of sessions.
+    ROUTE_MEMORY_SINCE_KEY = 'route_memory_since'
+
+    clock = reactor
 
     def setup_routing(self):
         self.r_config = self.config.get('redis_manager', {})
         self.r_prefix = self.config['dispatcher_name']
 
-        self.rules = []
-        for rule in self.config.get('rules', []):
-            if 'keyword' not in rule or 'app' not in rule:
-                raise ConfigError("Rule definition %r must contain values for"
-                                  " both 'app' and 'keyword'" % rule)
-            rule = rule.copy()
-            rule['keyword'] = rule['keyword'].lower()
-            self.rules.append(rule)
-        keyword_mappings = self.config.get('keyword_mappings', {})
-        for transport_name, keyword in keyword_mappings.items():
-            self.rules.append({'app': transport_name,
-                               'keyword': keyword.lower()})
+        self.load_rules(self.config)
         self.fallback_application = self.config.get('fallback_application')
         self.transport_mappings = self.config['transport_mappings']
         self.expire_routing_timeout = int(self.config.get(
             'expire_routing_memory', self.DEFAULT_ROUTING_TIMEOUT))
+        self.routing_cache_size = int(self.config.get(
+            'routing_memory_cache_size', self.DEFAULT_ROUTING_CACHE_SIZE))
 
         # FIXME: The following is a hack to deal with sync-only setup.
         self._redis_d = TxRedisManager.from_config(self.r_config)
@@ -488,8 +669,59 @@ class ContentKeywordRouter(SimpleDispatchRouter):
 
     def _setup_redis(self, redis):
         self.redis = redis
+        # Routes used to be stored as sessions. The session manager is
+        # kept so that events for messages sent before the upgrade can
+        # still be routed until those sessions have expired.
         self.session_manager = SessionManager(
             self.redis, self.expire_routing_timeout)
+        self.route_memory = RouteMemory(
+            self.redis, self.expire_routing_timeout, self.routing_cache_size)
+        d = self.redis.setnx(self.ROUTE_MEMORY_SINCE_KEY,
+                             int(self.clock.seconds()))
+        d.addCallback(lambda _: self.redis.get(self.ROUTE_MEMORY_SINCE_KEY))
+        d.addCallback(self._set_legacy_routes_until)
+        return d
+
+    def _set_legacy_routes_until(self, since):
+        # Once every route stored as a session has expired, a route that
+        # isn't in route memory can't be found in the sessions either.
+        self.legacy_routes_until = None
+        if self.expire_routing_timeout:
+            self.legacy_routes_until = (
+                int(since) + self.expire_routing_timeout)
+
+    def legacy_routes_expired(self):
+        """
+        Return True if every route stored as a session has expired, so
+        that events need not be looked up in the sessions.
+        """
+        return (self.legacy_routes_until is not None and
+                self.clock.seconds() >= self.legacy_routes_until)
+
+    @inlineCallbacks
+    def teardown_routing(self):
+        yield self._redis_d
+        yield self.route_memory.flush()
+
+    def load_rules(self, config):
+        """
+        Build the routing rules from the `rules` and `keyword_mappings`
+        in `config`.
+        """
+        rules = []
+        for rule in config.get('rules', []):
+            if 'keyword' not in rule or 'app' not in rule:
+                raise ConfigError("Rule definition %r must contain values for"
+                                  " both 'app' and 'keyword'" % rule)
+            rule = rule.copy()
+            rule['keyword'] = rule['keyword'].lower()
+            rules.append(rule)
+        keyword_mappings = config.get('keyword_mappings', {})
+        for transport_name, keyword in keyword_mappings.items():
+            rules.append({'app': transport_name,
+                          'keyword': keyword.lower()})
+        self.rule_index = KeywordRuleIndex(rules)
+        self.rules = self.rule_index.rules
 
     def get_message_key(self, message):
         return 'message:%s' % (message,)
@@ -504,22 +736,26 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         self.dispatcher.publish_inbound_event(name, msg)
 
     def is_msg_matching_routing_rules(self, keyword, msg, rule):
+        """
+        Return True if `msg`, whose first word is `keyword`, matches
+        `rule`. Routing doesn't use this; it looks all matching rules up
+        in :attr:`rule_index` at once.
+        """
         return all([keyword == rule['keyword'],
-                    (not 'to_addr' in rule) or
+                    ('to_addr' not in rule) or
                     (msg['to_addr'] == rule['to_addr']),
-                    (not 'prefix' in rule) or
+                    ('prefix' not in rule) or
                     (msg['from_addr'].startswith(rule['prefix']))])
 
     def dispatch_inbound_message(self, msg):
-        keyword = get_first_word(msg['content']).lower()
-        matched = False
-        for rule in self.rules:
-            if self.is_msg_matching_routing_rules(keyword, msg, rule):
-                matched = True
-                # copy message so that the middleware doesn't see a particular
-                # message instance multiple times
-                self.publish_exposed_inbound(rule['app'], msg.copy())
-        if not matched:
+        keyword = msg.routing_keyword()
+        rules = self.rule_index.match(
+            keyword, msg['to_addr'], msg['from_addr'])
+        for rule in rules:
+            # copy message so that the middleware doesn't see a particular
+            # message instance multiple times
+            self.publish_exposed_inbound(rule['app'], msg.copy())
+        if not rules:
             if self.fallback_application is not None:
                 self.publish_exposed_inbound(self.fallback_application, msg)
             else:
@@ -528,9 +764,11 @@ class ContentKeywordRouter(SimpleDispatchRouter):
     @inlineCallbacks
     def dispatch_inbound_event(self, msg):
         yield self._redis_d  # Horrible hack to ensure we have it setup.
-        message_key = self.get_message_key(msg['user_message_id'])
-        session = yield self.session_manager.load_session(message_key)
-        name = session.get('name')
+        name = yield self.route_memory.lookup(msg['user_message_id'])
+        if name is None and not self.legacy_routes_expired():
+            message_key = self.get_message_key(msg['user_message_id'])
+            session = yield self.session_manager.load_session(message_key)
+            name = session.get('name')
         if not name:
             log.error("No transport_name for return route found in Redis"
                       " while dispatching transport event for message %s"
@@ -545,10 +783,14 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         yield self._redis_d  # Horrible hack to ensure we have it setup.
         transport_name = self.transport_mappings.get(msg['from_addr'])
         if transport_name is not None:
+            d = self.route_memory.store(
+                msg['message_id'], msg['transport_name'])
+            if self.dispatcher.partition is not None:
+                # Events are partitioned by message id rather than user, so
+                # a different dispatcher may route this message's events.
+                # It can only do that once the route is in redis.
+                yield d
             self.publish_transport(transport_name, msg)
-            message_key = self.get_message_key(msg['message_id'])
-            yield self.session_manager.create_session(
-                message_key, name=msg['transport_name'])
         else:
             log.error("No transport for %s" % (msg['from_addr'],))
 
@@ -1,7 +1,12 @@
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
+from twisted.internet.task import Clock
+from txamqp.content import Content
+
+from twisted.trial.unittest import TestCase
 
 from vumi.dispatchers.base import (
-    BaseDispatchWorker, ToAddrRouter, FromAddrMultiplexRouter)
+    BaseDispatchWorker, ToAddrRouter, FromAddrMultiplexRouter,
+    KeywordRuleIndex, RegexMappingSet)
 from vumi.middleware import MiddlewareStack
 from vumi.tests.utils import VumiWorkerTestCase, LogCatcher
 from vumi.dispatchers.tests.utils import DispatcherTestCase
@@ -166,6 +171,37 @@ class TestBaseDispatchWorker(VumiWorkerTestCase):
         self.assert_messages(apps, 'transport2.outbound', msgs)
         self.assert_no_messages('transport1.outbound', 'transport3.outbound')
 
+    @inlineCallbacks
+    def test_lazy_message_decoding_opt_in(self):
+        dispatcher = yield self.get_dispatcher()
+        consumer = dispatcher.transport_consumer['transport1']
+        self.assertFalse(consumer.lazy_decoding)
+        dispatcher = yield self.get_dispatcher(lazy_message_decoding=True)
+        consumer = dispatcher.transport_consumer['transport1']
+        self.assertTrue(consumer.lazy_decoding)
+
+    @inlineCallbacks
+    def test_partitioned_routing(self):
+        yield self.get_dispatcher(partition=1)
+        msg = self.mkmsg_in(transport_name='transport1')
+        yield self.dispatch(msg, 'transport1.inbound.1')
+        self.assert_messages(['transport1.inbound'], 'app1.inbound', [msg])
+
+        ack = self.mkmsg_ack(transport_name='transport1')
+        yield self.dispatch(ack, 'transport1.event.1')
+        self.assert_messages(['transport1.event'], 'app1.event', [ack])
+
+        msg = self.mkmsg_out(transport_name='transport1')
+        yield self.dispatch(msg, 'app1.outbound.1')
+        self.assert_messages(['app1.outbound'], 'transport1.outbound', [msg])
+
+        self.clear_dispatched()
+        yield self.dispatch(self.mkmsg_in(transport_name='transport1'),
+                            'transport1.inbound.0')
+        yield self.dispatch(self.mkmsg_in(transport_name='transport1'),
+                            'transport1.inbound')
+        self.assert_no_messages('app1.inbound')
+
 
 class DummyDispatcher(BaseDispatchWorker):
 
@@ -231,6 +267,46 @@ class TestToAddrRouter(VumiWorkerTestCase):
         publishers = self.dispatcher.transport_publisher
         self.assertEqual(publishers['transport1'].msgs, [msg])
 
+    def test_dispatch_inbound_message_to_all_matches(self):
+        msg = self.mkmsg_in(to_addr='to:app2:1', transport_name='transport1')
+        self.router.dispatch_inbound_message(msg)
+        publishers = self.dispatcher.exposed_publisher
+        self.assertEqual(publishers['app1'].msgs, [msg])
+        self.assertEqual(publishers['app2'].msgs, [msg])
+
+
+class TestRegexMappingSet(TestCase):
+
+    def test_match(self):
+        mapping_set = RegexMappingSet([
+            ('app1', 'to:.*:1'),
+            ('app2', 'to:app2'),
+            ('app3', 'from:'),
+            ])
+        self.assertEqual(['app1', 'app2'], mapping_set.match('to:app2:1'))
+        self.assertEqual(['app2'], mapping_set.match('to:app2'))
+        self.assertEqual([], mapping_set.match('to:app3'))
+
+    def test_match_uncombinable_patterns(self):
+        mapping_set = RegexMappingSet([
+            ('app1', 'a'),
+            ('app2', r'(a)\1'),
+            ('app3', '(?i)A'),
+            ('app4', 'aa'),
+            ])
+        self.assertEqual(['app1', 'app2', 'app3', 'app4'],
+                         mapping_set.match('aa'))
+        self.assertEqual(['app1', 'app3'], mapping_set.match('ab'))
+
+    def test_match_many_patterns(self):
+        patterns = [('app%d' % i, r'%d\d*$' % i) for i in range(250)]
+        mapping_set = RegexMappingSet(patterns)
+        self.assertEqual(['app1', 'app12', 'app123'],
+                         mapping_set.match('123'))
+        self.assertEqual(['app2', 'app24', 'app249'],
+                         mapping_set.match('249'))
+        self.assertEqual([], mapping_set.match('x'))
+
 
 class TestTransportToTransportRouter(VumiWorkerTestCase):
 
@@ -247,6 +323,7 @@ class TestTransportToTransportRouter(VumiWorkerTestCase):
             "route_mappings": {
                 "transport1": ["transport2"],
                 },
+            "lazy_message_decoding": True,
             }
         self.worker = yield self.get_worker(config, BaseDispatchWorker)
 
@@ -273,6 +350,37 @@ class TestTransportToTransportRouter(VumiWorkerTestCase):
         self.assert_messages('transport2.outbound', [msg])
         self.assert_no_messages('transport2.inbound', 'transport1.outbound')
 
+    @inlineCallbacks
+    def test_unmodified_message_body_passed_through(self):
+        msg = self.mkmsg_in(transport_name='transport1')
+        # Not what to_json() would produce, so we can tell.
+        body = ' ' + msg.to_json()
+        self._amqp.publish_raw('vumi', 'transport1.inbound', body)
+        yield self._amqp.kick_delivery()
+        [content] = self._amqp.get_dispatched('vumi', 'transport2.outbound')
+        self.assertEqual(body, content.body)
+
+    @inlineCallbacks
+    def test_routing_headers_passed_through(self):
+        msg = self.mkmsg_in(transport_name='transport1')
+        content = Content(msg.to_json())
+        content['headers'] = msg.routing_headers()
+        self._amqp.basic_publish('vumi', 'transport1.inbound', content)
+        yield self._amqp.kick_delivery()
+        [published] = self._amqp.get_dispatched('vumi', 'transport2.outbound')
+        self.assertEqual(msg.routing_headers(), published['headers'])
+
+    @inlineCallbacks
+    def test_retried_header_not_passed_through(self):
+        msg = self.mkmsg_in(transport_name='transport1')
+        content = Content(msg.to_json())
+        content['headers'] = dict(msg.routing_headers(), retried=1)
+        self._amqp.basic_publish('vumi', 'transport1.inbound', content)
+        yield self._amqp.kick_delivery()
+        [published] = self._amqp.get_dispatched('vumi', 'transport2.outbound')
+        self.assertFalse('retried' in published['headers'])
+        self.assertEqual(msg.routing_headers(), published['headers'])
+
 
 class TestFromAddrMultiplexRouter(VumiWorkerTestCase):
 
@@ -402,6 +510,30 @@ class UserGroupingRouterTestCase(DispatcherTestCase):
             'group2',
         ])
 
+    @inlineCallbacks
+    def test_concurrent_group_assignment(self):
+        yield self.redis.incr('round-robin')
+        groups = yield gatherResults([
+            self.router.get_group_for_user('from_1'),
+            self.router.get_group_for_user('from_1'),
+            ])
+        self.assertEqual(groups, ['group2', 'group2'])
+        self.assertEqual('group2', (yield self.redis.get('user:from_1')))
+
+    @inlineCallbacks
+    def test_existing_group_assignment(self):
+        yield self.redis.set('user:from_1', 'group2')
+        group = yield self.router.get_group_for_user('from_1')
+        self.assertEqual(group, 'group2')
+
+    @inlineCallbacks
+    def test_cached_group_assignment(self):
+        group = yield self.router.get_group_for_user('from_1')
+        yield self.redis._purge_all()
+        self.assertEqual(group, (yield self.router.get_group_for_user(
+            'from_1')))
+        self.assertEqual(None, (yield self.redis.get('user:from_1')))
+
     def mkmsg_from(self, from_addr):
         return self.mkmsg_in(
             transport_name=self.transport_name, from_addr=from_addr)
@@ -443,6 +575,39 @@ class UserGroupingRouterTestCase(DispatcherTestCase):
         self.assertEqual(app_msg, transport_msg)
 
 
+class TestKeywordRuleIndex(TestCase):
+
+    def test_match_keyword(self):
+        index = KeywordRuleIndex([
+            {'app': 'app1', 'keyword': 'foo'},
+            {'app': 'app2', 'keyword': 'bar'},
+            ])
+        self.assertEqual(['app1'], [
+            r['app'] for r in index.match('foo', '8181', '+256')])
+        self.assertEqual([], index.match('baz', '8181', '+256'))
+
+    def test_match_to_addr_and_prefix(self):
+        index = KeywordRuleIndex([
+            {'app': 'app1', 'keyword': 'foo', 'to_addr': '8181',
+             'prefix': '+256'},
+            {'app': 'app2', 'keyword': 'foo', 'prefix': '+2567'},
+            {'app': 'app3', 'keyword': 'foo', 'to_addr': '8181'},
+            {'app': 'app4', 'keyword': 'foo', 'to_addr': None},
+            {'app': 'app5', 'keyword': 'foo'},
+            ])
+
+        def apps(to_addr, from_addr):
+            return [r['app'] for r in index.match('foo', to_addr, from_addr)]
+
+        self.assertEqual(['app1', 'app2', 'app3', 'app5'],
+                         apps('8181', '+256788601462'))
+        self.assertEqual(['app1', 'app3', 'app5'],
+                         apps('8181', '+256188601462'))
+        self.assertEqual(['app2', 'app5'], apps('8282', '+256788601462'))
+        self.assertEqual(['app4', 'app5'], apps(None, '+27831234567'))
+        self.assertEqual(['app4', 'app5'], apps(None, None))
+
+
 class TestContentKeywordRouter(DispatcherTestCase):
 
     dispatcher_class = BaseDispatchWorker
@@ -522,6 +687,33 @@ class TestContentKeywordRouter(DispatcherTestCase):
                                                         direction='inbound')
         self.assertEqual(app3_inbound_msg, [msg])
 
+    @inlineCallbacks
+    def test_load_rules(self):
+        self.router.load_rules({
+            'rules': [{'app': 'app2', 'keyword': 'KEYWORD1'}],
+            })
+        msg = self.mkmsg_in(content='KEYWORD1 rest of a msg',
+                            to_addr='8181',
+                            from_addr='+256788601462')
+        yield self.dispatch(msg,
+                            transport_name='transport1',
+                            direction='inbound')
+        self.assertEqual([], self.get_dispatched_messages(
+            'app1', direction='inbound'))
+        self.assertEqual([msg], self.get_dispatched_messages(
+            'app2', direction='inbound'))
+
+    def test_is_msg_matching_routing_rules(self):
+        rule = self.config['rules'][0]
+        msg = self.mkmsg_in(to_addr='8181', from_addr='+256788601462')
+        self.assertTrue(
+            self.router.is_msg_matching_routing_rules('KEYWORD1', msg, rule))
+        self.assertFalse(
+            self.router.is_msg_matching_routing_rules('KEYWORD2', msg, rule))
+        msg = self.mkmsg_in(to_addr='8181', from_addr='+27831234567')
+        self.assertFalse(
+            self.router.is_msg_matching_routing_rules('KEYWORD1', msg, rule))
+
     @inlineCallbacks
     def test_inbound_message_routing_empty_message_content(self):
         msg = self.mkmsg_in(content=None)
@@ -572,6 +764,39 @@ class TestContentKeywordRouter(DispatcherTestCase):
                                                       direction='event')
         self.assertEqual(app1_event_msg, [])
 
+    @inlineCallbacks
+    def test_inbound_event_routing_legacy_routes_expired(self):
+        msg = self.mkmsg_ack(user_message_id='1',
+                             transport_name='transport1')
+        yield self.router.session_manager.create_session(
+            'message:1', name='app2')
+        self.router.clock = Clock()
+        self.router.clock.advance(self.router.legacy_routes_until)
+        self.assertTrue(self.router.legacy_routes_expired())
+
+        yield self.dispatch(msg,
+                            transport_name='transport1',
+                            direction='event')
+
+        self.assertEqual([], self.get_dispatched_messages(
+            'app2', direction='event'))
+
+    @inlineCallbacks
+    def test_route_memory_since(self):
+        yield self.router.session_manager.stop(stop_redis=False)
+        self.router.clock = Clock()
+        self.router.clock.advance(1000)
+        yield self.router._setup_redis(self.redis)
+        self.assertEqual(1003, self.router.legacy_routes_until)
+        self.assertFalse(self.router.legacy_routes_expired())
+        # A later start keeps the time routes were first stored.
+        yield self.router.session_manager.stop(stop_redis=False)
+        self.router.clock.advance(1000)
+        yield self.router._setup_redis(self.redis)
+        self.assertEqual('1000', (yield self.redis.get(
+            self.router.ROUTE_MEMORY_SINCE_KEY)))
+        self.assertTrue(self.router.legacy_routes_expired())
+
     @inlineCallbacks
     def test_inbound_event_routing_failing_publisher_not_defined(self):
         msg = self.mkmsg_ack(transport_name='transport1')
@@ -619,8 +844,25 @@ class TestContentKeywordRouter(DispatcherTestCase):
                                                        direction='outbound')
         self.assertEqual(transport2_msgs, [])
 
-        session = yield self.router.session_manager.load_session('message:1')
-        self.assertEqual(session['name'], 'app2')
+        yield self.router.route_memory.flush()
+        self.assertEqual('app2', (yield self.redis.get('route:1')))
+
+    @inlineCallbacks
+    def test_outbound_message_event_routing(self):
+        msg = self.mkmsg_out(content="KEYWORD1 rest of msg",
+                             from_addr='shortcode1',
+                             transport_name='app2')
+        yield self.dispatch(msg,
+                            transport_name='app2',
+                            direction='outbound')
+
+        ack = self.mkmsg_ack(user_message_id=msg['message_id'],
+                             transport_name='transport1')
+        yield self.dispatch(ack,
+                            transport_name='transport1',
+                            direction='event')
+        self.assertEqual([ack], self.get_dispatched_messages(
+            'app2', direction='event'))
 
 
 class TestRedirectOutboundRouterForSMPP(DispatcherTestCase):
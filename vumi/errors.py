@@ -20,3 +20,7 @@ class InvalidMessageField(InvalidMessage):
 
 class ConfigError(VumiError):
     pass
+
+
+class TemporaryError(VumiError):
+    """A message can't be handled now, but may be if it is retried later."""
@@ -0,0 +1,123 @@
+# -*- test-case-name: vumi.tests.test_local_bus -*-
+
+"""An in-process exchange for workers that share a reactor."""
+
+from twisted.python import log
+
+
+class LocalDelivery(object):
+    """
+    A message delivered through a :class:`LocalMessageBus`.
+
+    These are put on a consumer's queue next to the messages that
+    arrive over AMQP. There's no delivery tag because there is nothing
+    to acknowledge.
+
+    :attr:`message` is the consumer's own copy of the message.
+    :attr:`original` is the message as it was published, shared by
+    every queue it was delivered to, and must only be read. It is what
+    gets published over AMQP if consuming the message fails.
+    """
+
+    delivery_tag = None
+
+    def __init__(self, message, original):
+        self.message = message
+        self.original = original
+
+
+class LocalMessageBus(object):
+    """
+    Deliver messages between co-located workers without going through
+    AMQP.
+
+    Consumers register themselves for the exchange, routing key and
+    queue they consume from. Publishing to an exchange and routing key
+    with local consumers hands a copy of the :class:`vumi.message.Message`
+    to one consumer on each bound queue, round robin, so nothing is
+    encoded, sent to the broker or decoded on the way. This only happens
+    if the broker's bindings are known and every queue the broker has
+    bound to the routing key has a local consumer. Publishing to a
+    routing key that isn't bound locally, that is also bound to a queue
+    or exchange with no local consumer, or that is bound to a queue
+    whose local consumers are all paused, returns False so the
+    publisher can fall back to AMQP.
+
+    Consumers keep consuming from AMQP as well, so messages published
+    by workers in other processes still arrive.
+
+    Local deliveries are not durable. A consumer whose handler fails
+    publishes the message over AMQP to be retried (see
+    :meth:`vumi.service.Consumer.consume_local`), but messages still
+    waiting in a consumer's queue when its process dies are lost. The
+    bus gives at-most-once delivery in that case, where AMQP would
+    redeliver, which is why :class:`vumi.multiworker.MultiWorker` only
+    uses it when `local_message_bus` is set.
+    """
+
+    def __init__(self):
+        # (exchange_name, routing_key) -> {queue_name: [consumer, ...]}
+        self._bindings = {}
+
+    def add_consumer(self, consumer):
+        key = (consumer.exchange_name, consumer.routing_key)
+        queues = self._bindings.setdefault(key, {})
+        queues.setdefault(consumer.queue_name, []).append(consumer)
+        log.msg("Local bus: %s bound to %r" % (consumer.queue_name, key))
+
+    def remove_consumer(self, consumer):
+        key = (consumer.exchange_name, consumer.routing_key)
+        queues = self._bindings.get(key, {})
+        consumers = queues.get(consumer.queue_name, [])
+        if consumer in consumers:
+            consumers.remove(consumer)
+        if not consumers:
+            queues.pop(consumer.queue_name, None)
+        if not queues:
+            self._bindings.pop(key, None)
+
+    def is_bound(self, exchange_name, routing_key):
+        return (exchange_name, routing_key) in self._bindings
+
+    def _pick_consumer(self, consumers):
+        for i, consumer in enumerate(consumers):
+            if not consumer.paused:
+                # Move it to the back for round robin delivery.
+                consumers.append(consumers.pop(i))
+                return consumer
+        return None
+
+    def publish(self, exchange_name, routing_key, message, destinations):
+        """
+        Deliver `message` to the local consumers bound to `routing_key`.
+
+        :param destinations:
+            The ``(destination_type, destination)`` pairs the broker has
+            bound to `routing_key` (see
+            :meth:`vumi.service.BindingCache.destinations`), or None if
+            they aren't known. The message is only delivered locally if
+            every one of them is a queue with a local consumer, so that
+            nothing else bound to the routing key misses it.
+
+        :returns:
+            True if the message was delivered locally, False if it
+            should be published over AMQP instead.
+        """
+        queues = self._bindings.get((exchange_name, routing_key))
+        if not queues or destinations is None:
+            return False
+        if not set(destinations) <= set(('queue', q) for q in queues):
+            return False
+        targets = []
+        for consumers in queues.values():
+            consumer = self._pick_consumer(consumers)
+            if consumer is None:
+                # Leave it to the broker to hold on to the message until
+                # this queue is unpaused.
+                return False
+            targets.append(consumer)
+        for consumer in targets:
+            # Each queue gets its own copy so neither the publisher nor
+            # other consumers see changes made to it.
+            consumer.deliver_local(LocalDelivery(message.copy(), message))
+        return True
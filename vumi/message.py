@@ -1,30 +1,94 @@
 # -*- test-case-name: vumi.tests.test_message -*-
 
+import re
 import json
 from uuid import uuid4
+from copy import deepcopy
 from datetime import datetime
 
-from errors import MissingMessageField, InvalidMessageField
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
-from vumi.utils import to_kwargs
+from errors import MissingMessageField, InvalidMessageField, ConfigError
+
+from vumi.utils import to_kwargs, get_first_word
 
 
 # This is the date format we work with internally
 VUMI_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 
 
+# Matches the same strings as datetime.strptime(value, VUMI_DATE_FORMAT).
+VUMI_DATE_RE = re.compile(
+    r'(\d{4})-(\d{1,2})-(\d{1,2}) (\d{1,2}):(\d{1,2}):(\d{1,2})\.(\d{1,6})\Z')
+
+
+def parse_vumi_date(value):
+    """
+    Parse a timestamp in :data:`VUMI_DATE_FORMAT`.
+
+    This is several times faster than `strptime`, and much faster still
+    for strings that aren't timestamps.
+
+    :returns:
+        A datetime, or None if `value` isn't a timestamp.
+    """
+    match = VUMI_DATE_RE.match(value)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction = match.groups()
+    try:
+        return datetime(int(year), int(month), int(day), int(hour),
+                        int(minute), int(second), int(fraction.ljust(6, '0')))
+    except ValueError:
+        return None
+
+
 def date_time_decoder(json_object):
-    for key, value in json_object.items():
-        try:
-            json_object[key] = datetime.strptime(value,
-                    VUMI_DATE_FORMAT)
-        except ValueError:
-            continue
-        except TypeError:
-            continue
+    for key, value in json_object.iteritems():
+        if isinstance(value, basestring):
+            timestamp = parse_vumi_date(value)
+            if timestamp is not None:
+                json_object[key] = timestamp
     return json_object
 
 
+def _decode_nested_timestamps(value):
+    # Does what date_time_decoder would have done to every dict in `value`.
+    if isinstance(value, dict):
+        date_time_decoder(value)
+        for item in value.itervalues():
+            if isinstance(item, (dict, list)):
+                _decode_nested_timestamps(item)
+    elif isinstance(value, list):
+        for item in value:
+            if isinstance(item, (dict, list)):
+                _decode_nested_timestamps(item)
+
+
+def decode_timestamps(payload, timestamp_fields):
+    """
+    Decode the timestamps in a payload parsed without
+    :func:`date_time_decoder`.
+
+    Only the top-level `timestamp_fields` are decoded, not every string.
+    Timestamps nested in dicts or lists, like those in
+    ``transport_metadata``, are still found by looking at every value,
+    because older workers put them there.
+    """
+    for key, value in payload.iteritems():
+        if key in timestamp_fields:
+            if isinstance(value, basestring):
+                timestamp = parse_vumi_date(value)
+                if timestamp is not None:
+                    payload[key] = timestamp
+        elif isinstance(value, (dict, list)):
+            _decode_nested_timestamps(value)
+    return payload
+
+
 class JSONMessageEncoder(json.JSONEncoder):
     """A JSON encoder that is able to serialize datetime"""
     def default(self, obj):
@@ -41,6 +105,157 @@ def to_json(obj):
     return json.dumps(obj, cls=JSONMessageEncoder)
 
 
+# Fields publishers send in AMQP headers so that routers can read them
+# without decoding the message body. See Message.routing_headers().
+ROUTING_HEADER_FIELDS = ('to_addr', 'from_addr', 'transport_name',
+                         'message_type')
+KEYWORD_HEADER = 'keyword'
+
+
+# Values of these types are never changed in place, so copies can share them.
+IMMUTABLE_PAYLOAD_TYPES = frozenset([
+    str, unicode, int, long, float, bool, type(None), datetime])
+
+
+def copy_payload(value):
+    """
+    Copy a message payload, or a value in one, without a trip through
+    JSON. Dicts and lists are copied, immutable values are shared and
+    anything else is deep-copied.
+    """
+    value_type = type(value)
+    if value_type is dict:
+        copied = value.copy()
+        for key, item in copied.iteritems():
+            if type(item) not in IMMUTABLE_PAYLOAD_TYPES:
+                copied[key] = copy_payload(item)
+        return copied
+    if value_type in IMMUTABLE_PAYLOAD_TYPES:
+        return value
+    if value_type is list:
+        return [copy_payload(item) for item in value]
+    if value_type is tuple:
+        return tuple(copy_payload(item) for item in value)
+    return deepcopy(value)
+
+
+class MessageCodec(object):
+    """
+    Encodes message payloads for the wire.
+
+    Each codec has a name, used to choose it in worker config, and a
+    content type, sent along with every encoded message so that the
+    consumer knows how to decode it.
+    """
+
+    name = None
+    content_type = None
+
+    def encode(self, payload):
+        raise NotImplementedError()
+
+    def decode(self, data):
+        raise NotImplementedError()
+
+
+class JSONMessageCodec(MessageCodec):
+    """The default codec. Messages without a content type are JSON."""
+
+    name = 'json'
+    content_type = 'application/json'
+
+    def encode(self, payload):
+        return to_json(payload)
+
+    def decode(self, data):
+        return from_json(data)
+
+
+class MsgpackMessageCodec(MessageCodec):
+    """
+    A compact binary codec. Only available if the `msgpack` package is
+    installed.
+
+    Strings are decoded as unicode and tuples as lists, as they are
+    with JSON.
+    """
+
+    name = 'msgpack'
+    content_type = 'application/x-msgpack'
+
+    DATETIME_KEY = '__datetime__'
+
+    def _default(self, obj):
+        if isinstance(obj, datetime):
+            return {self.DATETIME_KEY: obj.strftime(VUMI_DATE_FORMAT)}
+        raise TypeError("Can't encode %r" % (obj,))
+
+    def _object_hook(self, obj):
+        if len(obj) == 1 and self.DATETIME_KEY in obj:
+            return parse_vumi_date(obj[self.DATETIME_KEY])
+        return obj
+
+    def encode(self, payload):
+        return msgpack.packb(payload, default=self._default)
+
+    def decode(self, data):
+        try:
+            return msgpack.unpackb(
+                data, raw=False, object_hook=self._object_hook)
+        except TypeError:
+            # Older versions of msgpack don't know about `raw`.
+            return msgpack.unpackb(
+                data, encoding='utf-8', object_hook=self._object_hook)
+
+
+MESSAGE_CODECS = dict((codec.name, codec) for codec in [
+    JSONMessageCodec,
+])
+if msgpack is not None:
+    MESSAGE_CODECS[MsgpackMessageCodec.name] = MsgpackMessageCodec
+
+_codec_instances = {}
+
+
+def get_codec(name=None):
+    """
+    Return the codec called `name`, or the JSON codec if `name` is None.
+    """
+    if name is None:
+        name = JSONMessageCodec.name
+    if name not in _codec_instances:
+        if name == MsgpackMessageCodec.name and msgpack is None:
+            raise ConfigError("The msgpack codec needs the msgpack package.")
+        if name not in MESSAGE_CODECS:
+            raise ConfigError("Unknown message codec: %r" % (name,))
+        _codec_instances[name] = MESSAGE_CODECS[name]()
+    return _codec_instances[name]
+
+
+def get_codec_for_content_type(content_type):
+    """
+    Return the codec for `content_type`, ignoring parameters such as
+    `charset`. Messages from workers that don't send a content type, or
+    send one we have no codec for, are treated as JSON.
+    """
+    if content_type is not None:
+        content_type = content_type.split(';', 1)[0].strip().lower()
+        for name, codec_class in MESSAGE_CODECS.items():
+            if codec_class.content_type == content_type:
+                return get_codec(name)
+    return get_codec()
+
+
+def encode_batch(messages, codec=None):
+    """
+    Encode a list of messages with `codec`, JSON by default, so that they
+    can be sent as one AMQP message. See :meth:`Message.decode_batch`.
+    """
+    if codec is None:
+        codec = get_codec()
+    return codec.encode([message.payload for message in messages])
+
+
 class Message(object):
     """
     Start of a somewhat unified message object to be
@@ -49,19 +264,66 @@ class Message(object):
 
     scary transport format -> Vumi Tansport -> Unified Message -> Vumi Worker
 
+    Subclasses should set ``__slots__ = ()`` so that messages don't
+    each carry an instance dict.
     """
 
+    __slots__ = ('payload',)
+
+    # The top-level fields that hold timestamps. If None, every value
+    # that looks like a timestamp is decoded as one.
+    TIMESTAMP_FIELDS = None
+
+    # Fields every message of this class must have, in addition to
+    # those required by its base classes. See required_fields().
+    REQUIRED_FIELDS = ()
+
     def __init__(self, _process_fields=True, **kwargs):
         if _process_fields:
             kwargs = self.process_fields(kwargs)
         self.payload = kwargs
         self.validate_fields()
 
+    @classmethod
+    def from_trusted_payload(cls, payload):
+        """
+        Build a message from a payload that is known to be valid, such as
+        one copied from another message of the same class, without
+        processing or validating it again. The payload is not copied.
+        """
+        if cls.__init__.im_func is not Message.__init__.im_func:
+            # We can't know what a custom __init__ needs to set up.
+            return cls(_process_fields=False, **payload)
+        msg = cls.__new__(cls)
+        msg.payload = payload
+        return msg
+
+    @classmethod
+    def required_fields(cls):
+        """
+        Return the fields required by this class and its base classes.
+
+        These are collected from ``REQUIRED_FIELDS`` once per class.
+        """
+        fields = cls.__dict__.get('_required_fields')
+        if fields is None:
+            fields = []
+            for klass in reversed(cls.__mro__):
+                for field in klass.__dict__.get('REQUIRED_FIELDS', ()):
+                    if field not in fields:
+                        fields.append(field)
+            fields = tuple(fields)
+            cls._required_fields = fields
+        return fields
+
     def process_fields(self, fields):
         return fields
 
     def validate_fields(self):
-        pass
+        payload = self.payload
+        for field in self.required_fields():
+            if field not in payload:
+                raise MissingMessageField(field)
 
     def assert_field_present(self, *fields):
         for field in fields:
@@ -78,7 +340,42 @@ class Message(object):
 
     @classmethod
     def from_json(cls, json_string):
-        return cls(_process_fields=False, **to_kwargs(from_json(json_string)))
+        if cls.TIMESTAMP_FIELDS is None:
+            payload = from_json(json_string)
+        else:
+            payload = decode_timestamps(json.loads(json_string),
+                                        cls.TIMESTAMP_FIELDS)
+        return cls(_process_fields=False, **to_kwargs(payload))
+
+    @classmethod
+    def decode_batch(cls, data, codec=None):
+        """
+        Decode a list of messages encoded with :func:`encode_batch`.
+        """
+        if codec is None or isinstance(codec, JSONMessageCodec):
+            payloads = json.loads(data)
+            if cls.TIMESTAMP_FIELDS is None:
+                _decode_nested_timestamps(payloads)
+            else:
+                for payload in payloads:
+                    decode_timestamps(payload, cls.TIMESTAMP_FIELDS)
+        else:
+            payloads = codec.decode(data)
+        return [cls(_process_fields=False, **to_kwargs(payload))
+                for payload in payloads]
+
+    def encode(self, codec=None):
+        """Encode this message with `codec`, JSON by default."""
+        if codec is None:
+            return self.to_json()
+        return codec.encode(self.payload)
+
+    @classmethod
+    def decode(cls, data, codec=None):
+        """Decode a message encoded with `codec`, JSON by default."""
+        if codec is None or isinstance(codec, JSONMessageCodec):
+            return cls.from_json(data)
+        return cls(_process_fields=False, **to_kwargs(codec.decode(data)))
 
     def __str__(self):
         return u"<Message payload=\"%s\">" % repr(self.payload)
@@ -106,16 +403,49 @@ class Message(object):
     def items(self):
         return self.payload.items()
 
+    def routing_headers(self):
+        """
+        Return the AMQP headers to publish this message with.
+
+        These hold the string values of :data:`ROUTING_HEADER_FIELDS`,
+        UTF-8 encoded because that's all AMQP header tables can carry.
+        """
+        headers = {}
+        payload = self.payload
+        for field in ROUTING_HEADER_FIELDS:
+            value = payload.get(field)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            if isinstance(value, str):
+                headers[field] = value
+        return headers
+
+    def routing_header(self, name):
+        """
+        Return the routing header `name` this message was received with,
+        or None. Only lazily decoded messages keep their headers.
+        """
+        return None
+
     def copy(self):
-        return self.from_json(self.to_json())
+        """
+        Return a copy of this message that can be changed without
+        affecting the original, e.g. by middleware when a message is sent
+        to several endpoints.
+        """
+        return self.from_trusted_payload(copy_payload(self.payload))
 
 
 class TransportMessage(Message):
     """Common base class for messages sent to or from a transport."""
 
+    __slots__ = ()
+
     # sub-classes should set the message type
     MESSAGE_TYPE = None
     MESSAGE_VERSION = '20110921'
+    TIMESTAMP_FIELDS = ('timestamp',)
+    REQUIRED_FIELDS = ('message_version', 'message_type', 'timestamp')
 
     @staticmethod
     def generate_id():
@@ -135,12 +465,10 @@ class TransportMessage(Message):
         return fields
 
     def validate_fields(self):
-        self.assert_field_value('message_version', self.MESSAGE_VERSION)
-        self.assert_field_present(
-            'message_type',
-            'timestamp',
-            )
-        if self['message_type'] is None:
+        super(TransportMessage, self).validate_fields()
+        if self.payload['message_version'] != self.MESSAGE_VERSION:
+            raise InvalidMessageField('message_version')
+        if self.payload['message_type'] is None:
             raise InvalidMessageField('message_type')
 
 
@@ -153,7 +481,22 @@ class TransportUserMessage(TransportMessage):
                       by transports or message workers).
     """
 
+    __slots__ = ()
+
     MESSAGE_TYPE = 'user_message'
+    REQUIRED_FIELDS = (
+        'message_id',
+        'to_addr',
+        'from_addr',
+        'in_reply_to',
+        'session_event',
+        'content',
+        'transport_name',
+        'transport_type',
+        'transport_metadata',
+        'helper_metadata',
+        'group',
+        )
 
     # session event constants
     #
@@ -195,29 +538,31 @@ class TransportUserMessage(TransportMessage):
         return fields
 
     def validate_fields(self):
-        super(TransportUserMessage, self).validate_fields()
         # We might get older message versions without the `group` field.
         self.payload.setdefault('group', None)
-        self.assert_field_present(
-            'message_id',
-            'to_addr',
-            'from_addr',
-            'in_reply_to',
-            'session_event',
-            'content',
-            'transport_name',
-            'transport_type',
-            'transport_metadata',
-            'helper_metadata',
-            'group',
-            )
-        if self['session_event'] not in self.SESSION_EVENTS:
+        super(TransportUserMessage, self).validate_fields()
+        if self.payload['session_event'] not in self.SESSION_EVENTS:
             raise InvalidMessageField("Invalid session_event %r"
                                       % (self['session_event'],))
 
     def user(self):
         return self['from_addr']
 
+    def routing_keyword(self):
+        """Return the first word of the content, in lower case."""
+        keyword = self.routing_header(KEYWORD_HEADER)
+        if keyword is None:
+            keyword = get_first_word(self['content']).lower()
+        return keyword
+
+    def routing_headers(self):
+        headers = super(TransportUserMessage, self).routing_headers()
+        keyword = self.routing_keyword()
+        if isinstance(keyword, unicode):
+            keyword = keyword.encode('utf-8')
+        headers[KEYWORD_HEADER] = keyword
+        return headers
+
     def reply(self, content, continue_session=True, **kw):
         """Construct a reply message.
 
@@ -231,6 +576,25 @@ class TransportUserMessage(TransportMessage):
         name-prefixed content in an IRC channel message).
         """
         session_event = None if continue_session else self.SESSION_CLOSE
+        if not kw:
+            # Everything but the content comes from this message, which
+            # has already been validated.
+            return TransportUserMessage.from_trusted_payload({
+                'message_version': self.MESSAGE_VERSION,
+                'message_type': TransportUserMessage.MESSAGE_TYPE,
+                'timestamp': datetime.utcnow(),
+                'message_id': self.generate_id(),
+                'to_addr': self['from_addr'],
+                'from_addr': self['to_addr'],
+                'group': self['group'],
+                'in_reply_to': self['message_id'],
+                'content': content,
+                'session_event': session_event,
+                'transport_name': self['transport_name'],
+                'transport_type': self['transport_type'],
+                'transport_metadata': self['transport_metadata'],
+                'helper_metadata': self['helper_metadata'],
+                })
         out_msg = TransportUserMessage(
             to_addr=self['from_addr'],
             from_addr=self['to_addr'],
@@ -283,7 +647,11 @@ class TransportUserMessage(TransportMessage):
 class TransportEvent(TransportMessage):
     """Message about a TransportUserMessage.
     """
+
+    __slots__ = ()
+
     MESSAGE_TYPE = 'event'
+    REQUIRED_FIELDS = ('user_message_id', 'event_id', 'event_type')
 
     # list of valid delivery statuses
     DELIVERY_STATUSES = frozenset(('pending', 'failed', 'delivered'))
@@ -306,11 +674,6 @@ class TransportEvent(TransportMessage):
 
     def validate_fields(self):
         super(TransportEvent, self).validate_fields()
-        self.assert_field_present(
-            'user_message_id',
-            'event_id',
-            'event_type',
-            )
         event_type = self.payload['event_type']
         if event_type not in self.EVENT_TYPES:
             raise InvalidMessageField("Unknown event_type %r" % (event_type,))
@@ -318,3 +681,207 @@ class TransportEvent(TransportMessage):
             self.assert_field_present(extra_field)
             if not check(self[extra_field]):
                 raise InvalidMessageField(extra_field)
+
+
+class LazyMessage(object):
+    """
+    Methods for messages that are only decoded when they are used.
+
+    Routing-only workers, like most dispatchers, look at one or two
+    fields of each message and publish it again unchanged. A lazy
+    message keeps the body it was received with and only parses it when
+    a field is first read. Timestamps are only decoded when they are
+    needed. If nothing can have changed the message, :meth:`to_json` and
+    :meth:`encode` return the original body instead of encoding the
+    payload again.
+
+    Fields in the routing headers the message was published with are
+    read from the headers, so routers that only look at those don't
+    parse the body at all. The body isn't validated in that case either.
+
+    Reading a field that holds a dict or list, or the whole
+    :attr:`payload`, counts as changing the message, because there's no
+    way to tell whether the value was changed in place afterwards.
+
+    Use :func:`lazy_message_class` to get the lazy version of a message
+    class rather than using these methods directly.
+    """
+
+    _LAZY_SLOTS = ('_raw', '_codec', '_headers', '_fields', '_decoded',
+                   '_unmodified')
+
+    # Set on each lazy class to the message class it is a lazy version of.
+    _message_class = None
+
+    @classmethod
+    def from_raw(cls, data, codec=None, headers=None):
+        """
+        Wrap a message body encoded with `codec`, JSON by default, and
+        published with the routing `headers`.
+        """
+        msg = cls.__new__(cls)
+        msg._raw = data
+        msg._codec = codec or get_codec()
+        msg._headers = headers or {}
+        msg._fields = None
+        msg._decoded = False
+        msg._unmodified = True
+        return msg
+
+    @classmethod
+    def from_trusted_payload(cls, payload):
+        """
+        Build a plain, already decoded message from `payload`. A lazy
+        message needs a body to decode, which a payload doesn't have.
+        """
+        return cls._message_class.from_trusted_payload(payload)
+
+    def _parsed(self):
+        fields = self._fields
+        if fields is None:
+            if isinstance(self._codec, JSONMessageCodec):
+                # Timestamps are left for _decoded_fields().
+                fields = to_kwargs(json.loads(self._raw))
+            else:
+                fields = to_kwargs(self._codec.decode(self._raw))
+                self._decoded = True
+            self._message_class.from_trusted_payload(fields).validate_fields()
+            self._fields = fields
+        return fields
+
+    def _decoded_fields(self):
+        fields = self._parsed()
+        if not self._decoded:
+            if self.TIMESTAMP_FIELDS is None:
+                _decode_nested_timestamps(fields)
+            else:
+                decode_timestamps(fields, self.TIMESTAMP_FIELDS)
+            self._decoded = True
+        return fields
+
+    def _get_payload(self):
+        self._unmodified = False
+        return self._decoded_fields()
+
+    def _set_payload(self, payload):
+        self._headers = {}
+        self._fields = payload
+        self._decoded = True
+        self._unmodified = False
+
+    payload = property(_get_payload, _set_payload)
+
+    def is_unmodified(self):
+        """
+        Return True if this message can't have changed since it was
+        received.
+        """
+        return self._unmodified
+
+    def raw_body(self):
+        """Return the body this message was received with."""
+        return self._raw
+
+    def _needs_decoding(self, key):
+        return self.TIMESTAMP_FIELDS is None or key in self.TIMESTAMP_FIELDS
+
+    def routing_header(self, name):
+        """
+        Return the routing header `name` this message was received with,
+        or None if the message may have changed since. The body is not
+        parsed, so reading a header doesn't validate the message.
+        """
+        if not self._unmodified:
+            return None
+        value = self._headers.get(name)
+        if value is not None:
+            value = value.decode('utf-8')
+        return value
+
+    def routing_headers(self):
+        if self._unmodified:
+            # Working them out would mean parsing the body. Only the
+            # routing headers are passed on, not whatever else the
+            # previous hop set (such as the retry marker).
+            return dict((name, value)
+                        for name, value in self._headers.iteritems()
+                        if name in ROUTING_HEADER_FIELDS
+                        or name == KEYWORD_HEADER)
+        return self._message_class.routing_headers(self)
+
+    def __getitem__(self, key):
+        if self._fields is None and key in ROUTING_HEADER_FIELDS:
+            value = self.routing_header(key)
+            if value is not None:
+                return value
+        value = self._parsed()[key]
+        if type(value) not in IMMUTABLE_PAYLOAD_TYPES:
+            return self.payload[key]
+        if not self._decoded and self._needs_decoding(key):
+            value = self._decoded_fields()[key]
+        return value
+
+    def __setitem__(self, key, value):
+        self.payload[key] = value
+
+    def __contains__(self, key):
+        if (self._fields is None and key in ROUTING_HEADER_FIELDS
+                and key in self._headers):
+            return True
+        return key in self._parsed()
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def items(self):
+        return self.payload.items()
+
+    def to_json(self):
+        if self._unmodified and isinstance(self._codec, JSONMessageCodec):
+            return self._raw
+        return to_json(self._decoded_fields())
+
+    def encode(self, codec=None):
+        if codec is None or isinstance(codec, JSONMessageCodec):
+            return self.to_json()
+        if self._unmodified and type(codec) is type(self._codec):
+            return self._raw
+        return codec.encode(self._decoded_fields())
+
+    def copy(self):
+        if not self._unmodified:
+            return self._message_class.from_trusted_payload(
+                copy_payload(self._decoded_fields()))
+        # Copies made for fan-out can still be passed through as is.
+        msg = self.from_raw(self._raw, self._codec, self._headers)
+        if self._fields is not None:
+            msg._fields = copy_payload(self._fields)
+            msg._decoded = self._decoded
+        return msg
+
+    def __str__(self):
+        return u"<Message payload=\"%s\">" % repr(self._decoded_fields())
+
+
+_lazy_classes = {}
+
+
+def lazy_message_class(message_class):
+    """
+    Return a subclass of `message_class` whose messages are decoded lazily.
+    See :class:`LazyMessage`.
+    """
+    if message_class not in _lazy_classes:
+        attrs = dict((name, value)
+                     for name, value in LazyMessage.__dict__.iteritems()
+                     if name not in ('__dict__', '__weakref__', '__doc__',
+                                     '__module__', '_LAZY_SLOTS'))
+        attrs['__slots__'] = LazyMessage._LAZY_SLOTS
+        attrs['__doc__'] = LazyMessage.__doc__
+        attrs['__module__'] = message_class.__module__
+        attrs['_message_class'] = message_class
+        _lazy_classes[message_class] = type(
+            'Lazy%s' % (message_class.__name__,), (message_class,), attrs)
+    return _lazy_classes[message_class]
@@ -4,9 +4,9 @@
 from vumi.middleware.base import (
     BaseMiddleware, TransportMiddleware, ApplicationMiddleware,
     MiddlewareStack, create_middlewares_from_config,
-    setup_middlewares_from_config)
+    setup_middlewares_from_config, setup_middleware_metrics_from_config)
 
 __all__ = [
     'BaseMiddleware', 'TransportMiddleware', 'ApplicationMiddleware',
     'MiddlewareStack', 'create_middlewares_from_config',
-    'setup_middlewares_from_config']
+    'setup_middlewares_from_config', 'setup_middleware_metrics_from_config']
@@ -1,9 +1,13 @@
 # -*- test-case-name: vumi.middleware.tests.test_base -*-
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+import time
+
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, returnValue, succeed, fail)
 
 from vumi.utils import load_class_by_string
 from vumi.errors import ConfigError, VumiError
+from vumi.blinkenlights.metrics import MetricManager, Timer, Count
 
 
 class MiddlewareError(VumiError):
@@ -108,21 +112,111 @@ class ApplicationMiddleware(BaseMiddleware):
 
 class MiddlewareStack(object):
     """Ordered list of middlewares to pass a Message through.
+
+    :param list middlewares:
+        The middlewares, in the order consumed messages pass through them.
+    :type metrics: :class:`vumi.blinkenlights.metrics.MetricManager`
+    :param metrics:
+        If given, how long each middleware takes to handle messages in
+        each direction is recorded in a
+        ``middleware.<name>.<direction>.time`` timer, and the number of
+        errors it raises in a ``middleware.<name>.<direction>.errors``
+        counter. It is stopped when the stack is torn down. Default is
+        None (no metrics are recorded).
     """
 
-    def __init__(self, middlewares):
+    DIRECTIONS = ('inbound', 'outbound', 'event', 'failure')
+
+    def __init__(self, middlewares, metrics=None):
         self.middlewares = middlewares
+        self.metrics = metrics
+        self._middleware_metrics = {}
+        if metrics is not None:
+            for middleware in middlewares:
+                for direction in self.DIRECTIONS:
+                    self._register_metrics(metrics, middleware, direction)
+
+    def _register_metrics(self, metrics, middleware, direction):
+        prefix = 'middleware.%s.%s.' % (middleware.name, direction)
+        self._middleware_metrics[(middleware, direction)] = (
+            metrics.register(Timer(prefix + 'time')),
+            metrics.register(Count(prefix + 'errors')))
 
-    @inlineCallbacks
     def _handle(self, middlewares, handler_name, message, endpoint):
+        """
+        Pass `message` through each of `middlewares` in turn.
+
+        Handlers that return plain values are called one after the other
+        without going through a Deferred. The remaining handlers are only
+        chained onto a Deferred once a handler actually returns one.
+
+        :rtype: Deferred
+        :returns: A Deferred that fires with the processed message.
+        """
+        try:
+            return self._process(
+                iter(middlewares), handler_name, message, endpoint)
+        except Exception:
+            return fail()
+
+    def _process(self, middlewares, handler_name, message, endpoint):
         method_name = 'handle_%s' % (handler_name,)
         for middleware in middlewares:
             handler = getattr(middleware, method_name)
-            message = yield handler(message, endpoint)
-            if message is None:
-                raise MiddlewareError('Returned value of %s.%s should never ' \
-                                'be None' % (middleware, method_name,))
-        returnValue(message)
+            if self.metrics is None:
+                message = handler(message, endpoint)
+            else:
+                message = self._timed_handle(
+                    handler, middleware, handler_name, message, endpoint)
+            if isinstance(message, Deferred):
+                # Return a new Deferred so that it only fires once the
+                # whole stack has run, even if later handlers are
+                # asynchronous too.
+                d = Deferred()
+                message.addCallback(self._resume, middleware, middlewares,
+                                    handler_name, endpoint)
+                message.chainDeferred(d)
+                return d
+            self._check_result(message, middleware, method_name)
+        return succeed(message)
+
+    def _resume(self, message, middleware, middlewares, handler_name,
+                endpoint):
+        self._check_result(
+            message, middleware, 'handle_%s' % (handler_name,))
+        return self._process(middlewares, handler_name, message, endpoint)
+
+    def _timed_handle(self, handler, middleware, handler_name, message,
+                      endpoint):
+        # Timer.start() and Timer.stop() can't be used because messages
+        # may be waiting on an asynchronous handler at the same time.
+        timer, errors = self._middleware_metrics[(middleware, handler_name)]
+        start = time.time()
+        try:
+            result = handler(message, endpoint)
+        except Exception:
+            errors.inc()
+            raise
+        if isinstance(result, Deferred):
+            result.addCallbacks(self._record_time, self._record_error,
+                                callbackArgs=(timer, start),
+                                errbackArgs=(errors,))
+        else:
+            timer.set(time.time() - start)
+        return result
+
+    def _record_time(self, result, timer, start):
+        timer.set(time.time() - start)
+        return result
+
+    def _record_error(self, failure, errors):
+        errors.inc()
+        return failure
+
+    def _check_result(self, message, middleware, method_name):
+        if message is None:
+            raise MiddlewareError('Returned value of %s.%s should never '
+                                  'be None' % (middleware, method_name,))
 
     def apply_consume(self, handler_name, message, endpoint):
         return self._handle(
@@ -136,6 +230,8 @@ class MiddlewareStack(object):
     def teardown(self):
         for mw in reversed(self.middlewares):
             yield mw.teardown_middleware()
+        if self.metrics is not None:
+            self.metrics.stop()
 
 
 def create_middlewares_from_config(worker, config):
@@ -169,3 +265,21 @@ def setup_middlewares_from_config(worker, config):
     for mw in middlewares:
         yield mw.setup_middleware()
     returnValue(middlewares)
+
+
+def setup_middleware_metrics_from_config(worker, config):
+    """Start a metric manager for a worker's :class:`MiddlewareStack`.
+
+    Middleware metrics are only recorded if the worker configuration
+    includes a `middleware_metrics_prefix`, e.g. ``vumi.worker0.``.
+
+    :rtype: Deferred
+    :returns:
+        A Deferred that fires with the started
+        :class:`vumi.blinkenlights.metrics.MetricManager`, or None if
+        metrics are not enabled.
+    """
+    prefix = config.get('middleware_metrics_prefix')
+    if prefix is None:
+        return succeed(None)
+    return worker.start_publisher(MetricManager, prefix)
@@ -1,12 +1,16 @@
 import time
 import yaml
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed)
 from twisted.trial.unittest import TestCase
 
 from vumi.middleware.base import (BaseMiddleware, MiddlewareStack,
+                                  MiddlewareError,
                                   create_middlewares_from_config,
-                                  setup_middlewares_from_config)
+                                  setup_middlewares_from_config,
+                                  setup_middleware_metrics_from_config)
+from vumi.blinkenlights.metrics import MetricManager
 
 
 class ToyMiddleware(BaseMiddleware):
@@ -39,6 +43,35 @@ class ToyMiddleware(BaseMiddleware):
         return self._handle('failure', message, endpoint)
 
 
+class AsyncToyMiddleware(ToyMiddleware):
+    """Returns an unfired Deferred that the test has to fire."""
+
+    def _handle(self, direction, message, endpoint):
+        d = Deferred()
+        self.worker.pending.append(d)
+        d.addCallback(super(AsyncToyMiddleware, self)._handle, message,
+                      endpoint)
+        return d
+
+
+class NoneMiddleware(BaseMiddleware):
+
+    def handle_inbound(self, message, endpoint):
+        return None
+
+
+class AsyncNoneMiddleware(BaseMiddleware):
+
+    def handle_inbound(self, message, endpoint):
+        return succeed(None)
+
+
+class BrokenMiddleware(BaseMiddleware):
+
+    def handle_inbound(self, message, endpoint):
+        raise ValueError("broken")
+
+
 class MiddlewareStackTestCase(TestCase):
 
     @inlineCallbacks
@@ -49,10 +82,11 @@ class MiddlewareStackTestCase(TestCase):
                 (yield self.mkmiddleware('mw3')),
                 ])
         self.processed_messages = []
+        self.pending = []
 
     @inlineCallbacks
-    def mkmiddleware(self, name):
-        mw = ToyMiddleware(name, {}, self)
+    def mkmiddleware(self, name, cls=ToyMiddleware):
+        mw = cls(name, {}, self)
         yield mw.setup_middleware()
         returnValue(mw)
 
@@ -82,6 +116,64 @@ class MiddlewareStackTestCase(TestCase):
                 ('mw1', 'inbound', 'dummy_msg.mw3.mw2.mw1', 'end_foo'),
                 ])
 
+    def test_apply_consume_synchronous(self):
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertTrue(isinstance(d, Deferred))
+        self.assertTrue(d.called)
+        self.assertEqual(len(self.processed_messages), 3)
+        return d.addCallback(self.assertEqual, 'dummy_msg.mw1.mw2.mw3')
+
+    @inlineCallbacks
+    def test_apply_consume_asynchronous(self):
+        self.stack.middlewares[1] = yield self.mkmiddleware(
+            'mw2', AsyncToyMiddleware)
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertFalse(d.called)
+        self.assert_processed([
+                ('mw1', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+                ])
+        [pending] = self.pending
+        pending.callback('inbound')
+        message = yield d
+        self.assertEqual(message, 'dummy_msg.mw1.mw2.mw3')
+        self.assert_processed([
+                ('mw1', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+                ('mw2', 'inbound', 'dummy_msg.mw1.mw2', 'end_foo'),
+                ('mw3', 'inbound', 'dummy_msg.mw1.mw2.mw3', 'end_foo'),
+                ])
+
+    @inlineCallbacks
+    def test_apply_publish_asynchronous(self):
+        self.stack.middlewares[0] = yield self.mkmiddleware(
+            'mw1', AsyncToyMiddleware)
+        self.stack.middlewares[2] = yield self.mkmiddleware(
+            'mw3', AsyncToyMiddleware)
+        d = self.stack.apply_publish('outbound', 'dummy_msg', 'end_foo')
+        self.assert_processed([])
+        self.pending.pop(0).callback('outbound')
+        self.assertFalse(d.called)
+        self.pending.pop(0).callback('outbound')
+        message = yield d
+        self.assertEqual(message, 'dummy_msg.mw3.mw2.mw1')
+
+    def test_none_result(self):
+        self.stack.middlewares.append(NoneMiddleware('none', {}, self))
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        return self.assertFailure(d, MiddlewareError)
+
+    def test_none_result_asynchronous(self):
+        self.stack.middlewares.insert(
+            1, AsyncNoneMiddleware('none', {}, self))
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertEqual(len(self.processed_messages), 1)
+        return self.assertFailure(d, MiddlewareError)
+
+    def test_handler_error(self):
+        self.stack.middlewares.insert(0, BrokenMiddleware('broken', {}, self))
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assert_processed([])
+        return self.assertFailure(d, ValueError)
+
     @inlineCallbacks
     def test_teardown_in_reverse_order(self):
 
@@ -97,6 +189,74 @@ class MiddlewareStackTestCase(TestCase):
             ['mw3', 'mw2', 'mw1'])
 
 
+class MiddlewareStackMetricsTestCase(TestCase):
+
+    def setUp(self):
+        self.metrics = MetricManager('vumi.test.')
+        self.processed_messages = []
+        self.pending = []
+        self.stack = MiddlewareStack([
+                ToyMiddleware('mw1', {}, self),
+                AsyncToyMiddleware('mw2', {}, self),
+                BrokenMiddleware('mw3', {}, self),
+                ], self.metrics)
+
+    def processed(self, name, direction, message, endpoint):
+        self.processed_messages.append((name, direction, message, endpoint))
+
+    def poll(self, suffix):
+        return [value for _, value in self.metrics[suffix].poll()]
+
+    def test_metrics_registered(self):
+        for name in ['mw1', 'mw2', 'mw3']:
+            for direction in ['inbound', 'outbound', 'event', 'failure']:
+                prefix = 'middleware.%s.%s.' % (name, direction)
+                self.assertTrue(prefix + 'time' in self.metrics)
+                self.assertTrue(prefix + 'errors' in self.metrics)
+        self.assertEqual(self.metrics['middleware.mw1.inbound.time'].name,
+                         'vumi.test.middleware.mw1.inbound.time')
+
+    def test_timing(self):
+        self.stack.middlewares.pop()
+        d = self.stack.apply_publish('outbound', 'dummy_msg', 'end_foo')
+        self.assertEqual(self.poll('middleware.mw1.outbound.time'), [])
+        self.pending.pop().callback('outbound')
+        self.assertEqual(len(self.poll('middleware.mw2.outbound.time')), 1)
+        self.assertEqual(len(self.poll('middleware.mw1.outbound.time')), 1)
+        self.assertEqual(self.poll('middleware.mw1.inbound.time'), [])
+        self.assertEqual(self.poll('middleware.mw1.outbound.errors'), [])
+        return d
+
+    def test_errors(self):
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.pending.pop().callback('inbound')
+        self.assertEqual(self.poll('middleware.mw3.inbound.errors'), [1.0])
+        self.assertEqual(self.poll('middleware.mw3.inbound.time'), [])
+        self.assertEqual(len(self.poll('middleware.mw2.inbound.time')), 1)
+        return self.assertFailure(d, ValueError)
+
+    def test_asynchronous_errors(self):
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.pending.pop().errback(ValueError("async"))
+        self.assertEqual(self.poll('middleware.mw2.inbound.errors'), [1.0])
+        self.assertEqual(self.poll('middleware.mw2.inbound.time'), [])
+        self.assertEqual(self.poll('middleware.mw3.inbound.errors'), [])
+        return self.assertFailure(d, ValueError)
+
+    @inlineCallbacks
+    def test_teardown_stops_metrics(self):
+        stopped = []
+        self.metrics.stop = lambda: stopped.append(True)
+        yield self.stack.teardown()
+        self.assertEqual(stopped, [True])
+
+    def test_no_metrics(self):
+        stack = MiddlewareStack([ToyMiddleware('mw1', {}, self)])
+        self.assertEqual(stack._middleware_metrics, {})
+        d = stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        return d.addCallback(self.assertEqual, 'dummy_msg.mw1')
+
+
 class UtilityFunctionsTestCase(TestCase):
 
     TEST_CONFIG_1 = {
@@ -150,3 +310,8 @@ class UtilityFunctionsTestCase(TestCase):
                          [ToyMiddleware, ToyMiddleware])
         self.assertEqual([mw._setup_done for mw in middlewares],
                          [False, False])
+
+    def test_middleware_metrics_disabled(self):
+        worker = object()
+        d = setup_middleware_metrics_from_config(worker, self.TEST_CONFIG_1)
+        return d.addCallback(self.assertEqual, None)
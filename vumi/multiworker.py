@@ -1,8 +1,211 @@
 # -*- test-case-name: vumi.tests.test_multiworker -*-
 
+import os
+import sys
+import json
+import signal
 from copy import deepcopy
 
+import yaml
+from twisted.python import log
+from twisted.internet import reactor
+from twisted.internet.defer import (Deferred, DeferredList, inlineCallbacks,
+                                    succeed)
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import LoopingCall
+from twisted.web import http
+from twisted.web.resource import Resource
+
 from vumi.service import Worker, WorkerCreator
+from vumi.local_bus import LocalMessageBus
+from vumi.blinkenlights.metrics import MetricManager, Metric, Count
+
+
+# File descriptors a worker process reads its configs from and writes
+# its health reports to.
+CONFIG_FD = 3
+VUMI_CONFIG_FD = 4
+HEALTH_FD = 5
+
+
+class WorkerProcessProtocol(ProcessProtocol):
+    """Relays a child process's output, health and exit to its
+    WorkerProcess."""
+
+    def __init__(self, worker_process):
+        self.worker_process = worker_process
+        self._health_buffer = ''
+
+    def childDataReceived(self, childFD, data):
+        if childFD != HEALTH_FD:
+            return ProcessProtocol.childDataReceived(self, childFD, data)
+        lines = (self._health_buffer + data).split('\n')
+        self._health_buffer = lines.pop()
+        for line in lines:
+            self.worker_process.health_reported(line)
+
+    def outReceived(self, data):
+        for line in data.splitlines():
+            log.msg("[%s] %s" % (self.worker_process.name, line))
+
+    errReceived = outReceived
+
+    def processEnded(self, reason):
+        self.worker_process.process_ended(reason)
+
+
+class WorkerProcess(object):
+    """A supervised OS process running a group of child workers.
+
+    The process is restarted whenever it exits, unless it is being
+    stopped. Restarts back off exponentially from `restart_delay` up to
+    `max_restart_delay` while the process keeps dying, and the delay
+    resets once the process has stayed up for `max_restart_delay`.
+
+    `config_data` maps file descriptors to data that is written to them
+    and then closed each time the process starts, so the process can
+    read its configs without them being written to disk. The process
+    may report its health as JSON lines on :data:`HEALTH_FD`.
+    """
+
+    clock = reactor
+    # seconds to wait for a process to exit after SIGTERM before killing it
+    stop_timeout = 10
+
+    def __init__(self, name, args, restart_delay=1.0, max_restart_delay=60.0,
+                 on_change=None, config_data=None):
+        self.name = name
+        self.args = args
+        self.config_data = config_data or {}
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.on_change = on_change
+        self.transport = None
+        self.started_at = None
+        self.restarts = 0
+        self.last_exit = None
+        self.reported_health = None
+        self.stopping = False
+        self._failures = 0
+        self._restart_call = None
+        self._stopped = []
+
+    @property
+    def running(self):
+        return self.transport is not None
+
+    def spawn_process(self, protocol, args, child_fds):
+        return reactor.spawnProcess(protocol, args[0], args, env=os.environ,
+                                    childFDs=child_fds)
+
+    def get_child_fds(self):
+        child_fds = {0: 'w', 1: 'r', 2: 'r', HEALTH_FD: 'r'}
+        for fd in self.config_data:
+            child_fds[fd] = 'w'
+        return child_fds
+
+    def start(self):
+        self.stopping = False
+        self._restart_call = None
+        log.msg("Starting worker process %s: %s" % (
+            self.name, ' '.join(self.args)))
+        self.transport = self.spawn_process(
+            WorkerProcessProtocol(self), self.args, self.get_child_fds())
+        for fd, data in sorted(self.config_data.items()):
+            self.transport.writeToChild(fd, data)
+            self.transport.closeChildFD(fd)
+        self.started_at = self.clock.seconds()
+        self._changed()
+
+    def health_reported(self, line):
+        try:
+            self.reported_health = json.loads(line)
+        except ValueError:
+            log.msg("Worker process %s reported bad health: %r" % (
+                self.name, line))
+
+    def process_ended(self, reason):
+        self.transport = None
+        self.reported_health = None
+        self.last_exit = getattr(reason.value, 'exitCode', None)
+        uptime = self.clock.seconds() - (self.started_at or 0)
+        self.started_at = None
+        self._changed()
+        if self.stopping:
+            stopped, self._stopped = self._stopped, []
+            for d in stopped:
+                d.callback(None)
+            return
+        if uptime >= self.max_restart_delay:
+            self._failures = 0
+        delay = min(self.restart_delay * (2 ** self._failures),
+                    self.max_restart_delay)
+        self._failures += 1
+        self.restarts += 1
+        log.msg("Worker process %s exited with %r, restarting in %.1fs" % (
+            self.name, self.last_exit, delay))
+        self._restart_call = self.clock.callLater(delay, self.start)
+
+    def stop(self):
+        """Stop the process and don't restart it.
+
+        :returns:
+            A Deferred that fires once the process has exited.
+        """
+        self.stopping = True
+        if self._restart_call is not None and self._restart_call.active():
+            self._restart_call.cancel()
+        self._restart_call = None
+        if not self.running:
+            return succeed(None)
+        d = Deferred()
+        self._stopped.append(d)
+        self.transport.signalProcess(signal.SIGTERM)
+        kill_call = self.clock.callLater(self.stop_timeout, self._kill)
+        d.addBoth(self._cancel_kill, kill_call)
+        return d
+
+    def _kill(self):
+        if self.running:
+            log.msg("Worker process %s didn't stop, killing it" % (
+                self.name,))
+            self.transport.signalProcess(signal.SIGKILL)
+
+    def _cancel_kill(self, result, kill_call):
+        if kill_call.active():
+            kill_call.cancel()
+        return result
+
+    def get_health(self):
+        uptime = None
+        if self.started_at is not None:
+            uptime = self.clock.seconds() - self.started_at
+        return {
+            'running': self.running,
+            'pid': self.transport.pid if self.running else None,
+            'uptime': uptime,
+            'restarts': self.restarts,
+            'last_exit': self.last_exit,
+            'workers': self.reported_health,
+        }
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change(self)
+
+
+class MultiWorkerHealthResource(Resource):
+    isLeaf = True
+
+    def __init__(self, worker):
+        self.worker = worker
+        Resource.__init__(self)
+
+    def render_GET(self, request):
+        request.setResponseCode(http.OK)
+        request.do_not_log = True
+        request.setHeader('content-type', 'application/json')
+        return json.dumps(self.worker.get_health())
 
 
 class MultiWorker(Worker):
@@ -16,14 +219,68 @@ class MultiWorker(Worker):
     :type defaults: dict
     :param defaults:
         Default configuration for child workers.
+    :type local_message_bus: bool
+    :param local_message_bus:
+        If true, child workers pass messages to each other in memory
+        instead of through AMQP whenever every queue bound to the
+        routing key they publish to is consumed by another child worker.
+        The bindings are read from the RabbitMQ management API, so this
+        has no effect unless `management-url` is set in the vumi
+        options. Other routing keys are still published over AMQP.
+        Messages handed over in memory are lost if the process dies
+        before they have been consumed, so only enable this where
+        at-most-once delivery is acceptable.
+        Default is false.
+    :type worker_processes: bool
+    :param worker_processes:
+        If true, run child workers in separate OS processes instead of
+        in this one, so a deployment can use more than one core. The
+        processes are restarted if they exit. Default is false.
+    :type process_groups: dict
+    :param process_groups:
+        Dict of group_name -> list of worker names that should share a
+        process when ``worker_processes`` is set. Workers that aren't
+        in a group get a process of their own.
+    :type restart_delay: float
+    :param restart_delay:
+        Seconds to wait before restarting a worker process that exited.
+        Doubles while the process keeps exiting. Default is 1.
+    :type max_restart_delay: float
+    :param max_restart_delay:
+        Upper limit for the restart delay. Default is 60.
+    :type health_interval: float
+    :param health_interval:
+        Seconds between the health reports worker processes send to
+        this worker. Default is 10.
+    :type metrics_prefix: str
+    :param metrics_prefix:
+        Prefix for the worker process metrics. Default is
+        ``vumi.multiworker.``.
+    :type health_port: int
+    :param health_port:
+        If set, serve the health of the child workers (and of the
+        worker processes) as JSON on this port. Default is None.
+    :type health_path: str
+    :param health_path:
+        Path to serve health on. Default is ``health``.
 
     Each entry in the ``workers`` config dict defines a child worker to start.
     A child worker's configuration should be provided in a config dict keyed by
     its name. Common configuration across child workers should go in the
     ``defaults`` config dict.
+
+    In process mode each worker process runs a MultiWorker of its own,
+    started with ``twistd vumi_worker``, with the child configs merged
+    here. The configs are passed over pipes rather than files, so AMQP
+    credentials never touch the disk. Each worker process reports the
+    health of its child workers back over another pipe, which is
+    included in the health served here and in the ``workers.connected``
+    metric. Metrics published by the child workers themselves are
+    aggregated as usual by the metrics workers.
     """
 
     WORKER_CREATOR = WorkerCreator
+    clock = reactor
 
     def construct_worker_config(self, worker_name):
         """
@@ -39,6 +296,7 @@ class MultiWorker(Worker):
         """
         config = self.construct_worker_config(worker_name)
         worker = self.worker_creator.create_worker(worker_class, config)
+        worker.local_bus = self.local_bus
         worker.setName(worker_name)
         worker.setServiceParent(self)
         return worker
@@ -46,10 +304,180 @@ class MultiWorker(Worker):
     def startService(self):
         super(MultiWorker, self).startService()
         self.workers = []
+        self.processes = {}
+        self.metrics = None
+        self.health_server = None
+        self._health_report = None
+        if self.config.get('worker_processes', False):
+            self.start_worker_processes()
+            return
+        if self.config.get('local_message_bus', False):
+            self.local_bus = LocalMessageBus()
         self.worker_creator = self.WORKER_CREATOR(self.options)
         for wname, wclass in self.config.get('workers', {}).items():
             worker = self.create_worker(wname, wclass)
             self.workers.append(worker)
+        health_fd = self.config.get('health_fd')
+        if health_fd is not None:
+            self._health_report = LoopingCall(self.report_health, health_fd)
+            self._health_report.clock = self.clock
+            self._health_report.start(
+                float(self.config.get('health_interval', 10.0)))
 
+    @inlineCallbacks
     def startWorker(self):
-        pass
+        if self.processes:
+            self.metrics = yield self.start_publisher(
+                MetricManager, self.config.get('metrics_prefix',
+                                               'vumi.multiworker.'),
+                on_publish=self._set_process_metrics)
+            self.metrics.register(Metric('processes.running'))
+            self.metrics.register(Count('processes.restarts'))
+            self.metrics.register(Metric('workers.connected'))
+            self._set_process_metrics(self.metrics)
+        health_port = self.config.get('health_port')
+        if health_port is not None:
+            health_path = self.config.get('health_path', 'health')
+            self.health_server = yield self.start_web_resources([
+                (MultiWorkerHealthResource(self), health_path),
+                ], health_port)
+
+    def stopWorker(self):
+        self._stop_health_report()
+        if self.health_server is not None:
+            self.health_server.stopListening()
+        if self.metrics is not None:
+            self.metrics.stop()
+        return self.stop_worker_processes()
+
+    def get_process_groups(self):
+        """
+        Return a dict of process name -> list of worker names to run in
+        that process.
+        """
+        worker_names = set(self.config.get('workers', {}))
+        groups = {}
+        for group_name, names in self.config.get(
+                'process_groups', {}).items():
+            groups[group_name] = [n for n in names if n in worker_names]
+            worker_names.difference_update(names)
+        for name in worker_names:
+            groups[name] = [name]
+        return groups
+
+    def construct_process_config(self, worker_names):
+        """
+        Construct the MultiWorker config for a worker process.
+        """
+        workers = self.config.get('workers', {})
+        config = {
+            'workers': dict((name, workers[name]) for name in worker_names),
+            'local_message_bus': self.config.get('local_message_bus', False),
+        }
+        for name in worker_names:
+            config[name] = self.construct_worker_config(name)
+        config['health_fd'] = HEALTH_FD
+        config['health_interval'] = self.config.get('health_interval', 10.0)
+        return config
+
+    def get_process_args(self):
+        return [
+            sys.executable, '-c',
+            'from twisted.scripts.twistd import run; run()',
+            '--nodaemon', '--pidfile=', 'vumi_worker',
+            '--worker-class', 'vumi.multiworker.MultiWorker',
+            '--config', '/dev/fd/%d' % (CONFIG_FD,),
+            '--vumi-config', '/dev/fd/%d' % (VUMI_CONFIG_FD,),
+        ]
+
+    def create_worker_process(self, process_name, args, config_data):
+        return WorkerProcess(
+            process_name, args,
+            restart_delay=float(self.config.get('restart_delay', 1.0)),
+            max_restart_delay=float(
+                self.config.get('max_restart_delay', 60.0)),
+            on_change=self._process_changed,
+            config_data=config_data)
+
+    def start_worker_processes(self):
+        vumi_options = dict((k, v) for k, v in self.options.items()
+                            if v is not None)
+        for process_name, worker_names in sorted(
+                self.get_process_groups().items()):
+            config_data = {
+                CONFIG_FD: yaml.safe_dump(
+                    self.construct_process_config(worker_names)),
+                VUMI_CONFIG_FD: yaml.safe_dump(vumi_options),
+            }
+            process = self.create_worker_process(
+                process_name, self.get_process_args(), config_data)
+            self.processes[process_name] = process
+            process.start()
+
+    def stop_worker_processes(self):
+        return DeferredList([p.stop() for p in self.processes.values()])
+
+    def report_health(self, health_fd):
+        """
+        Write the health of the child workers to `health_fd` as a line of
+        JSON, for the MultiWorker that started this worker process.
+        """
+        try:
+            os.write(health_fd, json.dumps(self.get_health()) + '\n')
+        except OSError, e:
+            log.msg("Can't report health, stopping reports: %s" % (e,))
+            self._stop_health_report()
+
+    def _stop_health_report(self):
+        if self._health_report is not None and self._health_report.running:
+            self._health_report.stop()
+        self._health_report = None
+
+    def _process_changed(self, process):
+        if self.metrics is None:
+            return
+        if not process.running and not process.stopping:
+            self.metrics['processes.restarts'].inc()
+
+    def _set_process_metrics(self, metrics):
+        running = len([p for p in self.processes.values() if p.running])
+        metrics['processes.running'].set(running)
+        metrics['workers.connected'].set(self._count_connected_workers())
+
+    def _count_connected_workers(self):
+        return sum(p.reported_health['connected']
+                   for p in self.processes.values()
+                   if p.reported_health is not None)
+
+    def get_worker_health(self):
+        """
+        Return the health of the child workers running in this process.
+        """
+        workers = dict((worker.name, {
+            'running': worker.running,
+            'connected': worker._amqp_client is not None,
+            }) for worker in self.workers)
+        return {
+            'workers': workers,
+            'connected': len([w for w in workers.values()
+                              if w['connected']]),
+            'total': len(workers),
+        }
+
+    def get_health(self):
+        """
+        Return the health of the worker processes and the child workers
+        they have reported on, or of the child workers in this process
+        if ``worker_processes`` isn't set.
+        """
+        if not self.config.get('worker_processes', False):
+            return self.get_worker_health()
+        processes = dict((name, process.get_health())
+                         for name, process in self.processes.items())
+        return {
+            'processes': processes,
+            'running': len([p for p in processes.values() if p['running']]),
+            'total': len(processes),
+            'restarts': sum(p['restarts'] for p in processes.values()),
+            'workers_connected': self._count_connected_workers(),
+        }
@@ -114,6 +114,11 @@ class FakeRedis(object):
             return 1
         return 0
 
+    @maybe_async
+    def setex(self, key, seconds, value):
+        self.set.sync(self, key, value)
+        self.expire.sync(self, key, seconds)
+
     @maybe_async
     def delete(self, key):
         existed = (key in self._data)
@@ -4,7 +4,7 @@
 
 from datetime import datetime
 
-from vumi.message import VUMI_DATE_FORMAT
+from vumi.message import VUMI_DATE_FORMAT, parse_vumi_date
 from vumi.utils import to_kwargs
 
 
@@ -213,7 +213,8 @@ class Timestamp(Field):
         return value.strftime(VUMI_DATE_FORMAT)
 
     def custom_from_riak(self, value):
-        return datetime.strptime(value, VUMI_DATE_FORMAT)
+        return (parse_vumi_date(value)
+                or datetime.strptime(value, VUMI_DATE_FORMAT))
 
 
 class Json(Field):
@@ -240,7 +241,8 @@ class VumiMessageDescriptor(FieldDescriptor):
         return dt.strftime(VUMI_DATE_FORMAT)
 
     def _timestamp_from_json(self, value):
-        return datetime.strptime(value, VUMI_DATE_FORMAT)
+        return (parse_vumi_date(value)
+                or datetime.strptime(value, VUMI_DATE_FORMAT))
 
     def set_value(self, modelobj, msg):
         """Set the value associated with this descriptor."""
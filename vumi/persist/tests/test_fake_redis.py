@@ -38,6 +38,12 @@ class FakeRedisTestCase(TestCase):
         yield self.assert_redis_op(False, 'setnx', "mykey", "other")
         yield self.assert_redis_op("value", 'get', "mykey")
 
+    @inlineCallbacks
+    def test_setex(self):
+        yield self.assert_redis_op(None, 'setex', "mykey", 10, "value")
+        yield self.assert_redis_op("value", 'get', "mykey")
+        yield self.assert_redis_op(9, 'ttl', "mykey")
+
     @inlineCallbacks
     def test_incr_with_by_param(self):
         yield self.redis.set("inc", 1)
@@ -0,0 +1,81 @@
+import time
+from twisted.python import usage
+
+from vumi.message import TransportUserMessage
+from vumi.dispatchers.base import ToAddrRouter
+from vumi.scripts.benchmark_utils import StubDispatcher, run_benchmark
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["messages", "m", "10000",
+         "Number of messages to dispatch."],
+        ["endpoints", "e", "5",
+         "Number of endpoints each message is copied to."],
+    ]
+
+    longdesc = """Benchmarks copying messages in dispatcher fan-out"""
+
+
+class JSONCopyMessage(TransportUserMessage):
+    """Copies itself the way Message.copy() used to."""
+
+    def copy(self):
+        return self.from_json(self.to_json())
+
+
+class FanOutBenchmark(object):
+    """
+    Dispatches messages through a ToAddrRouter that sends every message
+    to several endpoints, which copies it once per endpoint.
+    """
+
+    def __init__(self, options):
+        self.messages = int(options['messages'])
+        self.endpoints = int(options['endpoints'])
+
+    def make_router(self):
+        dispatcher = StubDispatcher()
+        config = {
+            'toaddr_mappings': dict(('app%d' % i, r'^\d+$')
+                                    for i in range(self.endpoints)),
+        }
+        router = ToAddrRouter(dispatcher, config)
+        router.setup_routing()
+        return dispatcher, router
+
+    def make_messages(self, message_class):
+        messages = []
+        for i in range(self.messages):
+            messages.append(message_class(
+                to_addr="1234", from_addr="5678", transport_name="bench",
+                transport_type="sms", content="Msg: %d" % (i,),
+                transport_metadata={'session_id': str(i)},
+                helper_metadata={'tag': {'tag': ['pool', 'tag%d' % i]}}))
+        return messages
+
+    def time_dispatch(self, message_class):
+        dispatcher, router = self.make_router()
+        msgs = self.make_messages(message_class)
+        start = time.time()
+        for msg in msgs:
+            router.dispatch_inbound_message(msg)
+        elapsed = time.time() - start
+        assert dispatcher.published == self.messages * self.endpoints
+        return elapsed
+
+    def run(self):
+        print "Dispatching %d messages to %d endpoints each." % (
+            self.messages, self.endpoints)
+        results = [
+            ("JSON round trip copy", self.time_dispatch(JSONCopyMessage)),
+            ("Message.copy()", self.time_dispatch(TransportUserMessage)),
+        ]
+        for name, elapsed in results:
+            print "%s took %.2f seconds (%.2f msgs/s, %.1f us per copy)" % (
+                name, elapsed, self.messages / elapsed,
+                elapsed * 1e6 / (self.messages * self.endpoints))
+
+
+if __name__ == '__main__':
+    run_benchmark(Options, FanOutBenchmark)
@@ -0,0 +1,95 @@
+import re
+import time
+from twisted.python import usage
+
+from vumi.message import TransportUserMessage
+from vumi.dispatchers.base import ToAddrRouter
+from vumi.scripts.benchmark_utils import StubDispatcher, run_benchmark
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["messages", "m", "10000",
+         "Number of messages to dispatch for each pattern count."],
+        ["patterns", "p", "10,100,1000,10000",
+         "Comma-separated list of toaddr_mappings sizes to benchmark."],
+    ]
+
+    longdesc = """Benchmarks ToAddrRouter with many toaddr_mappings"""
+
+    def postOptions(self):
+        try:
+            self['patterns'] = [int(n) for n in self['patterns'].split(',')]
+        except ValueError:
+            raise usage.UsageError("Pattern counts must be numbers.")
+        # Each run needs the catch-all and at least one short code.
+        if min(self['patterns']) < 2:
+            raise usage.UsageError("Pattern counts must be at least 2.")
+
+
+class ScanningToAddrRouter(ToAddrRouter):
+    """Matches each mapping in turn, the way ToAddrRouter used to."""
+
+    def setup_routing(self):
+        self.mappings = [(name, re.compile(pattern)) for name, pattern
+                         in self.config['toaddr_mappings'].items()]
+
+    def dispatch_inbound_message(self, msg):
+        toaddr = msg['to_addr']
+        for name, regex in self.mappings:
+            if regex.match(toaddr):
+                self.dispatcher.publish_inbound_message(name, msg.copy())
+
+
+class ToAddrBenchmark(object):
+    """
+    Dispatches messages through a ToAddrRouter with one short code
+    pattern per application. Each message matches two patterns: its own
+    short code and a catch-all.
+    """
+
+    def __init__(self, options):
+        self.messages = int(options['messages'])
+        self.pattern_counts = options['patterns']
+
+    def make_router(self, router_class, patterns):
+        dispatcher = StubDispatcher()
+        mappings = dict(('app%d' % i, r'^%d$' % (10000 + i,))
+                        for i in range(patterns - 1))
+        mappings['catch_all'] = r'^\d+$'
+        router = router_class(dispatcher, {'toaddr_mappings': mappings})
+        router.setup_routing()
+        return dispatcher, router
+
+    def make_messages(self, patterns):
+        messages = []
+        for i in range(self.messages):
+            messages.append(TransportUserMessage(
+                to_addr=str(10000 + i % patterns), from_addr="5678",
+                transport_name="bench", transport_type="sms",
+                content="Msg: %d" % (i,)))
+        return messages
+
+    def time_dispatch(self, router_class, patterns):
+        dispatcher, router = self.make_router(router_class, patterns)
+        msgs = self.make_messages(patterns - 1)
+        start = time.time()
+        for msg in msgs:
+            router.dispatch_inbound_message(msg)
+        elapsed = time.time() - start
+        assert dispatcher.published == self.messages * 2
+        return elapsed
+
+    def run(self):
+        print "Dispatching %d messages per run." % (self.messages,)
+        for patterns in self.pattern_counts:
+            for name, router_class in [
+                    ("Scanning", ScanningToAddrRouter),
+                    ("Combined", ToAddrRouter)]:
+                elapsed = self.time_dispatch(router_class, patterns)
+                print "%5d patterns, %s: %.2f seconds (%.1f us per msg)" % (
+                    patterns, name, elapsed, elapsed * 1e6 / self.messages)
+
+
+if __name__ == '__main__':
+    run_benchmark(Options, ToAddrBenchmark)
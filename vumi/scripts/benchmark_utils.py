@@ -0,0 +1,31 @@
+"""Helpers shared by the dispatcher benchmark scripts."""
+
+import sys
+from twisted.python import usage
+
+
+class StubDispatcher(object):
+    """Counts the messages a router publishes instead of sending them."""
+
+    def __init__(self):
+        self.published = 0
+
+    def publish_inbound_message(self, name, msg):
+        self.published += 1
+
+
+def run_benchmark(options_class, benchmark_class):
+    """
+    Parse the command line with `options_class` and run a
+    `benchmark_class` built from the options, exiting with a usage
+    message if the options are invalid.
+    """
+    try:
+        options = options_class()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    benchmark_class(options).run()
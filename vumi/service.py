@@ -1,51 +1,216 @@
 # -*- test-case-name: vumi.tests.test_service -*-
 
+import os
+import stat
 import json
+import time
+import hashlib
+import cPickle
+import tempfile
 from copy import deepcopy
+from collections import deque
+from urllib import quote
 
 from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPClient
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.internet import protocol, reactor
+from twisted.internet.defer import (inlineCallbacks, returnValue, succeed,
+                                    maybeDeferred, DeferredSemaphore,
+                                    DeferredLock, Deferred, gatherResults,
+                                    fail)
+from twisted.internet import protocol, reactor, task
 from twisted.web.resource import Resource
 import txamqp
 from txamqp.client import TwistedDelegate
 from txamqp.content import Content
 from txamqp.protocol import AMQClient
 
-from vumi.errors import VumiError
-from vumi.message import Message
-from vumi.utils import (load_class_by_string, vumi_resource_path, http_request,
-                        basic_auth_string, LogFilterSite)
+from vumi.errors import VumiError, ConfigError, TemporaryError
+from vumi.message import (Message, get_codec, get_codec_for_content_type,
+                          lazy_message_class, encode_batch)
+from vumi.local_bus import LocalDelivery
+from vumi.utils import (load_class_by_string, vumi_resource_path,
+                        http_request_full, basic_auth_string, LogFilterSite,
+                        to_kwargs, get_partition)
 
 
 SPECS = {}
 
+# Bump this whenever the format of cached specs changes.
+SPEC_CACHE_VERSION = 2
 
-def get_spec(specfile):
+# The AMQP header holding the number of messages in a batch envelope.
+BATCH_HEADER = 'batch'
+
+# The AMQP header marking a message from a batch envelope that failed
+# and was published again on its own.
+RETRIED_HEADER = 'retried'
+
+# The message field a partitioned publisher hashes by default, by the
+# last part of its routing key. Inbound and outbound messages stay in
+# one partition per user, and events in the partition of the message
+# they are about.
+DEFAULT_PARTITION_FIELDS = {
+    'inbound': 'from_addr',
+    'outbound': 'to_addr',
+    'event': 'user_message_id',
+}
+
+
+def get_spec(specfile, cache_dir=None):
     """
     Cache the generated part of txamqp, because generating it is expensive.
 
     This is important for tests, which create lots of txamqp clients,
     and therefore generate lots of specs. Just doing this results in a
     decidedly happy test run time reduction.
+
+    If `cache_dir` is given, the parsed spec is also cached on disk so
+    that other processes don't have to parse it again. See
+    :func:`load_cached_spec`.
     """
     if specfile not in SPECS:
-        SPECS[specfile] = txamqp.spec.load(specfile)
+        if cache_dir is None:
+            SPECS[specfile] = txamqp.spec.load(specfile)
+        else:
+            SPECS[specfile] = load_cached_spec(specfile, cache_dir)
     return SPECS[specfile]
 
 
+def spec_cache_path(specfile, cache_dir):
+    """Return the path of the cached copy of `specfile` in `cache_dir`."""
+    with open(specfile, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return os.path.join(cache_dir, "amqp-spec-%s-v%s.pickle" % (
+        digest, SPEC_CACHE_VERSION))
+
+
+def load_cached_spec(specfile, cache_dir):
+    """
+    Load a txamqp spec from a cache in `cache_dir`, keyed by the hash of
+    `specfile`. The spec is parsed and written to the cache if it isn't
+    there yet or can't be read.
+
+    The cache is a pickle, so it is only used if `cache_dir` and the
+    cached file belong to the current user and nobody else can write to
+    them. `cache_dir` is created readable by the current user only.
+
+    The generated classes can't be pickled, so they are generated again
+    after loading.
+    """
+    path = spec_cache_path(specfile, cache_dir)
+    if os.path.isdir(cache_dir) and not is_private_path(cache_dir):
+        log.msg("Not using AMQP spec cache %s, because other users can"
+                " write to it." % (cache_dir,))
+        return txamqp.spec.load(specfile)
+    try:
+        if not is_private_path(path):
+            raise VumiError("Cache file is writable by other users.")
+        with open(path, 'rb') as f:
+            spec = cPickle.load(f)
+    except (IOError, OSError):
+        pass
+    except Exception:
+        log.err(None, "Ignoring unreadable AMQP spec cache: %s" % (path,))
+    else:
+        spec.file = specfile
+        spec.post_load()
+        return spec
+
+    spec = txamqp.spec.load(specfile)
+    write_spec_cache(spec, path)
+    return spec
+
+
+def is_private_path(path):
+    """
+    Return True if `path` belongs to the current user and nobody else can
+    write to it.
+    """
+    st = os.stat(path)
+    return (st.st_uid == os.getuid()
+            and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+
+def write_spec_cache(spec, path):
+    generated = spec.module, spec.klass
+    del spec.module, spec.klass
+    try:
+        data = cPickle.dumps(spec, cPickle.HIGHEST_PROTOCOL)
+    finally:
+        spec.module, spec.klass = generated
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0700)
+        # Write somewhere else first so other processes never read a
+        # partially written cache. mkstemp() creates the file readable
+        # by us only.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        log.err(None, "Can't write AMQP spec cache: %s" % (path,))
+
+
+class StartupTimer(object):
+    """
+    Record how long each phase of starting a worker takes.
+
+    Phases are timed from :meth:`start` to :meth:`stop` and reported in
+    the order they were started.
+    """
+
+    clock = time
+
+    def __init__(self):
+        self.phases = []
+        self._started = {}
+        self._durations = {}
+
+    def start(self, phase):
+        if phase not in self._started:
+            self.phases.append(phase)
+        self._started[phase] = self.clock.time()
+
+    def stop(self, phase):
+        if phase in self._started and phase not in self._durations:
+            self._durations[phase] = self.clock.time() - self._started[phase]
+
+    def duration(self, phase):
+        return self._durations.get(phase)
+
+    def report(self):
+        parts = []
+        for phase in self.phases:
+            duration = self._durations.get(phase)
+            if duration is not None:
+                parts.append("%s %.3fs" % (phase, duration))
+        total = sum(self._durations.values())
+        return "Startup times: %s (total %.3fs)" % (', '.join(parts), total)
+
+
 class AmqpFactory(protocol.ReconnectingClientFactory):
 
     def __init__(self, worker):
         self.options = worker.options
         self.config = worker.config
-        self.spec = get_spec(vumi_resource_path(worker.options['specfile']))
+        self.startup_timer = worker.startup_timer
+        if self.startup_timer is not None:
+            self.startup_timer.start('spec load')
+        self.spec = get_spec(vumi_resource_path(worker.options['specfile']),
+                             worker.options.get('spec-cache-dir'))
+        if self.startup_timer is not None:
+            self.startup_timer.stop('spec load')
         self.delegate = TwistedDelegate()
         self.worker = worker
         self.amqp_client = None
 
+    def startedConnecting(self, connector):
+        if self.startup_timer is not None:
+            self.startup_timer.start('amqp connect')
+
     def buildProtocol(self, addr):
         self.amqp_client = WorkerAMQClient(
             self.delegate, self.options['vhost'],
@@ -74,7 +239,67 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
             self, connector, reason)
 
 
+class SharedChannel(object):
+    """
+    A channel shared by several consumers in the same channel group.
+
+    Each consumer on a shared channel has its own :class:`AckCoalescer`
+    that only sends single acks. A multiple ack would also cover the
+    messages other consumers on the channel are still processing.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.consumers = set()
+
+
 class WorkerAMQClient(AMQClient):
+    """
+    AMQP client that keeps a pool of channels for a worker's consumers
+    and publishers.
+
+    Publishers on the same exchange share a single channel. A
+    channel-level error, such as publishing to an exchange that doesn't
+    exist, closes the channel for all of them; publishes that were in
+    flight fail, and the next publish on the exchange opens a new
+    channel.
+
+    Consumers started with a `channel_group` share channels with other
+    consumers in the same group, up to :attr:`consumers_per_channel`
+    consumers per channel. Exchanges are declared once per connection.
+    """
+
+    consumers_per_channel = 16
+
+    def __init__(self, *args, **kw):
+        AMQClient.__init__(self, *args, **kw)
+        self.binding_caches = {}
+        self._next_channel_id = 0
+        self._pool_lock = DeferredLock()
+        self._declared_exchanges = set()
+        self._declaring_exchanges = {}
+        self._publisher_channels = {}
+        self._consumer_channels = {}
+        self._publishers = []
+
+    def connectionLost(self, reason):
+        for binding_cache in self.binding_caches.values():
+            binding_cache.stop()
+        self.binding_caches.clear()
+        AMQClient.connectionLost(self, reason)
+
+    def get_binding_cache(self, exchange_name):
+        """
+        Return the :class:`BindingCache` for `exchange_name`, creating
+        and starting it if necessary. All publishers on the same exchange
+        share a cache.
+        """
+        if exchange_name not in self.binding_caches:
+            binding_cache = BindingCache(self.vumi_options, exchange_name)
+            binding_cache.start()
+            self.binding_caches[exchange_name] = binding_cache
+        return self.binding_caches[exchange_name]
+
     @inlineCallbacks
     def connectionMade(self):
         AMQClient.connectionMade(self)
@@ -99,26 +324,130 @@ class WorkerAMQClient(AMQClient):
     def get_new_channel_id(self):
         """
         AMQClient keeps track of channels in a dictionary. The
-        channel ids are the keys, get the highest number and up it
-        or just return zero for the first channel
+        channel ids are the keys. Hand out ids from a counter, skipping
+        any that are already in use.
         """
-        return (max(self.channels) + 1) if self.channels else 0
+        channel_id = self._next_channel_id
+        while channel_id in self.channels:
+            channel_id += 1
+        self._next_channel_id = channel_id + 1
+        return channel_id
 
     def _declare_exchange(self, source, channel):
-        # get the details for AMQP
+        """
+        Declare the exchange for `source` on `channel`, unless it has
+        already been declared on this connection.
+
+        Callers that ask for an exchange while it is still being declared
+        wait for that declaration to finish, so nothing publishes to or
+        binds to an exchange that may not exist yet. An exchange is only
+        remembered once it has been declared, so a failed declaration is
+        tried again by the next caller.
+        """
         exchange_name = source.exchange_name
-        exchange_type = source.exchange_type
-        durable = source.durable
-        return channel.exchange_declare(exchange=exchange_name,
-                                        type=exchange_type, durable=durable)
+        if exchange_name in self._declared_exchanges:
+            return succeed(None)
+        d = Deferred()
+        waiting = self._declaring_exchanges.get(exchange_name)
+        if waiting is not None:
+            waiting.append(d)
+            return d
+        self._declaring_exchanges[exchange_name] = [d]
+        declared = maybeDeferred(channel.exchange_declare,
+                                 exchange=exchange_name,
+                                 type=source.exchange_type,
+                                 durable=source.durable)
+        declared.addBoth(self._exchange_declared, exchange_name)
+        return d
+
+    def _exchange_declared(self, result, exchange_name):
+        waiting = self._declaring_exchanges.pop(exchange_name)
+        if not isinstance(result, Failure):
+            self._declared_exchanges.add(exchange_name)
+            result = None
+        for d in waiting:
+            d.callback(result)
+
+    def get_publisher_channel(self, exchange_name):
+        """
+        Return a Deferred that fires with the channel shared by all
+        publishers on `exchange_name`.
+        """
+        return self._pool_lock.run(self._get_publisher_channel, exchange_name)
+
+    @inlineCallbacks
+    def _get_publisher_channel(self, exchange_name):
+        channel = self._publisher_channels.get(exchange_name)
+        if channel is None or channel.closed:
+            channel = yield self.get_channel()
+            self._publisher_channels[exchange_name] = channel
+        returnValue(channel)
+
+    def get_consumer_channel(self, channel_group, consumer):
+        """
+        Return a Deferred that fires with a :class:`SharedChannel` for a
+        consumer in `channel_group`.
+        """
+        return self._pool_lock.run(
+            self._get_consumer_channel, channel_group, consumer)
+
+    @inlineCallbacks
+    def _get_consumer_channel(self, channel_group, consumer):
+        shared = self._consumer_channels.get(channel_group)
+        if (shared is None
+                or len(shared.consumers) >= self.consumers_per_channel):
+            channel = yield self.get_channel()
+            shared = SharedChannel(channel)
+            self._consumer_channels[channel_group] = shared
+        shared.consumers.add(consumer)
+        returnValue(shared)
+
+    @inlineCallbacks
+    def release_consumer_channel(self, channel_group, shared, consumer):
+        """
+        Remove `consumer` from a shared channel, closing the channel if
+        it was the last consumer on it.
+        """
+        shared.consumers.discard(consumer)
+        if shared.consumers:
+            return
+        if self._consumer_channels.get(channel_group) is shared:
+            del self._consumer_channels[channel_group]
+        yield shared.channel.channel_close()
+        shared.channel.close(None)
+
+    def _can_share_channel(self, consumer):
+        # QoS applies to the whole channel, so consumers that use it
+        # need a channel of their own. Consumers that start paused are
+        # kept off shared channels so they can be paused with flow
+        # control before they are registered.
+        return (consumer.channel_group is not None
+                and not consumer.start_paused
+                and not consumer.get_prefetch_count())
 
     @inlineCallbacks
     def start_consumer(self, consumer_class, *args, **kwargs):
-        channel = yield self.get_channel()
         consumer = consumer_class(*args, **kwargs)
+        consumer.vumi_options = self.vumi_options
+        acker = None
+        if self._can_share_channel(consumer):
+            shared = yield self.get_consumer_channel(
+                consumer.channel_group, consumer)
+            channel = shared.channel
+            acker = AckCoalescer(channel, consumer.get_ack_batch_size(),
+                                 consumer.ack_batch_delay, multiple=False)
+            consumer.release_channel = lambda: self.release_consumer_channel(
+                consumer.channel_group, shared, consumer)
+        else:
+            channel = yield self.get_channel()
         if consumer.start_paused:
             channel.channel_flow(active=False)
-        consumer.vumi_options = self.vumi_options
+
+        # limit the number of unacknowledged messages the broker will
+        # push to us, so concurrent consumers don't buffer a whole queue
+        prefetch_count = consumer.get_prefetch_count()
+        if prefetch_count:
+            yield channel.basic_qos(0, prefetch_count, False)
 
         # get the details for AMQP
         exchange_name = consumer.exchange_name
@@ -130,33 +459,49 @@ class WorkerAMQClient(AMQClient):
         yield self._declare_exchange(consumer, channel)
 
         # declare the queue
-        yield channel.queue_declare(queue=queue_name, durable=durable)
+        yield channel.queue_declare(queue=queue_name, durable=durable,
+                                    auto_delete=consumer.auto_delete)
         # bind it to the exchange with the routing key
         yield channel.queue_bind(queue=queue_name, exchange=exchange_name,
                                  routing_key=routing_key)
         # register the consumer
         reply = yield channel.basic_consume(queue=queue_name)
+        consumer.consumer_tag = reply.consumer_tag
         queue = yield self.queue(reply.consumer_tag)
         # start consuming! nom nom nom
-        consumer.start(channel, queue)
+        consumer.start(channel, queue, acker)
         # return the newly created & consuming consumer
         returnValue(consumer)
 
     @inlineCallbacks
     def start_publisher(self, publisher_class, *args, **kwargs):
         # much more braindead than start_consumer
-        # get a channel
-        channel = yield self.get_channel()
-        # start the publisher
         publisher = publisher_class(*args, **kwargs)
+        # get the channel shared by publishers on this exchange
+        channel = yield self.get_publisher_channel(publisher.exchange_name)
+        # start the publisher
         publisher.vumi_options = self.vumi_options
+        publisher.binding_cache = self.get_binding_cache(
+            publisher.exchange_name)
         # declare the exchange, doesn't matter if it already exists
         yield self._declare_exchange(publisher, channel)
+        publisher.reopen_channel = lambda: self.get_publisher_channel(
+            publisher.exchange_name)
         # start!
         yield publisher.start(channel)
+        self._publishers.append(publisher)
         # return the publisher
         returnValue(publisher)
 
+    def stop_publishers(self):
+        """
+        Stop every publisher started on this connection, publishing any
+        messages they still have waiting for a batch to fill up.
+        """
+        publishers, self._publishers = self._publishers, []
+        return gatherResults([maybeDeferred(publisher.stop)
+                              for publisher in publishers])
+
 
 class Worker(MultiService, object):
     """
@@ -164,6 +509,11 @@ class Worker(MultiService, object):
     as needed.
     """
 
+    # A LocalMessageBus shared with co-located workers, see MultiWorker.
+    local_bus = None
+    # A StartupTimer to report startup times to, see WorkerCreator.
+    startup_timer = None
+
     def __init__(self, options, config=None):
         super(Worker, self).__init__()
         self.options = options
@@ -174,7 +524,19 @@ class Worker(MultiService, object):
 
     def _amqp_connected(self, amqp_client):
         self._amqp_client = amqp_client
-        return self.startWorker()
+        timer, self.startup_timer = self.startup_timer, None
+        if timer is None:
+            return self.startWorker()
+        # Only report on the first connection.
+        timer.stop('amqp connect')
+        timer.start('startWorker')
+        d = maybeDeferred(self.startWorker)
+
+        def _report(result):
+            timer.stop('startWorker')
+            log.msg(timer.report())
+            return result
+        return d.addCallback(_report)
 
     def _amqp_connection_failed(self):
         pass
@@ -195,6 +557,8 @@ class Worker(MultiService, object):
     def stopService(self):
         if self.running:
             yield self.stopWorker()
+            if self._amqp_client is not None:
+                yield self._amqp_client.stop_publishers()
         yield super(Worker, self).stopService()
 
     def routing_key_to_class_name(self, routing_key):
@@ -202,7 +566,43 @@ class Worker(MultiService, object):
 
     def consume(self, routing_key, callback, queue_name=None,
                 exchange_name='vumi', exchange_type='direct', durable=True,
-                message_class=None, paused=False):
+                message_class=None, paused=False, concurrency=1,
+                prefetch_count=None, ack_batch_size=1, ack_batch_delay=None,
+                channel_group=None, lazy_decoding=False, auto_delete=False):
+        """
+        Start a consumer that calls `callback` for each message received.
+
+        :param int concurrency:
+            Maximum number of messages the callback may be processing at
+            once. The default of 1 processes messages one at a time, in the
+            order they are received.
+        :param int prefetch_count:
+            Maximum number of unacknowledged messages the broker will
+            deliver to this consumer. Defaults to `concurrency` when
+            consuming concurrently and to no limit otherwise.
+        :param int ack_batch_size:
+            Number of acks to coalesce into a single ``basic_ack``
+            frame where possible. Default is 1 (ack every message).
+        :param float ack_batch_delay:
+            Maximum time in seconds to hold on to an ack while waiting
+            for a batch to fill up.
+        :param str channel_group:
+            Consumers in the same channel group share AMQP channels.
+            Consumers that start paused or set a prefetch count always
+            get a channel of their own. Consumers on a shared channel
+            are paused by cancelling their subscription rather than with
+            channel flow control, and ack each message individually.
+            Default is None (own channel).
+        :param bool lazy_decoding:
+            Only decode messages when their fields are first read, and
+            publish unmodified messages with the body they arrived with.
+            Messages in batch envelopes are always decoded straight away.
+            See :class:`vumi.message.LazyMessage`. Default is False.
+        :param bool auto_delete:
+            Have the broker delete the queue when its last consumer goes
+            away. Messages published to it after that are dropped.
+            Default is False.
+        """
 
         # use the routing key to generate the name for the class
         # amq.routing.key -> AmqRoutingKey
@@ -214,7 +614,14 @@ class Worker(MultiService, object):
             'exchange_name': exchange_name,
             'exchange_type': exchange_type,
             'durable': durable,
+            'auto_delete': auto_delete,
             'start_paused': paused,
+            'concurrency': concurrency,
+            'prefetch_count': prefetch_count,
+            'ack_batch_size': ack_batch_size,
+            'ack_batch_delay': ack_batch_delay,
+            'channel_group': channel_group,
+            'lazy_decoding': lazy_decoding,
         }
         log.msg('Starting %s with %s' % (class_name, kwargs))
         klass = type(class_name, (DynamicConsumer,), kwargs)
@@ -223,11 +630,43 @@ class Worker(MultiService, object):
         return self.start_consumer(klass, callback)
 
     def start_consumer(self, consumer_class, *args, **kw):
-        return self._amqp_client.start_consumer(consumer_class, *args, **kw)
+        d = self._amqp_client.start_consumer(consumer_class, *args, **kw)
+        if self.local_bus is not None:
+            d.addCallback(self._bind_local_consumer)
+        return d
+
+    def _bind_local_consumer(self, consumer):
+        consumer.local_bus = self.local_bus
+        self.local_bus.add_consumer(consumer)
+        return consumer
 
     def publish_to(self, routing_key,
                    exchange_name='vumi', exchange_type='direct', durable=True,
                    delivery_mode=2):
+        """
+        Start a publisher for `routing_key`.
+
+        Messages are encoded with the codec named by the ``message_codec``
+        worker config option, JSON by default. Consumers decode messages
+        using the content type they were published with, so workers can
+        switch codecs one at a time.
+
+        Messages are sent with their routing fields in the AMQP headers
+        unless the ``routing_headers`` worker config option is false.
+
+        If the ``publish_batch_size`` worker config option is more than
+        1, messages are sent in batches of up to that many, waiting at
+        most ``publish_batch_delay`` seconds (default 0.1) for a batch to
+        fill up. See :meth:`Publisher.publish_batch`.
+
+        If the ``publish_partitions`` worker config option maps
+        `routing_key` to a number of partitions N, messages are spread
+        over the routing keys ``<routing_key>.0`` to ``<routing_key>.<N -
+        1>`` by a hash of one of their fields. The field is given by the
+        ``partition_fields`` worker config option, which also maps
+        routing keys, and defaults to the one for the last part of
+        `routing_key` in :data:`DEFAULT_PARTITION_FIELDS`.
+        """
         class_name = self.routing_key_to_class_name(routing_key)
         publisher_class = type("%sDynamicPublisher" % class_name, (Publisher,),
             {
@@ -237,10 +676,41 @@ class Worker(MultiService, object):
                 "durable": durable,
                 "delivery_mode": delivery_mode,
             })
+        codec_name = self.config.get('message_codec')
+        if codec_name is not None:
+            publisher_class.codec = get_codec(codec_name)
+        publisher_class.routing_headers = self.config.get(
+            'routing_headers', True)
+        publisher_class.batch_size = int(
+            self.config.get('publish_batch_size', 1))
+        publisher_class.batch_delay = self.config.get(
+            'publish_batch_delay', Publisher.batch_delay)
+        partitions = self.config.get('publish_partitions', {}).get(
+            routing_key)
+        if partitions is not None:
+            publisher_class.partitions = int(partitions)
+            publisher_class.partition_field = self.get_partition_field(
+                routing_key)
         return self.start_publisher(publisher_class)
 
+    def get_partition_field(self, routing_key):
+        field = self.config.get('partition_fields', {}).get(routing_key)
+        if field is None:
+            field = DEFAULT_PARTITION_FIELDS.get(routing_key.split('.')[-1])
+        if field is None:
+            raise ConfigError("No partition field for routing key %r in"
+                              " 'partition_fields'." % (routing_key,))
+        return field
+
     def start_publisher(self, publisher_class, *args, **kw):
-        return self._amqp_client.start_publisher(publisher_class, *args, **kw)
+        d = self._amqp_client.start_publisher(publisher_class, *args, **kw)
+        if self.local_bus is not None:
+            d.addCallback(self._bind_local_publisher)
+        return d
+
+    def _bind_local_publisher(self, publisher):
+        publisher.local_bus = self.local_bus
+        return publisher
 
     def start_web_resources(self, resources, port, site_class=None):
         # start the HTTP server for receiving the receipts
@@ -273,11 +743,138 @@ class QueueCloseMarker(object):
     "This is a marker for closing consumer queues."
 
 
+class AckCoalescer(object):
+    """
+    Coalesce the acks for messages delivered on a channel.
+
+    Messages must be registered with :meth:`delivered` in the order the
+    broker delivered them. Once they have been processed, they are
+    either acked with :meth:`ack`, rejected with :meth:`reject` or left
+    unacknowledged with :meth:`skip`. Acks are sent when `batch_size`
+    messages are waiting to be acked or `batch_delay` seconds after the
+    first of them was processed, whichever comes first.
+
+    When flushing, a contiguous run of processed messages at the front
+    of the delivery order is acked with a single ``basic_ack`` with
+    ``multiple=True``. Processed messages that are stuck behind a
+    message still being processed are acked individually. This stops
+    them from holding up prefetch slots. After a message has been
+    skipped, ``multiple=True`` would also ack the skipped message, so
+    all later acks on the channel are sent individually. Rejections are
+    sent straight away, so they don't get in the way of later multiple
+    acks.
+
+    The delivery order can only be known for messages delivered to a
+    single consumer. A coalescer for one of several consumers on a
+    channel must be created with `multiple` set to False, so that it
+    never sends multiple acks.
+
+    :param channel:
+        The channel the messages were delivered on.
+    :param int batch_size:
+        Number of processed messages that triggers a flush. The default
+        of 1 acks every message as soon as it has been processed.
+    :param float batch_delay:
+        Maximum time in seconds a processed message waits to be acked.
+        Default is None (only flush on `batch_size`).
+    :param bool multiple:
+        Whether runs of processed messages may be acked with a single
+        multiple ack. Default is True.
+    """
+
+    PENDING, DONE, SKIPPED, REJECTED = range(4)
+
+    clock = reactor
+
+    def __init__(self, channel, batch_size=1, batch_delay=None,
+                 multiple=True):
+        self.channel = channel
+        self.batch_size = max(1, int(batch_size))
+        self.batch_delay = batch_delay
+        self._outstanding = deque()
+        self._entries = {}
+        self._done_count = 0
+        self._multiple_safe = multiple
+        self._flush_call = None
+
+    def delivered(self, delivery_tag):
+        entry = [delivery_tag, self.PENDING]
+        self._outstanding.append(entry)
+        self._entries[delivery_tag] = entry
+
+    def ack(self, delivery_tag):
+        entry = self._entries.pop(delivery_tag, None)
+        if entry is None:
+            # We weren't told about this delivery, so just ack it.
+            self.channel.basic_ack(delivery_tag, False)
+            return
+        entry[1] = self.DONE
+        self._done_count += 1
+        if self._done_count >= self.batch_size:
+            self.flush()
+        elif self._flush_call is None and self.batch_delay is not None:
+            self._flush_call = self.clock.callLater(
+                self.batch_delay, self.flush)
+
+    def skip(self, delivery_tag):
+        entry = self._entries.pop(delivery_tag, None)
+        if entry is not None:
+            entry[1] = self.SKIPPED
+            if self._outstanding[0] is entry:
+                self.flush()
+
+    def reject(self, delivery_tag, requeue):
+        self.channel.basic_reject(delivery_tag, requeue)
+        entry = self._entries.pop(delivery_tag, None)
+        if entry is not None:
+            entry[1] = self.REJECTED
+            if self._outstanding[0] is entry:
+                self.flush()
+
+    def flush(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+
+        individual = []
+        last_tag = None
+        while self._outstanding and self._outstanding[0][1] != self.PENDING:
+            delivery_tag, state = self._outstanding.popleft()
+            if state == self.REJECTED:
+                continue
+            if state == self.SKIPPED:
+                if last_tag is not None:
+                    self.channel.basic_ack(last_tag, True)
+                    last_tag = None
+                self._multiple_safe = False
+            elif self._multiple_safe:
+                last_tag = delivery_tag
+            else:
+                individual.append(delivery_tag)
+        if last_tag is not None:
+            self.channel.basic_ack(last_tag, True)
+
+        if self._done_count:
+            remaining = deque()
+            for entry in self._outstanding:
+                if entry[1] == self.DONE:
+                    individual.append(entry[0])
+                elif entry[1] != self.REJECTED:
+                    remaining.append(entry)
+            self._outstanding = remaining
+        for delivery_tag in individual:
+            self.channel.basic_ack(delivery_tag, False)
+        self._done_count = 0
+
+
 class Consumer(object):
 
     exchange_name = "vumi"
     exchange_type = "direct"
     durable = False
+    # delete the queue once its last consumer has gone
+    auto_delete = False
 
     queue_name = "queue"
     routing_key = "routing_key"
@@ -285,23 +882,62 @@ class Consumer(object):
     message_class = Message
     start_paused = False
 
+    # maximum number of messages being consumed at the same time
+    concurrency = 1
+    # maximum number of unacked messages, see get_prefetch_count()
+    prefetch_count = None
+    # ack coalescing, see AckCoalescer
+    ack_batch_size = 1
+    ack_batch_delay = None
+    # consumers in the same channel group may share a channel
+    channel_group = None
+    # set by WorkerAMQClient when the channel is shared
+    release_channel = None
+    # set by Worker when co-located workers share a LocalMessageBus
+    local_bus = None
+    # decode messages on first use, see vumi.message.LazyMessage
+    lazy_decoding = False
+
+    def get_prefetch_count(self):
+        """
+        Return the `basic_qos` prefetch count for this consumer.
+
+        An explicit :attr:`prefetch_count` always wins. Concurrent
+        consumers default to prefetching as many messages as they can
+        process at once. Serial consumers default to no limit.
+        """
+        if self.prefetch_count is not None:
+            return int(self.prefetch_count)
+        if self.concurrency > 1:
+            return int(self.concurrency)
+        return None
+
     @inlineCallbacks
-    def start(self, channel, queue):
+    def start(self, channel, queue, acker=None):
         self.channel = channel
         self.queue = queue
         self.keep_consuming = True
+        self.paused = self.start_paused
         self._testing = hasattr(channel, 'message_processed')
+        self._semaphore = DeferredSemaphore(max(1, int(self.concurrency)))
+        if acker is None:
+            acker = AckCoalescer(channel, self.get_ack_batch_size(),
+                                 self.ack_batch_delay)
+        self._acker = acker
 
         @inlineCallbacks
         def read_messages():
             log.msg("Consumer starting...")
             try:
                 while self.keep_consuming:
+                    yield self._semaphore.acquire()
                     message = yield self.queue.get()
                     if isinstance(message, QueueCloseMarker):
                         log.msg("Queue closed.")
                         return
-                    yield self.consume(message)
+                    if not isinstance(message, LocalDelivery):
+                        self._acker.delivered(message.delivery_tag)
+                    self._consume_in_flight(message)
             except txamqp.queue.Closed, e:
                 log.err("Queue has closed", e)
 
@@ -309,39 +945,243 @@ class Consumer(object):
         yield None
         returnValue(self)
 
+    def get_ack_batch_size(self):
+        """
+        Return the number of acks to coalesce. This is never more than
+        the prefetch count, because the broker won't deliver any more
+        messages while the prefetch limit is reached.
+        """
+        prefetch_count = self.get_prefetch_count()
+        if prefetch_count:
+            return min(self.ack_batch_size, prefetch_count)
+        return self.ack_batch_size
+
+    def _consume_in_flight(self, message):
+        d = self.consume(message)
+
+        def _done(result):
+            self._semaphore.release()
+            if self._testing and not isinstance(message, LocalDelivery):
+                self.channel.message_processed()
+            return result
+
+        def _failed(failure):
+            if not isinstance(message, LocalDelivery):
+                self.reject(message, self.should_requeue(message, failure))
+            return failure
+
+        d.addErrback(_failed)
+        d.addBoth(_done)
+        d.addErrback(log.err)
+        return d
+
     def pause(self):
+        if self.release_channel is not None:
+            # Flow control would pause every consumer on the channel, so
+            # stop the broker delivering to this one instead. Messages
+            # that have already been delivered are still processed.
+            if self.paused:
+                return succeed(None)
+            self.paused = True
+            return self.channel.basic_cancel(self.consumer_tag)
+        self.paused = True
         return self.channel.channel_flow(active=False)
 
     def unpause(self):
+        if self.release_channel is not None:
+            if not self.paused:
+                return succeed(None)
+            self.paused = False
+            # Reusing the consumer tag delivers to the same local queue.
+            return self.channel.basic_consume(
+                queue=self.queue_name, consumer_tag=self.consumer_tag)
+        self.paused = False
         return self.channel.channel_flow(active=True)
 
+    def deliver_local(self, delivery):
+        """Queue a :class:`LocalDelivery` from the local message bus."""
+        self.queue.put(delivery)
+
+    def _local_message(self, delivery):
+        message = delivery.message
+        if not isinstance(message, self.message_class):
+            message = self.message_class(
+                _process_fields=False, **to_kwargs(message.payload))
+        return message
+
+    @inlineCallbacks
+    def consume_local(self, delivery):
+        """
+        Consume a :class:`LocalDelivery`.
+
+        There is nothing to ack. If the message fails, or
+        :meth:`consume_message` returns False, it is published over AMQP
+        straight to this consumer's queue so that it is retried there
+        rather than lost. The message is published as it was received,
+        whatever the handler did to it.
+        """
+        try:
+            result = yield self.consume_message(self._local_message(delivery))
+        except Exception:
+            log.err(None, "Error consuming local message, publishing it"
+                    " to %s over AMQP." % (self.queue_name,))
+            result = False
+        if result is False:
+            yield self.publish_to_queue(delivery.original)
+
+    def publish_to_queue(self, message):
+        """
+        Publish `message` to this consumer's queue only, through the
+        default exchange.
+        """
+        content = Content(message.to_json())
+        content['delivery mode'] = 2
+        headers = message.routing_headers()
+        if headers:
+            content['headers'] = headers
+        return self.channel.basic_publish(exchange='',
+                                          routing_key=self.queue_name,
+                                          content=content)
+
     @inlineCallbacks
     def consume(self, message):
-        result = yield self.consume_message(self.message_class.from_json(
-                                            message.content.body))
-        if self._testing:
-            self.channel.message_processed()
+        if isinstance(message, LocalDelivery):
+            yield self.consume_local(message)
+            return
+        if self.get_batch_size(message.content):
+            yield self.consume_batch(message)
+            return
+        result = yield self.consume_message(
+            self.decode_message(message.content))
         if result is not False:
             returnValue(self.ack(message))
         else:
+            self._acker.skip(message.delivery_tag)
             log.msg('Received %s as a return value consume_message. '
                     'Not acknowledging AMQ message' % result)
 
+    def decode_message(self, content):
+        """
+        Decode an AMQP message body with the codec named by its content
+        type. Messages without a content type are JSON.
+        """
+        properties = getattr(content, 'properties', None) or {}
+        codec = get_codec_for_content_type(properties.get('content type'))
+        if self.lazy_decoding:
+            return lazy_message_class(self.message_class).from_raw(
+                content.body, codec, properties.get('headers'))
+        return self.message_class.decode(content.body, codec)
+
+    def _get_header(self, content, name):
+        properties = getattr(content, 'properties', None) or {}
+        headers = properties.get('headers') or {}
+        return headers.get(name)
+
+    def get_batch_size(self, content):
+        """
+        Return the number of messages in a batch envelope, or None if
+        `content` holds a single message.
+        """
+        return self._get_header(content, BATCH_HEADER)
+
+    @inlineCallbacks
+    def consume_batch(self, message):
+        """
+        Consume the messages in a batch envelope one at a time.
+
+        Messages that fail, or for which :meth:`consume_message` returns
+        False, are published again on their own with the
+        :data:`RETRIED_HEADER` header, so that they are consumed again
+        later. If one of those fails again it is rejected for good, like
+        a redelivered message (see :meth:`should_requeue`). The envelope
+        is acked once every message in it has been processed or
+        re-queued.
+
+        The whole envelope has to be parsed to split it up, so
+        `lazy_decoding` doesn't apply to the messages in it.
+        """
+        content = message.content
+        properties = getattr(content, 'properties', None) or {}
+        codec = get_codec_for_content_type(properties.get('content type'))
+        failed = []
+        for member in self.message_class.decode_batch(content.body, codec):
+            try:
+                result = yield self.consume_message(member)
+            except Exception:
+                log.err(None, "Error consuming batched message")
+                result = False
+            if result is False:
+                failed.append(member)
+        for member in failed:
+            yield self.requeue_message(member, codec, properties)
+        self.ack(message)
+
+    def requeue_message(self, message, codec, properties):
+        """
+        Publish `message` from a batch envelope with `properties` on its
+        own, to be consumed again. Like :meth:`publish_to_queue`, it goes
+        through the default exchange to this consumer's queue only, so
+        other queues bound to the routing key don't get a duplicate.
+        """
+        content = Content(message.encode(codec))
+        for key in ('content type', 'delivery mode'):
+            if key in properties:
+                content[key] = properties[key]
+        headers = dict(message.routing_headers())
+        headers[RETRIED_HEADER] = 1
+        content['headers'] = headers
+        return self.channel.basic_publish(exchange='',
+                                          routing_key=self.queue_name,
+                                          content=content)
+
     def consume_message(self, message):
         """helper method, override in implementation"""
         log.msg("Received message: %s" % message)
 
     def ack(self, message):
-        self.channel.basic_ack(message.delivery_tag, True)
+        self._acker.ack(message.delivery_tag)
+
+    def reject(self, message, requeue):
+        self._acker.reject(message.delivery_tag, requeue)
+
+    def should_requeue(self, message, failure):
+        """
+        Return True if `message`, which failed to be consumed with
+        `failure`, should be put back on the queue.
+
+        Messages that fail with a :class:`vumi.errors.TemporaryError` are
+        always requeued. Other messages are requeued once, and rejected
+        for good (and so dropped or dead-lettered by the broker) if they
+        fail again after being redelivered. Messages from a batch
+        envelope that were published again after failing have already
+        had their retry.
+        """
+        if failure.check(TemporaryError):
+            return True
+        if getattr(message, 'redelivered', False):
+            return False
+        content = getattr(message, 'content', None)
+        return not self._get_header(content, RETRIED_HEADER)
 
     @inlineCallbacks
     def stop(self):
         log.msg("Consumer stopping...")
         self.keep_consuming = False
-        # This actually closes the channel on the server
-        yield self.channel.channel_close()
-        # This just marks the channel as closed on the client
-        self.channel.close(None)
+        if self.local_bus is not None:
+            self.local_bus.remove_consumer(self)
+        # Send any acks we're still holding on to.
+        self._acker.flush()
+        if self.release_channel is not None:
+            # Other consumers are using this channel, so just cancel
+            # ourselves and let the pool close it when it's unused.
+            if not self.paused:
+                yield self.channel.basic_cancel(self.consumer_tag)
+            yield self.release_channel()
+        else:
+            # This actually closes the channel on the server
+            yield self.channel.channel_close()
+            # This just marks the channel as closed on the client
+            self.channel.close(None)
         self.queue.put(QueueCloseMarker())
         returnValue(self.keep_consuming)
 
@@ -362,6 +1202,153 @@ class RoutingKeyError(Exception):
         return repr(self.value)
 
 
+class BindingCache(object):
+    """
+    Periodically refreshed set of routing keys bound on an exchange.
+
+    Bindings are fetched from the RabbitMQ management API in the
+    background every `bindings-ttl` seconds, so checking a routing key
+    never waits on HTTP. If the management API isn't configured or
+    can't be reached, all routing keys are considered bound.
+
+    The cache also records where each routing key is bound to, so that
+    a :class:`vumi.local_bus.LocalMessageBus` can tell whether every
+    queue bound to a routing key is consumed in this process.
+
+    A routing key missing from the cache is also considered bound until
+    a refresh started after it was first seen confirms that it isn't.
+    This avoids rejecting messages for queues bound since the last
+    refresh.
+
+    Relevant vumi options:
+
+    :param str management-url:
+        Base URL of the RabbitMQ management API, e.g.
+        ``http://localhost:55672/api/``. If this is not set (the
+        default), bindings are not checked. If it is, publishing to a
+        routing key confirmed to have nothing bound to it raises
+        :class:`RoutingKeyError`.
+    :param float bindings-ttl:
+        Seconds between binding refreshes. Default is 30.
+    """
+
+    DEFAULT_TTL = 30
+
+    clock = reactor
+
+    def __init__(self, vumi_options, exchange_name):
+        self.vumi_options = vumi_options
+        self.exchange_name = exchange_name
+        self.management_url = vumi_options.get('management-url')
+        self.ttl = float(vumi_options.get('bindings-ttl') or self.DEFAULT_TTL)
+        # None means the bindings are unknown or undetectable.
+        self.bound_routing_keys = None
+        # routing key -> set of (destination_type, destination)
+        self.bindings = None
+        self.last_refreshed = None
+        self._unconfirmed_keys = {}
+        self._unbound_keys = set()
+        self._refreshing = None
+        self._refresh_loop = None
+
+    def start(self):
+        if not self.management_url:
+            return
+        self._refresh_loop = task.LoopingCall(self.refresh)
+        self._refresh_loop.clock = self.clock
+        self._refresh_loop.start(self.ttl, now=True)
+
+    def stop(self):
+        if self._refresh_loop is not None and self._refresh_loop.running:
+            self._refresh_loop.stop()
+        self._refresh_loop = None
+
+    def bindings_url(self):
+        return "%s/exchanges/%s/%s/bindings/source" % (
+            self.management_url.rstrip('/'),
+            quote(self.vumi_options['vhost'], safe=''),
+            quote(self.exchange_name, safe=''))
+
+    @inlineCallbacks
+    def fetch_bindings(self):
+        """
+        Fetch the bindings on our exchange from the management API.
+        Returns a dict mapping each bound routing key to a set of
+        ``(destination_type, destination)`` pairs, or None if the
+        bindings could not be fetched.
+        """
+        try:
+            resp = yield http_request_full(self.bindings_url(), headers={
+                    'Authorization': basic_auth_string(
+                        self.vumi_options['username'],
+                        self.vumi_options['password']),
+                    }, method='GET')
+            if resp.code != 200:
+                raise VumiError("Unexpected response code %s fetching"
+                                " bindings." % (resp.code,))
+            bindings = {}
+            for binding in json.loads(resp.delivered_body):
+                bindings.setdefault(binding['routing_key'], set()).add(
+                    (binding['destination_type'], binding['destination']))
+        except Exception, e:
+            log.msg("Failed to fetch bindings for exchange %r: %r" % (
+                    self.exchange_name, e))
+            bindings = None
+        returnValue(bindings)
+
+    def refresh(self):
+        """
+        Refresh the bindings in the background. Only one refresh runs at
+        a time; calling this during a refresh returns the same Deferred.
+        """
+        if self._refreshing is None:
+            started = self.clock.seconds()
+            self._refreshing = self.fetch_bindings()
+            self._refreshing.addCallback(self._refreshed, started)
+        return self._refreshing
+
+    def _refreshed(self, bindings, started):
+        self._refreshing = None
+        self.bindings = bindings
+        bound_routing_keys = None
+        if bindings is not None:
+            bound_routing_keys = set(bindings)
+        self.bound_routing_keys = bound_routing_keys
+        self.last_refreshed = started
+        for key, first_seen in self._unconfirmed_keys.items():
+            if first_seen <= started:
+                del self._unconfirmed_keys[key]
+                if bound_routing_keys is not None:
+                    if key not in bound_routing_keys:
+                        self._unbound_keys.add(key)
+        if self._unconfirmed_keys:
+            # Some keys were first seen after this refresh started.
+            self.refresh()
+
+    def is_bound(self, key):
+        """
+        Check whether `key` is bound on our exchange. This never waits
+        for a refresh.
+        """
+        if self.bound_routing_keys is None or key in self.bound_routing_keys:
+            return True
+        if key in self._unbound_keys:
+            return False
+        if key not in self._unconfirmed_keys:
+            self._unconfirmed_keys[key] = self.clock.seconds()
+            self.refresh()
+        return True
+
+    def destinations(self, key):
+        """
+        Return the ``(destination_type, destination)`` pairs `key` was
+        bound to at the last refresh, or None if that isn't known.
+        """
+        if self.bindings is None:
+            return None
+        return self.bindings.get(key)
+
+
 class Publisher(object):
     exchange_name = "vumi"
     exchange_type = "direct"
@@ -370,41 +1357,40 @@ class Publisher(object):
     durable = False
     auto_delete = False
     delivery_mode = 2  # save to disk
+    # set by Worker when co-located workers share a LocalMessageBus
+    local_bus = None
+    # set by WorkerAMQClient, returns a Deferred for an open channel
+    reopen_channel = None
+    # the MessageCodec for publish_message(), untagged JSON if None
+    codec = None
+    # send Message.routing_headers() with each message
+    routing_headers = True
+    # maximum number of messages publish_message() sends in one batch
+    batch_size = 1
+    # maximum time in seconds a message waits for its batch to fill up
+    batch_delay = 0.1
+    # number of partitions publish_message() spreads messages over, or
+    # None to publish them all with routing_key
+    partitions = None
+    # the message field whose hash picks a message's partition
+    partition_field = None
+
+    clock = reactor
 
     def start(self, channel):
         log.msg("Started the publisher")
         self.channel = channel
-        self.bound_routing_keys = {}
+        # routing key (or None for the default) -> [(message, d), ...]
+        self._batches = {}
+        self._batch_call = None
 
         # There's probably a better way to do this.
         if not hasattr(self, 'vumi_options'):
             self.vumi_options = {}
+        if not hasattr(self, 'binding_cache'):
+            self.binding_cache = BindingCache(
+                self.vumi_options, self.exchange_name)
 
-    @inlineCallbacks
-    def list_bindings(self):
-        try:
-            # Note utils.callback() does a POST not a GET
-            # which may lead to errors if the RabbitMQ Management REST api
-            # changes
-            resp = yield http_request(
-                "http://localhost:55672/api/bindings", headers={
-                    'Authorization': basic_auth_string(
-                        self.vumi_options['username'],
-                        self.vumi_options['password']),
-                    })
-            bindings = json.loads(resp)
-            bound_routing_keys = {}
-            for b in bindings:
-                if (b['vhost'] == self.vumi_options['vhost'] and
-                    b['source'] == self.exchange_name):
-                    bound_routing_keys[b['routing_key']] = \
-                            bound_routing_keys.get(b['routing_key'], []) + \
-                            [b['destination']]
-        except:
-            bound_routing_keys = {"bindings": "undetected"}
-        returnValue(bound_routing_keys)
-
-    @inlineCallbacks
     def routing_key_is_bound(self, key):
         # Don't check for bound routing keys on RPC reply exchanges
         # The one-use queues are changing too frequently to cache efficiently,
@@ -412,36 +1398,19 @@ class Publisher(object):
         # and the auto-generated queues & routing_keys are unlikley to
         # result in errors where routing keys are unbound
         if self.exchange_name[-4:].lower() == '_rpc':
-            returnValue(True)
-        if (len(self.bound_routing_keys) == 1 and
-            self.bound_routing_keys.get("bindings") == "undetected"):
-            # The following is very noisy in the logs:
-            # log.msg("No bindings detected, is the RabbitMQ Management plugin"
-            #         " installed?")
-            returnValue(True)
-        if key in self.bound_routing_keys.keys():
-            returnValue(True)
-        self.bound_routing_keys = yield self.list_bindings()
-        if (len(self.bound_routing_keys) == 1 and
-            self.bound_routing_keys.get("bindings") == "undetected"):
-            # The following is very noisy in the logs:
-            # log.msg("No bindings detected, is the RabbitMQ Management plugin"
-            #         " installed?")
-            returnValue(True)
-        returnValue(key in self.bound_routing_keys.keys())
+            return True
+        return self.binding_cache.is_bound(key)
 
-    @inlineCallbacks
     def check_routing_key(self, routing_key, require_bind):
         if(routing_key != routing_key.lower()):
             raise RoutingKeyError("The routing_key: %s is not all lower case!"
                                   % (routing_key))
         if not require_bind:
             return
-        is_bound = yield self.routing_key_is_bound(routing_key)
-        if not is_bound:
+        if not self.routing_key_is_bound(routing_key):
             raise RoutingKeyError("The routing_key: %s is not bound to any"
                                   " queues in vhost: %s  exchange: %s" % (
-                                  routing_key, self.vumi_options['vhost'],
+                                  routing_key, self.vumi_options.get('vhost'),
                                   self.exchange_name))
 
     @inlineCallbacks
@@ -450,15 +1419,146 @@ class Publisher(object):
         routing_key = kwargs.get('routing_key') or self.routing_key
         require_bind = kwargs.get('require_bind', self.require_bind)
         yield self.check_routing_key(routing_key, require_bind)
+        if (getattr(self.channel, 'closed', False)
+                and self.reopen_channel is not None):
+            # A channel error closed the channel shared by this
+            # exchange's publishers.
+            self.channel = yield self.reopen_channel()
         yield self.channel.basic_publish(exchange=exchange_name,
                                          content=message,
                                          routing_key=routing_key)
 
+    def partition_routing_key(self, message):
+        """Return the routing key of the partition `message` belongs in."""
+        partition = get_partition(
+            message.get(self.partition_field), self.partitions)
+        return '%s.%d' % (self.routing_key, partition)
+
     def publish_message(self, message, **kwargs):
-        d = self.publish_raw(message.to_json(), **kwargs)
+        if self.partitions is not None and not kwargs.get('routing_key'):
+            kwargs['routing_key'] = self.partition_routing_key(message)
+        if self.local_bus is not None and self.exchange_type == 'direct':
+            exchange_name = kwargs.get('exchange_name') or self.exchange_name
+            routing_key = kwargs.get('routing_key') or self.routing_key
+            try:
+                self.check_routing_key(routing_key, kwargs.get(
+                    'require_bind', self.require_bind))
+            except RoutingKeyError:
+                return fail()
+            destinations = None
+            if exchange_name == self.exchange_name:
+                destinations = self.binding_cache.destinations(routing_key)
+            if self.local_bus.publish(exchange_name, routing_key, message,
+                                      destinations):
+                return succeed(message)
+        if self.batch_size > 1:
+            if set(kwargs) <= set(['routing_key']):
+                return self._add_to_batch(message, kwargs.get('routing_key'))
+            # Don't let this message overtake the ones already batched.
+            self.flush_batch()
+        return self._publish_single(message, **kwargs)
+
+    def _publish_single(self, message, **kwargs):
+        if self.routing_headers:
+            kwargs.setdefault('headers', message.routing_headers())
+        if self.codec is None:
+            # Untagged messages are JSON, which every worker understands.
+            d = self.publish_raw(message.to_json(), **kwargs)
+        else:
+            d = self.publish_raw(message.encode(self.codec),
+                                 content_type=self.codec.content_type,
+                                 **kwargs)
         d.addCallback(lambda r: message)
         return d
 
+    def _add_to_batch(self, message, routing_key=None):
+        d = Deferred()
+        batch = self._batches.setdefault(routing_key, [])
+        batch.append((message, d))
+        if len(batch) >= self.batch_size:
+            self._publish_batch_members(routing_key,
+                                        self._batches.pop(routing_key))
+            if not self._batches and self._batch_call is not None:
+                self._batch_call.cancel()
+                self._batch_call = None
+        elif self._batch_call is None and self.batch_delay is not None:
+            self._batch_call = self.clock.callLater(
+                self.batch_delay, self.flush_batch)
+        return d
+
+    def stop(self):
+        """
+        Publish the messages still waiting for their batch to fill up,
+        so that they aren't lost when the worker shuts down, and cancel
+        the delayed flush.
+        """
+        log.msg("Publisher stopping...")
+        if not hasattr(self, '_batches'):
+            # It was never started, so nothing can be waiting.
+            return succeed([])
+        return self.flush_batch()
+
+    def flush_batch(self):
+        """
+        Publish the messages waiting for their batch to fill up. The
+        Deferreds returned by :meth:`publish_message` for them fire once
+        the batch has been published.
+        """
+        if self._batch_call is not None:
+            if self._batch_call.active():
+                self._batch_call.cancel()
+            self._batch_call = None
+        batches, self._batches = self._batches, {}
+        if not batches:
+            return succeed([])
+        if len(batches) == 1:
+            [(routing_key, batch)] = batches.items()
+            return self._publish_batch_members(routing_key, batch)
+        d = gatherResults([self._publish_batch_members(routing_key, batch)
+                           for routing_key, batch in batches.items()])
+        d.addCallback(lambda results: sum(results, []))
+        return d
+
+    def _publish_batch_members(self, routing_key, batch):
+        kwargs = {}
+        if routing_key is not None:
+            kwargs['routing_key'] = routing_key
+        messages = [message for message, _d in batch]
+        if len(messages) == 1:
+            d = self._publish_single(messages[0], **kwargs)
+        else:
+            d = self.publish_batch(messages, **kwargs)
+
+        def _published(_result):
+            for message, member_d in batch:
+                member_d.callback(message)
+            return messages
+
+        def _failed(failure):
+            for _message, member_d in batch:
+                member_d.errback(failure)
+
+        d.addCallbacks(_published, _failed)
+        return d
+
+    def publish_batch(self, messages, **kwargs):
+        """
+        Publish `messages` in one AMQP message, a batch envelope.
+
+        The envelope holds the messages encoded with
+        :func:`vumi.message.encode_batch` and has the number of messages
+        in its :data:`BATCH_HEADER` header. Consumers process the
+        messages one by one and ack the envelope once they all have been
+        processed. See :meth:`Consumer.consume_batch`.
+        """
+        headers = {BATCH_HEADER: len(messages)}
+        if self.codec is None:
+            return self.publish_raw(encode_batch(messages), headers=headers,
+                                    **kwargs)
+        return self.publish_raw(encode_batch(messages, self.codec),
+                                content_type=self.codec.content_type,
+                                headers=headers, **kwargs)
+
     def publish_json(self, data, **kw):
         """helper method"""
         return self.publish_raw(json.dumps(data, cls=json.JSONEncoder), **kw)
@@ -467,6 +1567,12 @@ class Publisher(object):
         amq_message = Content(data)
         amq_message['delivery mode'] = kwargs.pop('delivery_mode',
                 self.delivery_mode)
+        content_type = kwargs.pop('content_type', None)
+        if content_type is not None:
+            amq_message['content type'] = content_type
+        headers = kwargs.pop('headers', None)
+        if headers:
+            amq_message['headers'] = headers
         return self.publish(amq_message, **kwargs)
 
 
@@ -475,6 +1581,10 @@ class WorkerCreator(object):
     Creates workers
     """
 
+    # If set, worker startup times are recorded here and logged once
+    # the worker has started.
+    startup_timer = None
+
     def __init__(self, vumi_options):
         self.options = vumi_options
 
@@ -485,13 +1595,18 @@ class WorkerCreator(object):
 
         Return value is the AmqpFactory instance containing the worker.
         """
+        if self.startup_timer is not None:
+            self.startup_timer.start('import')
+        worker_class = load_class_by_string(worker_class)
+        if self.startup_timer is not None:
+            self.startup_timer.stop('import')
         return self.create_worker_by_class(
-            load_class_by_string(worker_class), config, timeout=timeout,
-            bindAddress=bindAddress)
+            worker_class, config, timeout=timeout, bindAddress=bindAddress)
 
     def create_worker_by_class(self, worker_class, config, timeout=30,
                                bindAddress=None):
         worker = worker_class(deepcopy(self.options), config)
+        worker.startup_timer = self.startup_timer
         self._connect(worker, timeout=timeout, bindAddress=bindAddress)
         return worker
 
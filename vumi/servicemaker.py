@@ -9,7 +9,7 @@ from twisted.python import usage
 from twisted.application.service import IServiceMaker
 from twisted.plugin import IPlugin
 
-from vumi.service import WorkerCreator
+from vumi.service import WorkerCreator, StartupTimer
 from vumi.utils import load_class_by_string
 from vumi.errors import VumiError
 from vumi.sentry import SentryLoggerService
@@ -51,6 +51,15 @@ class VumiOptions(usage.Options):
         ["vhost", None, None, "AMQP virtual host (*)"],
         ["specfile", None, None, "AMQP spec file (*)"],
         ["sentry", None, None, "Sentry DSN (*)"],
+        ["management-url", None, None,
+         "RabbitMQ management API URL, e.g. http://localhost:55672/api/."
+         " If set, publishes to routing keys with no queue bound fail"
+         " with RoutingKeyError. Disabled by default (*)"],
+        ["bindings-ttl", None, None,
+         "Seconds between refreshes of routing key bindings (*)", float],
+        ["spec-cache-dir", None, None,
+         "Directory to cache the parsed AMQP spec in. Only used if it"
+         " belongs to the current user and nobody else can write to it (*)"],
         ["vumi-config", None, None,
          "YAML config file for setting core vumi options (any command-line"
          " parameter marked with an asterisk)"],
@@ -64,6 +73,9 @@ class VumiOptions(usage.Options):
         "vhost": "/develop",
         "specfile": "amqp-spec-0-8.xml",
         "sentry": None,
+        "management-url": None,
+        "bindings-ttl": 30,
+        "spec-cache-dir": None,
         }
 
     def get_vumi_options(self):
@@ -176,6 +188,7 @@ class VumiWorkerServiceMaker(object):
         logger_name = options.worker_config.get('worker_name', class_name)
 
         worker_creator = WorkerCreator(options.vumi_options)
+        worker_creator.startup_timer = StartupTimer()
         worker = worker_creator.create_worker(options.worker_class,
                                               options.worker_config)
 
@@ -8,8 +8,8 @@ from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
 from txamqp.client import TwistedDelegate
 from txamqp.content import Content
 
-from vumi.service import WorkerAMQClient
-from vumi.message import Message as VumiMessage
+from vumi.service import WorkerAMQClient, BATCH_HEADER
+from vumi.message import Message as VumiMessage, get_codec_for_content_type
 
 
 def gen_id(prefix=''):
@@ -67,23 +67,24 @@ def mkContent(body, children=None, properties=None):
                  properties=properties)
 
 
-def mk_deliver(body, exchange, routing_key, ctag, dtag):
+def mk_deliver(body, exchange, routing_key, ctag, dtag, properties=None,
+               redelivered=False):
     return Message(mkMethod('deliver', 60), [
             ('consumer_tag', ctag),
             ('delivery_tag', dtag),
-            ('redelivered', False),
+            ('redelivered', redelivered),
             ('exchange', exchange),
             ('routing_key', routing_key),
-            ], mkContent(body))
+            ], mkContent(body, properties=properties))
 
 
-def mk_get_ok(body, exchange, routing_key, dtag):
+def mk_get_ok(body, exchange, routing_key, dtag, properties=None):
     return Message(mkMethod('get-ok', 71), [
             ('delivery_tag', dtag),
             ('redelivered', False),
             ('exchange', exchange),
             ('routing_key', routing_key),
-            ], mkContent(body))
+            ], mkContent(body, properties=properties))
 
 
 class FakeAMQPBroker(object):
@@ -123,10 +124,10 @@ class FakeAMQPBroker(object):
         assert exchange_type == self.exchanges[exchange].exchange_type
         return Message(mkMethod("declare-ok", 11))
 
-    def queue_declare(self, queue):
+    def queue_declare(self, queue, auto_delete=False):
         if not queue:
             queue = gen_id('queue.')
-        self.queues.setdefault(queue, FakeAMQPQueue(queue))
+        self.queues.setdefault(queue, FakeAMQPQueue(queue, auto_delete))
         queue_obj = self._get_queue(queue)
         return Message(mkMethod("declare-ok", 11), [
                 ('queue', queue),
@@ -152,6 +153,12 @@ class FakeAMQPBroker(object):
     def basic_publish(self, exchange, routing_key, content):
         exc = self.dispatched.setdefault(exchange, {})
         exc.setdefault(routing_key, []).append(content)
+        if exchange == '' and routing_key in self.queues:
+            # The default exchange routes to the queue named by the
+            # routing key.
+            self.queues[routing_key].put(exchange, routing_key, content)
+            self.kick_delivery()
+            return None
         if exchange not in self.exchanges:
             # This is to test, so we don't care about missing queues
             return None
@@ -166,6 +173,12 @@ class FakeAMQPBroker(object):
         self._get_queue(queue).ack(delivery_tag)
         return None
 
+    def basic_reject(self, queue, delivery_tag, requeue):
+        self._get_queue(queue).reject(delivery_tag, requeue)
+        # Rejecting frees up a prefetch slot, and may requeue a message.
+        self.kick_delivery()
+        return None
+
     def deliver_to_channels(self):
         # Since all delivery goes through kick_delivery(), this can
         # only happen if message_processed() is called too many times.
@@ -182,14 +195,18 @@ class FakeAMQPBroker(object):
             return False
         delivered = False
         for ctag, queue in channel.consumers.items():
-            dtag, msg = self._get_queue(queue).get_message()
-            while dtag is not None:
+            # Check after each message so that we honour the prefetch limit.
+            while channel.deliverable():
+                dtag, msg = self._get_queue(queue).get_message()
+                if dtag is None:
+                    break
                 dmsg = mk_deliver(msg['content'], msg['exchange'],
-                                  msg['routing_key'], ctag, dtag)
+                                  msg['routing_key'], ctag, dtag,
+                                  msg['properties'],
+                                  msg.get('redelivered', False))
                 self._delivering['count'] += 1
                 channel.deliver_message(dmsg, queue)
                 delivered = True
-                dtag, msg = self._get_queue(queue).get_message()
         return delivered
 
     def kick_delivery(self):
@@ -251,8 +268,15 @@ class FakeAMQPBroker(object):
 
     def get_messages(self, exchange, rkey):
         contents = self.get_dispatched(exchange, rkey)
-        messages = [VumiMessage.from_json(content.body)
-                    for content in contents]
+        messages = []
+        for content in contents:
+            properties = getattr(content, 'properties', None) or {}
+            codec = get_codec_for_content_type(
+                properties.get('content type'))
+            if BATCH_HEADER in (properties.get('headers') or {}):
+                messages.extend(VumiMessage.decode_batch(content.body, codec))
+            else:
+                messages.append(VumiMessage.decode(content.body, codec))
         return messages
 
     def publish_message(self, exchange, routing_key, message):
@@ -281,6 +305,7 @@ class FakeAMQPChannel(object):
         self.delegate = delegate
         self.unacked = []
         self.flow_active = True
+        self.closed = False
 
     def __repr__(self):
         return '<FakeAMQPChannel: id=%s flow=%s>' % (
@@ -300,7 +325,7 @@ class FakeAMQPChannel(object):
         return Message(mkMethod("flow-ok", 21), [('active', active)])
 
     def close(self, _reason):
-        pass
+        self.closed = True
 
     def basic_qos(self, _prefetch_size, prefetch_count, _global):
         self.qos_prefetch_count = prefetch_count
@@ -308,18 +333,18 @@ class FakeAMQPChannel(object):
     def exchange_declare(self, exchange, type, durable=None):
         return self.broker.exchange_declare(exchange, type)
 
-    def queue_declare(self, queue, durable=None):
-        return self.broker.queue_declare(queue)
+    def queue_declare(self, queue, durable=None, auto_delete=False):
+        return self.broker.queue_declare(queue, auto_delete)
 
     def queue_bind(self, queue, exchange, routing_key):
         return self.broker.queue_bind(queue, exchange, routing_key)
 
-    def basic_consume(self, queue, tag=None):
-        if not tag:
-            tag = gen_id('consumer.')
-        assert tag not in self.consumers
-        self.consumers[tag] = queue
-        return self.broker.basic_consume(queue, tag)
+    def basic_consume(self, queue, consumer_tag=None):
+        if not consumer_tag:
+            consumer_tag = gen_id('consumer.')
+        assert consumer_tag not in self.consumers
+        self.consumers[consumer_tag] = queue
+        return self.broker.basic_consume(queue, consumer_tag)
 
     def basic_cancel(self, tag):
         queue = self.consumers.pop(tag, None)
@@ -332,6 +357,9 @@ class FakeAMQPChannel(object):
 
     def basic_ack(self, delivery_tag, multiple):
         assert delivery_tag in [d for d, _q in self.unacked]
+        if self.qos_prefetch_count > 0:
+            # Acking frees up prefetch slots, so deliver queued messages.
+            self.broker.kick_delivery()
         for dtag, queue in self.unacked[:]:
             if multiple or (dtag == delivery_tag):
                 self.unacked.remove((dtag, queue))
@@ -339,6 +367,13 @@ class FakeAMQPChannel(object):
                 if (dtag == delivery_tag):
                     return resp
 
+    def basic_reject(self, delivery_tag, requeue):
+        for dtag, queue in self.unacked[:]:
+            if dtag == delivery_tag:
+                self.unacked.remove((dtag, queue))
+                return self.broker.basic_reject(queue, dtag, requeue)
+        assert False, "Unknown delivery tag %r" % (delivery_tag,)
+
     def deliverable(self):
         if not self.flow_active:
             return False
@@ -355,7 +390,7 @@ class FakeAMQPChannel(object):
         if msg:
             self.unacked.append((dtag, queue))
             return mk_get_ok(msg['content'], msg['exchange'],
-                             msg['routing_key'], dtag)
+                             msg['routing_key'], dtag, msg['properties'])
         return Message(mkMethod("get-empty", 72))
 
     def message_processed(self):
@@ -410,8 +445,10 @@ class FakeAMQPExchangeTopic(FakeAMQPExchange):
 
 
 class FakeAMQPQueue(object):
-    def __init__(self, name):
+    def __init__(self, name, auto_delete=False):
         self.name = name
+        # Only recorded, the queue isn't deleted.
+        self.auto_delete = auto_delete
         self.messages = []
         self.consumers = set()
         self.unacked_messages = {}
@@ -441,11 +478,18 @@ class FakeAMQPQueue(object):
                 'exchange': exchange,
                 'routing_key': routing_key,
                 'content': content.body,
+                'properties': getattr(content, 'properties', None),
                 })
 
     def ack(self, delivery_tag):
         self.unacked_messages.pop(delivery_tag)
 
+    def reject(self, delivery_tag, requeue):
+        msg = self.unacked_messages.pop(delivery_tag)
+        if requeue:
+            msg['redelivered'] = True
+            self.messages.insert(0, msg)
+
     def get_message(self):
         try:
             msg = self.messages.pop(0)
@@ -0,0 +1,118 @@
+from twisted.trial.unittest import TestCase
+
+from vumi.local_bus import LocalMessageBus, LocalDelivery
+from vumi.message import Message
+
+
+class FakeConsumer(object):
+    def __init__(self, routing_key, queue_name=None, exchange_name='vumi'):
+        self.exchange_name = exchange_name
+        self.routing_key = routing_key
+        self.queue_name = queue_name or routing_key
+        self.paused = False
+        self.deliveries = []
+
+    def deliver_local(self, delivery):
+        self.deliveries.append(delivery)
+
+    def messages(self):
+        return [d.message for d in self.deliveries]
+
+
+def queues(*names):
+    return set(('queue', name) for name in names)
+
+
+class TestLocalMessageBus(TestCase):
+
+    def setUp(self):
+        self.bus = LocalMessageBus()
+
+    def test_unbound(self):
+        msg = Message(content='hi')
+        self.assertFalse(self.bus.is_bound('vumi', 'foo'))
+        self.assertFalse(self.bus.publish('vumi', 'foo', msg, queues()))
+
+    def test_publish(self):
+        consumer = FakeConsumer('foo')
+        self.bus.add_consumer(consumer)
+        msg = Message(content='hi')
+        self.assertTrue(self.bus.is_bound('vumi', 'foo'))
+        self.assertFalse(self.bus.is_bound('other', 'foo'))
+        self.assertTrue(self.bus.publish('vumi', 'foo', msg, queues('foo')))
+        [delivery] = consumer.deliveries
+        self.assertTrue(isinstance(delivery, LocalDelivery))
+        self.assertEqual(None, delivery.delivery_tag)
+        self.assertEqual(msg, delivery.message)
+        # The consumer gets its own copy.
+        self.assertFalse(delivery.message is msg)
+        self.assertTrue(delivery.original is msg)
+
+    def test_unknown_bindings_fall_back(self):
+        consumer = FakeConsumer('foo')
+        self.bus.add_consumer(consumer)
+        self.assertFalse(self.bus.publish('vumi', 'foo', Message(n=1), None))
+        self.assertEqual([], consumer.messages())
+
+    def test_other_bindings_fall_back(self):
+        consumer = FakeConsumer('foo')
+        self.bus.add_consumer(consumer)
+        self.assertFalse(self.bus.publish('vumi', 'foo', Message(n=1),
+                                          queues('foo', 'tap')))
+        self.assertFalse(self.bus.publish(
+            'vumi', 'foo', Message(n=2),
+            queues('foo') | set([('exchange', 'other')])))
+        self.assertEqual([], consumer.messages())
+
+    def test_round_robin_within_queue(self):
+        c1 = FakeConsumer('foo')
+        c2 = FakeConsumer('foo')
+        self.bus.add_consumer(c1)
+        self.bus.add_consumer(c2)
+        for i in range(4):
+            self.bus.publish('vumi', 'foo', Message(n=i), queues('foo'))
+        self.assertEqual([0, 2], [m['n'] for m in c1.messages()])
+        self.assertEqual([1, 3], [m['n'] for m in c2.messages()])
+
+    def test_every_queue_gets_a_copy(self):
+        c1 = FakeConsumer('foo', 'queue1')
+        c2 = FakeConsumer('foo', 'queue2')
+        self.bus.add_consumer(c1)
+        self.bus.add_consumer(c2)
+        self.bus.publish('vumi', 'foo', Message(n=1),
+                         queues('queue1', 'queue2'))
+        self.assertEqual([1], [m['n'] for m in c1.messages()])
+        self.assertEqual([1], [m['n'] for m in c2.messages()])
+        self.assertFalse(c1.messages()[0] is c2.messages()[0])
+
+    def test_paused_consumers_skipped(self):
+        c1 = FakeConsumer('foo')
+        c2 = FakeConsumer('foo')
+        c1.paused = True
+        self.bus.add_consumer(c1)
+        self.bus.add_consumer(c2)
+        self.assertTrue(self.bus.publish('vumi', 'foo', Message(n=1),
+                                         queues('foo')))
+        self.assertEqual([], c1.messages())
+        self.assertEqual([1], [m['n'] for m in c2.messages()])
+
+    def test_all_paused_falls_back(self):
+        c1 = FakeConsumer('foo', 'queue1')
+        c2 = FakeConsumer('foo', 'queue2')
+        c2.paused = True
+        self.bus.add_consumer(c1)
+        self.bus.add_consumer(c2)
+        self.assertFalse(self.bus.publish('vumi', 'foo', Message(n=1),
+                                          queues('queue1', 'queue2')))
+        self.assertEqual([], c1.messages())
+        self.assertEqual([], c2.messages())
+
+    def test_remove_consumer(self):
+        consumer = FakeConsumer('foo')
+        self.bus.add_consumer(consumer)
+        self.bus.remove_consumer(consumer)
+        self.assertFalse(self.bus.is_bound('vumi', 'foo'))
+        self.assertFalse(self.bus.publish('vumi', 'foo', Message(n=1),
+                                          queues('foo')))
+        # Removing it again is harmless.
+        self.bus.remove_consumer(consumer)
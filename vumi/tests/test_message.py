@@ -1,8 +1,17 @@
-from twisted.trial.unittest import TestCase
+from datetime import datetime
+
+from twisted.trial.unittest import TestCase, SkipTest
 
 from vumi.tests.utils import RegexMatcher, UTCNearNow
 from vumi.message import (Message, TransportMessage, TransportEvent,
-                          TransportUserMessage)
+                          TransportUserMessage, JSONMessageCodec, get_codec,
+                          get_codec_for_content_type, parse_vumi_date,
+                          date_time_decoder, from_json, to_json,
+                          lazy_message_class, KEYWORD_HEADER,
+                          VUMI_DATE_FORMAT)
+from vumi import message
+from vumi.errors import (ConfigError, MissingMessageField,
+                         InvalidMessageField)
 
 
 class MessageTest(TestCase):
@@ -17,6 +26,65 @@ class MessageTest(TestCase):
         self.assertTrue('a' in Message(a=5))
         self.assertFalse('a' in Message(b=5))
 
+    def test_message_copy(self):
+        msg = TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345', content='heya',
+            transport_name='sphex', transport_type='sms',
+            transport_metadata={'session': {'id': 'abc'}},
+            helper_metadata={'tags': [{'pool': 'foo'}]})
+        copy = msg.copy()
+        self.assertTrue(isinstance(copy, TransportUserMessage))
+        self.assertEqual(msg, copy)
+        copy['content'] = 'changed'
+        copy['transport_metadata']['session']['id'] = 'changed'
+        copy['helper_metadata']['tags'][0]['pool'] = 'changed'
+        copy['helper_metadata']['tags'].append('new')
+        self.assertEqual('heya', msg['content'])
+        self.assertEqual({'session': {'id': 'abc'}},
+                         msg['transport_metadata'])
+        self.assertEqual({'tags': [{'pool': 'foo'}]}, msg['helper_metadata'])
+
+    def test_no_instance_dict(self):
+        msg = TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345', content='heya',
+            transport_name='sphex', transport_type='sms',
+            transport_metadata={})
+        self.assertFalse(hasattr(msg, '__dict__'))
+
+    def test_required_fields(self):
+        self.assertEqual(('message_version', 'message_type', 'timestamp'),
+                         TransportMessage.required_fields())
+        self.assertEqual(('message_version', 'message_type', 'timestamp',
+                          'user_message_id', 'event_id', 'event_type'),
+                         TransportEvent.required_fields())
+        self.assertRaises(MissingMessageField, TransportUserMessage,
+                          to_addr='+27831234567', content='heya',
+                          transport_name='sphex', transport_type='sms',
+                          transport_metadata={})
+        self.assertRaises(InvalidMessageField, TransportUserMessage,
+                          to_addr='+27831234567', from_addr='12345',
+                          content='heya', transport_name='sphex',
+                          transport_type='sms', transport_metadata={},
+                          session_event='bogus')
+
+    def test_from_trusted_payload(self):
+        payload = {'a': 1}
+        # No validation, so this isn't a valid TransportUserMessage.
+        msg = TransportUserMessage.from_trusted_payload(payload)
+        self.assertTrue(isinstance(msg, TransportUserMessage))
+        self.assertTrue(msg.payload is payload)
+
+    def test_reply_matches_validated_construction(self):
+        msg = TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345', content='heya',
+            transport_name='sphex', transport_type='sms',
+            transport_metadata={'foo': 'bar'})
+        reply = msg.reply('hello', continue_session=False)
+        validated = TransportUserMessage(**reply.payload)
+        self.assertEqual(validated, reply)
+        self.assertEqual(TransportUserMessage.SESSION_CLOSE,
+                         reply['session_event'])
+
     def test_transport_message(self):
         msg = TransportMessage(
             message_type='foo',
@@ -251,3 +319,253 @@ class MessageTest(TestCase):
         self.assertEqual('20110921', msg['message_version'])
         # self.assertEqual('sphex', msg['transport_name'])
         self.assertEqual('delivered', msg['delivery_status'])
+
+
+class TimestampDecodingTest(TestCase):
+
+    def test_parse_vumi_date(self):
+        self.assertEqual(datetime(2012, 3, 4, 5, 6, 7, 890123),
+                         parse_vumi_date('2012-03-04 05:06:07.890123'))
+        self.assertEqual(datetime(2012, 3, 4, 5, 6, 7, 890123),
+                         parse_vumi_date(u'2012-03-04 05:06:07.890123'))
+
+    def test_parse_vumi_date_like_strptime(self):
+        for value in ['2012-3-4 5:6:7.8', '2012-03-04 05:06:07.89',
+                      '2012-13-04 05:06:07.890123', '2012-03-04 05:06:07',
+                      '2012-03-04 05:06:07.890123\n', 'x2012-03-04 05:06:07.8',
+                      '', 'foo', '12-03-04 05:06:07.890123']:
+            try:
+                expected = datetime.strptime(value, VUMI_DATE_FORMAT)
+            except ValueError:
+                expected = None
+            self.assertEqual(expected, parse_vumi_date(value), repr(value))
+
+    def test_date_time_decoder(self):
+        self.assertEqual(
+            {'a': datetime(2012, 3, 4, 5, 6, 7, 890123), 'b': 'foo', 'c': 1},
+            date_time_decoder({'a': '2012-03-04 05:06:07.890123',
+                               'b': 'foo', 'c': 1}))
+
+    def test_from_json_decodes_timestamp_fields(self):
+        msg = TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345',
+            content='2012-03-04 05:06:07.890123',
+            transport_name='sphex', transport_type='sms',
+            transport_metadata={})
+        decoded = TransportUserMessage.from_json(msg.to_json())
+        self.assertEqual(msg['timestamp'], decoded['timestamp'])
+        # Other top-level fields are left alone.
+        self.assertEqual(u'2012-03-04 05:06:07.890123', decoded['content'])
+
+    def test_from_json_decodes_nested_timestamps(self):
+        # Older workers put datetimes in metadata and expect them back.
+        dt = datetime(2012, 3, 4, 5, 6, 7, 890123)
+        msg = TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345', content='hi',
+            transport_name='sphex', transport_type='sms',
+            transport_metadata={'deliver_at': dt, 'items': [{'at': dt}]},
+            helper_metadata={'dates': [dt]})
+        json_string = msg.to_json()
+        decoded = TransportUserMessage.from_json(json_string)
+        self.assertEqual(dt, decoded['transport_metadata']['deliver_at'])
+        self.assertEqual(dt, decoded['transport_metadata']['items'][0]['at'])
+        # Same as the old strptime based decoding.
+        self.assertEqual(from_json(json_string)['transport_metadata'],
+                         decoded['transport_metadata'])
+        self.assertEqual(from_json(json_string)['helper_metadata'],
+                         decoded['helper_metadata'])
+
+    def test_from_json_without_timestamp_fields(self):
+        dt = datetime(2012, 3, 4, 5, 6, 7, 890123)
+        msg = Message.from_json(to_json({'a': dt, 'b': {'c': dt}}))
+        self.assertEqual(Message(a=dt, b={'c': dt}), msg)
+
+
+class MessageCodecTest(TestCase):
+
+    def mkmsg(self):
+        return TransportUserMessage(
+            to_addr='+27831234567',
+            from_addr='12345',
+            content=u'heya \u2603',
+            transport_name='sphex',
+            transport_type='sms',
+            transport_metadata={'tuple': (1, 2)},
+            )
+
+    def get_msgpack_codec(self):
+        if message.msgpack is None:
+            raise SkipTest("Failed to import 'msgpack'.")
+        return get_codec('msgpack')
+
+    def test_get_codec(self):
+        self.assertTrue(isinstance(get_codec(), JSONMessageCodec))
+        self.assertTrue(get_codec('json') is get_codec())
+        self.assertRaises(ConfigError, get_codec, 'carrier-pigeon')
+
+    def test_get_codec_for_content_type(self):
+        self.assertTrue(get_codec_for_content_type(None) is get_codec())
+        self.assertTrue(get_codec_for_content_type('application/json')
+                        is get_codec())
+        self.assertTrue(get_codec_for_content_type('text/plain')
+                        is get_codec())
+        self.assertTrue(
+            get_codec_for_content_type('Application/JSON; charset=utf-8')
+            is get_codec())
+
+    def test_get_codec_for_content_type_msgpack(self):
+        codec = self.get_msgpack_codec()
+        self.assertTrue(
+            get_codec_for_content_type('application/x-msgpack') is codec)
+
+    def test_msgpack_codec_missing(self):
+        self.patch(message, 'MESSAGE_CODECS', {'json': JSONMessageCodec})
+        self.patch(message, '_codec_instances', {})
+        self.assertRaises(ConfigError, get_codec, 'msgpack')
+        self.assertTrue(get_codec_for_content_type('application/x-msgpack')
+                        is get_codec())
+
+    def test_json_codec(self):
+        msg = self.mkmsg()
+        data = msg.encode(get_codec('json'))
+        self.assertEqual(msg.to_json(), data)
+        decoded = TransportUserMessage.decode(data, get_codec('json'))
+        self.assertEqual(TransportUserMessage.from_json(data), decoded)
+
+    def test_msgpack_codec(self):
+        codec = self.get_msgpack_codec()
+        msg = self.mkmsg()
+        data = msg.encode(codec)
+        decoded = TransportUserMessage.decode(data, codec)
+        # Same result as a trip through JSON.
+        self.assertEqual(TransportUserMessage.from_json(msg.to_json()),
+                         decoded)
+        self.assertTrue(isinstance(decoded['timestamp'], datetime))
+        self.assertTrue(isinstance(decoded['transport_name'], unicode))
+        self.assertTrue(len(data) < len(msg.to_json()))
+
+
+class LazyMessageTest(TestCase):
+
+    def mkmsg(self, **kw):
+        kw.setdefault('transport_metadata', {'session_id': 'abc'})
+        kw.setdefault('content', 'heya')
+        return TransportUserMessage(
+            to_addr='+27831234567',
+            from_addr='12345',
+            transport_name='sphex',
+            transport_type='sms',
+            **kw)
+
+    def mklazy(self, msg):
+        lazy_class = lazy_message_class(TransportUserMessage)
+        return lazy_class.from_raw(msg.to_json())
+
+    def test_lazy_message_class(self):
+        lazy_class = lazy_message_class(TransportUserMessage)
+        self.assertTrue(issubclass(lazy_class, TransportUserMessage))
+        self.assertTrue(lazy_message_class(TransportUserMessage)
+                        is lazy_class)
+
+    def test_not_parsed_until_used(self):
+        lazy_class = lazy_message_class(TransportUserMessage)
+        msg = lazy_class.from_raw('not json')
+        self.assertRaises(ValueError, msg.get, 'to_addr')
+
+    def test_invalid_message(self):
+        msg = self.mklazy(self.mkmsg())
+        msg._raw = msg._raw.replace('20110921', '19700101')
+        self.assertRaises(InvalidMessageField, msg.get, 'to_addr')
+
+    def test_fields(self):
+        orig = self.mkmsg()
+        msg = self.mklazy(orig)
+        self.assertEqual('+27831234567', msg['to_addr'])
+        self.assertTrue('from_addr' in msg)
+        self.assertEqual(None, msg.get('foo'))
+        self.assertEqual(orig['timestamp'], msg['timestamp'])
+        self.assertEqual(orig, msg)
+
+    def test_unmodified_passthrough(self):
+        data = self.mkmsg().to_json()
+        lazy_class = lazy_message_class(TransportUserMessage)
+        msg = lazy_class.from_raw(data)
+        self.assertEqual(msg['to_addr'], '+27831234567')
+        self.assertTrue(msg.is_unmodified())
+        self.assertTrue(msg.to_json() is data)
+        self.assertTrue(msg.encode(get_codec('json')) is data)
+
+    def test_modified(self):
+        orig = self.mkmsg()
+        msg = self.mklazy(orig)
+        msg['to_addr'] = 'foo'
+        self.assertFalse(msg.is_unmodified())
+        orig['to_addr'] = 'foo'
+        self.assertEqual(orig, TransportUserMessage.from_json(msg.to_json()))
+
+    def test_mutable_field_counts_as_modified(self):
+        orig = self.mkmsg()
+        msg = self.mklazy(orig)
+        msg['transport_metadata']['session_id'] = 'def'
+        self.assertFalse(msg.is_unmodified())
+        self.assertEqual('def', from_json(msg.to_json())[
+            'transport_metadata']['session_id'])
+
+    def test_copy(self):
+        orig = self.mkmsg()
+        msg = self.mklazy(orig)
+        self.assertEqual('sphex', msg['transport_name'])
+        copied = msg.copy()
+        self.assertTrue(copied.to_json() is msg.to_json())
+        self.assertEqual(orig, copied)
+        copied['transport_metadata']['session_id'] = 'def'
+        self.assertEqual('abc', msg['transport_metadata']['session_id'])
+
+    def test_fields_from_routing_headers(self):
+        lazy_class = lazy_message_class(TransportUserMessage)
+        msg = lazy_class.from_raw('not json', headers={
+            'to_addr': '+27831234567', KEYWORD_HEADER: 'heya'})
+        self.assertEqual(u'+27831234567', msg['to_addr'])
+        self.assertTrue('to_addr' in msg)
+        self.assertEqual(u'heya', msg.routing_keyword())
+        self.assertRaises(ValueError, msg.get, 'from_addr')
+
+    def test_routing_headers(self):
+        orig = self.mkmsg(content=u'Caf\xe9 au lait')
+        headers = orig.routing_headers()
+        self.assertEqual({
+            'to_addr': '+27831234567',
+            'from_addr': '12345',
+            'transport_name': 'sphex',
+            'message_type': 'user_message',
+            KEYWORD_HEADER: 'caf\xc3\xa9',
+            }, headers)
+        lazy_class = lazy_message_class(TransportUserMessage)
+        msg = lazy_class.from_raw(orig.to_json(), headers=headers)
+        self.assertEqual(headers, msg.routing_headers())
+        msg['to_addr'] = '+27831234568'
+        self.assertEqual('+27831234568', msg.routing_headers()['to_addr'])
+
+    def test_routing_headers_drop_other_headers(self):
+        orig = self.mkmsg()
+        headers = orig.routing_headers()
+        lazy_class = lazy_message_class(TransportUserMessage)
+        msg = lazy_class.from_raw(orig.to_json(), headers=dict(
+            headers, retried=1))
+        self.assertEqual(headers, msg.routing_headers())
+
+    def test_copy_modified(self):
+        orig = self.mkmsg()
+        msg = self.mklazy(orig)
+        msg['content'] = 'bye'
+        copied = msg.copy()
+        self.assertEqual(TransportUserMessage, type(copied))
+        self.assertEqual(msg, copied)
+
+    def test_from_trusted_payload(self):
+        orig = self.mkmsg()
+        lazy_class = lazy_message_class(TransportUserMessage)
+        msg = lazy_class.from_trusted_payload(orig.payload)
+        self.assertEqual(TransportUserMessage, type(msg))
+        self.assertEqual(orig, msg)
+        self.assertEqual(orig.to_json(), msg.to_json())
@@ -1,11 +1,19 @@
+import os
+import json
+
+import yaml
 from twisted.trial.unittest import TestCase
 from twisted.internet.defer import (Deferred, DeferredList, inlineCallbacks,
                                     returnValue)
+from twisted.internet.error import ProcessTerminated
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
 
 from vumi.tests.utils import StubbedWorkerCreator, get_stubbed_worker
 from vumi.service import Worker
 from vumi.message import TransportUserMessage
-from vumi.multiworker import MultiWorker
+from vumi.multiworker import (MultiWorker, WorkerProcess, CONFIG_FD,
+                              VUMI_CONFIG_FD, HEALTH_FD)
 
 
 class ToyWorker(Worker):
@@ -31,6 +39,26 @@ class ToyWorker(Worker):
             message.reply(''.join(reversed(message['content']))))
 
 
+class RelayWorker(Worker):
+    """Passes replies from worker1 on to its own output."""
+
+    def startService(self):
+        self._d = Deferred()
+        super(RelayWorker, self).startService()
+
+    @inlineCallbacks
+    def startWorker(self):
+        self.received = []
+        self.pub = yield self.publish_to("%s.out" % self.name)
+        yield self.consume("worker1.out", self.process_message,
+                           message_class=TransportUserMessage)
+        self._d.callback(None)
+
+    def process_message(self, message):
+        self.received.append(message)
+        return self.pub.publish_message(message)
+
+
 class StubbedMultiWorker(MultiWorker):
     def WORKER_CREATOR(self, options):
         worker_creator = StubbedWorkerCreator(options)
@@ -103,6 +131,37 @@ class MultiWorkerTestCase(TestCase):
         self.assertEqual(['STOP: worker%s' % (i + 1) for i in range(3)],
                          sorted(ToyWorker.events))
 
+    @inlineCallbacks
+    def test_report_health(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        config = dict(self.base_config, health_fd=write_fd,
+                      health_interval=5)
+        self.worker = get_stubbed_worker(StubbedMultiWorker, config)
+        self.worker.clock = Clock()
+        self.worker.startService()
+        # The first report is sent before the workers have connected.
+        health = json.loads(os.read(read_fd, 4096))
+        self.assertEqual(0, health['connected'])
+        self.assertEqual(3, health['total'])
+        yield self.worker.wait_for_workers()
+        self.worker.clock.advance(5)
+        health = json.loads(os.read(read_fd, 4096))
+        self.assertEqual(3, health['connected'])
+        self.assertEqual({'running': True, 'connected': True},
+                         health['workers']['worker1'])
+
+    def test_report_health_parent_gone(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, write_fd)
+        os.close(read_fd)
+        config = dict(self.base_config, health_fd=write_fd)
+        self.worker = get_stubbed_worker(StubbedMultiWorker, config)
+        self.worker.clock = Clock()
+        self.worker.startService()
+        self.assertEqual(None, self.worker._health_report)
+
     @inlineCallbacks
     def test_message_flow(self):
         yield self.get_multiworker(self.base_config)
@@ -130,3 +189,293 @@ class MultiWorkerTestCase(TestCase):
         worker2 = worker.getServiceNamed("worker2")
         self.assertEqual({'foo': 'bar'}, worker1.config)
         self.assertEqual({'foo': 'baz'}, worker2.config)
+
+    @inlineCallbacks
+    def test_local_message_bus(self):
+        cfg = {
+            'local_message_bus': True,
+            'workers': {
+                'worker1': "%s.ToyWorker" % (__name__,),
+                'relay': "%s.RelayWorker" % (__name__,),
+                },
+            }
+        worker = yield self.get_multiworker(cfg)
+        relay = worker.getServiceNamed("relay")
+        # Only the relay's queue is bound to worker1's output.
+        worker1 = worker.getServiceNamed("worker1")
+        worker1.pub.binding_cache.bindings = {
+            'worker1.out': set([('queue', 'worker1.out')])}
+        yield self.dispatch(mkmsg("foo"), "worker1")
+        yield self.broker.kick_delivery()
+        # worker1's reply went straight to the relay ...
+        self.assertEqual([], self.get_replies("worker1"))
+        self.assertEqual(['oof'], [m['content'] for m in relay.received])
+        self.assertTrue(isinstance(relay.received[0], TransportUserMessage))
+        # ... and nothing local consumes the relay's output, so that
+        # went over AMQP.
+        self.assertEqual(['oof'], self.get_replies("relay"))
+
+    @inlineCallbacks
+    def test_local_message_bus_other_bindings(self):
+        cfg = {
+            'local_message_bus': True,
+            'workers': {
+                'worker1': "%s.ToyWorker" % (__name__,),
+                'relay': "%s.RelayWorker" % (__name__,),
+                },
+            }
+        worker = yield self.get_multiworker(cfg)
+        relay = worker.getServiceNamed("relay")
+        # Something in another process also consumes worker1's output.
+        worker1 = worker.getServiceNamed("worker1")
+        worker1.pub.binding_cache.bindings = {
+            'worker1.out': set([('queue', 'worker1.out'), ('queue', 'tap')])}
+        yield self.dispatch(mkmsg("foo"), "worker1")
+        yield self.broker.kick_delivery()
+        self.assertEqual(['oof'], self.get_replies("worker1"))
+        self.assertEqual(['oof'], [m['content'] for m in relay.received])
+
+    @inlineCallbacks
+    def test_no_local_message_bus(self):
+        cfg = {
+            'workers': {
+                'worker1': "%s.ToyWorker" % (__name__,),
+                'relay': "%s.RelayWorker" % (__name__,),
+                },
+            }
+        yield self.get_multiworker(cfg)
+        yield self.dispatch(mkmsg("foo"), "worker1")
+        yield self.broker.kick_delivery()
+        self.assertEqual(['oof'], self.get_replies("worker1"))
+        self.assertEqual(['oof'], self.get_replies("relay"))
+
+
+class FakeProcessTransport(object):
+    def __init__(self, protocol, pid):
+        self.protocol = protocol
+        self.pid = pid
+        self.signals = []
+        self.child_data = {}
+        self.closed_fds = []
+
+    def writeToChild(self, fd, data):
+        self.child_data[fd] = self.child_data.get(fd, '') + data
+
+    def closeChildFD(self, fd):
+        self.closed_fds.append(fd)
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+
+    def exit(self, code):
+        self.protocol.processEnded(Failure(ProcessTerminated(exitCode=code)))
+
+
+class FakeWorkerProcess(WorkerProcess):
+    pids = iter(xrange(1000, 2000))
+
+    def spawn_process(self, protocol, args, child_fds):
+        self.spawned_args = args
+        self.child_fds = child_fds
+        return FakeProcessTransport(protocol, self.pids.next())
+
+
+class ProcessMultiWorker(MultiWorker):
+    def create_worker_process(self, process_name, args, config_data):
+        process = super(ProcessMultiWorker, self).create_worker_process(
+            process_name, args, config_data)
+        process.__class__ = FakeWorkerProcess
+        process.clock = self.clock
+        return process
+
+
+class ProcessMultiWorkerTestCase(TestCase):
+
+    timeout = 3
+
+    config = {
+        'worker_processes': True,
+        'process_groups': {
+            'group1': ['worker1', 'worker2'],
+            },
+        'restart_delay': 1,
+        'max_restart_delay': 10,
+        'workers': {
+            'worker1': "%s.ToyWorker" % (__name__,),
+            'worker2': "%s.ToyWorker" % (__name__,),
+            'worker3': "%s.ToyWorker" % (__name__,),
+            },
+        'defaults': {'foo': 'baz'},
+        'worker1': {'foo': 'bar'},
+        }
+
+    def setUp(self):
+        self.clock = Clock()
+        self.worker = get_stubbed_worker(ProcessMultiWorker, self.config)
+        self.worker.clock = self.clock
+
+    @inlineCallbacks
+    def tearDown(self):
+        if self.worker.running:
+            d = self.worker.stopService()
+            for process in self.worker.processes.values():
+                if process.running:
+                    process.transport.exit(0)
+            yield d
+
+    @inlineCallbacks
+    def start_worker(self):
+        self.worker.startService()
+        yield self.worker.startWorker()
+
+    def test_process_groups(self):
+        groups = self.worker.get_process_groups()
+        self.assertEqual({
+            'group1': ['worker1', 'worker2'],
+            'worker3': ['worker3'],
+            }, groups)
+
+    def test_construct_process_config(self):
+        config = self.worker.construct_process_config(['worker1', 'worker2'])
+        self.assertEqual({
+            'workers': {
+                'worker1': "%s.ToyWorker" % (__name__,),
+                'worker2': "%s.ToyWorker" % (__name__,),
+                },
+            'local_message_bus': False,
+            'worker1': {'foo': 'bar'},
+            'worker2': {'foo': 'baz'},
+            'health_fd': HEALTH_FD,
+            'health_interval': 10.0,
+            }, config)
+
+    @inlineCallbacks
+    def test_start_processes(self):
+        yield self.start_worker()
+        self.assertEqual([], self.worker.workers)
+        self.assertEqual(['group1', 'worker3'],
+                         sorted(self.worker.processes))
+        process = self.worker.processes['worker3']
+        self.assertTrue(process.running)
+        args = process.spawned_args
+        self.assertTrue('vumi_worker' in args)
+        self.assertEqual('/dev/fd/%d' % (CONFIG_FD,),
+                         args[args.index('--config') + 1])
+        self.assertEqual('/dev/fd/%d' % (VUMI_CONFIG_FD,),
+                         args[args.index('--vumi-config') + 1])
+        self.assertEqual('w', process.child_fds[CONFIG_FD])
+        self.assertEqual('r', process.child_fds[HEALTH_FD])
+        # The configs are written to pipes and never touch the disk.
+        transport = process.transport
+        config = yaml.safe_load(transport.child_data[CONFIG_FD])
+        self.assertEqual(self.worker.construct_process_config(['worker3']),
+                         config)
+        self.assertEqual({}, yaml.safe_load(
+            transport.child_data[VUMI_CONFIG_FD]))
+        self.assertEqual([CONFIG_FD, VUMI_CONFIG_FD], transport.closed_fds)
+
+    @inlineCallbacks
+    def test_stop_processes(self):
+        yield self.start_worker()
+        process = self.worker.processes['worker3']
+        transport = process.transport
+        d = process.stop()
+        self.assertEqual([15], transport.signals)
+        self.assertFalse(d.called)
+        transport.exit(0)
+        self.assertTrue(d.called)
+        self.assertFalse(process.running)
+        self.assertEqual(0, process.restarts)
+        d = self.worker.stopService()
+        self.worker.processes['group1'].transport.exit(0)
+        yield d
+
+    @inlineCallbacks
+    def test_kill_on_stop_timeout(self):
+        yield self.start_worker()
+        process = self.worker.processes['worker3']
+        transport = process.transport
+        process.stop()
+        self.clock.advance(process.stop_timeout)
+        self.assertEqual([15, 9], transport.signals)
+
+    @inlineCallbacks
+    def test_restart(self):
+        yield self.start_worker()
+        process = self.worker.processes['worker3']
+        pid = process.transport.pid
+        process.transport.exit(1)
+        self.assertFalse(process.running)
+        self.assertEqual(1, process.last_exit)
+        self.assertEqual(1, process.restarts)
+        self.clock.advance(1)
+        self.assertTrue(process.running)
+        self.assertNotEqual(pid, process.transport.pid)
+        # The restarted process gets its config again.
+        self.assertTrue(CONFIG_FD in process.transport.child_data)
+        # It died straight away, so the next restart takes longer.
+        process.transport.exit(1)
+        self.clock.advance(1)
+        self.assertFalse(process.running)
+        self.clock.advance(1)
+        self.assertTrue(process.running)
+        # It stayed up for a while, so the delay is reset.
+        self.clock.advance(10)
+        process.transport.exit(1)
+        self.clock.advance(1)
+        self.assertTrue(process.running)
+        self.assertEqual(3, process.restarts)
+
+    @inlineCallbacks
+    def test_health(self):
+        yield self.start_worker()
+        self.worker.processes['worker3'].transport.exit(1)
+        health = self.worker.get_health()
+        self.assertEqual(2, health['total'])
+        self.assertEqual(1, health['running'])
+        self.assertEqual(1, health['restarts'])
+        self.assertEqual(False, health['processes']['worker3']['running'])
+        self.assertEqual(1, health['processes']['worker3']['last_exit'])
+        self.assertEqual(True, health['processes']['group1']['running'])
+        self.assertEqual(0, health['processes']['group1']['uptime'])
+
+    @inlineCallbacks
+    def test_child_health(self):
+        yield self.start_worker()
+        process = self.worker.processes['group1']
+        self.assertEqual(None, self.worker.get_health()[
+            'processes']['group1']['workers'])
+        report = {
+            'workers': {
+                'worker1': {'running': True, 'connected': True},
+                'worker2': {'running': True, 'connected': False},
+                },
+            'connected': 1,
+            'total': 2,
+            }
+        line = json.dumps(report) + '\n'
+        protocol = process.transport.protocol
+        protocol.childDataReceived(HEALTH_FD, line[:10])
+        self.assertEqual(None, process.reported_health)
+        protocol.childDataReceived(HEALTH_FD, line[10:])
+        health = self.worker.get_health()
+        self.assertEqual(report, health['processes']['group1']['workers'])
+        self.assertEqual(1, health['workers_connected'])
+        metrics = self.worker.metrics
+        self.worker._set_process_metrics(metrics)
+        self.assertEqual([0, 1], [v for t, v in
+                                  metrics['workers.connected'].poll()])
+        # A process that exits has nothing to report until it says so.
+        process.transport.exit(1)
+        self.assertEqual(None, process.reported_health)
+        self.assertEqual(0, self.worker.get_health()['workers_connected'])
+
+    @inlineCallbacks
+    def test_metrics(self):
+        yield self.start_worker()
+        self.worker.processes['worker3'].transport.exit(1)
+        metrics = self.worker.metrics
+        self.assertEqual([1], [v for t, v in
+                               metrics['processes.restarts'].poll()])
+        self.assertEqual([2], [v for t, v in
+                               metrics['processes.running'].poll()])
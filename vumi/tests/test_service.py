@@ -1,9 +1,34 @@
+import os
+import shutil
+
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.task import deferLater, Clock
+from twisted.internet import reactor
+
+from vumi.service import (Worker, WorkerCreator, BindingCache,
+                          RoutingKeyError, AckCoalescer, StartupTimer,
+                          get_spec, spec_cache_path, SPECS)
+from vumi.tests.utils import (fake_amq_message, get_stubbed_worker,
+                              get_fake_amq_client)
+from vumi.utils import vumi_resource_path
+from vumi import service
+from vumi.message import (Message, TransportUserMessage, MessageCodec,
+                          to_json, from_json)
+from vumi.errors import VumiError, TemporaryError
+from vumi.local_bus import LocalMessageBus
+from vumi import message
+
 
-from vumi.service import Worker, WorkerCreator
-from vumi.tests.utils import (fake_amq_message, get_stubbed_worker)
-from vumi.message import Message
+class ReversedJSONCodec(MessageCodec):
+    name = 'reversed'
+    content_type = 'application/x-reversed-json'
+
+    def encode(self, payload):
+        return to_json(payload)[::-1]
+
+    def decode(self, data):
+        return from_json(data[::-1])
 
 
 class ServiceTestCase(TestCase):
@@ -33,6 +58,330 @@ class ServiceTestCase(TestCase):
                                                  message.content)
         self.assertEquals(log, [Message(key="value")])
 
+    def use_reversed_codec(self):
+        self.patch(message, 'MESSAGE_CODECS', dict(
+            message.MESSAGE_CODECS, reversed=ReversedJSONCodec))
+        self.patch(message, '_codec_instances', {})
+
+    @inlineCallbacks
+    def test_publish_with_codec(self):
+        self.use_reversed_codec()
+        worker = get_stubbed_worker(Worker, {'message_codec': 'reversed'})
+        broker = worker._amqp_client.broker
+        log = []
+        yield worker.consume('test.routing.key', log.append)
+        publisher = yield worker.publish_to('test.routing.key')
+        msg = Message(key="value")
+        yield publisher.publish_message(msg)
+        yield broker.kick_delivery()
+        [content] = broker.get_dispatched('vumi', 'test.routing.key')
+        self.assertEqual(msg.to_json()[::-1], content.body)
+        self.assertEqual('application/x-reversed-json',
+                         content['content type'])
+        self.assertEqual([msg], log)
+        self.assertEqual([msg], broker.get_messages('vumi',
+                                                    'test.routing.key'))
+
+    @inlineCallbacks
+    def test_publish_routing_headers(self):
+        worker = get_stubbed_worker(Worker)
+        broker = worker._amqp_client.broker
+        publisher = yield worker.publish_to('test.routing.key')
+        msg = TransportUserMessage(to_addr='+1234', from_addr='5678',
+                                   content='Hello world', transport_name='t',
+                                   transport_type='sms')
+        yield publisher.publish_message(msg)
+        [content] = broker.get_dispatched('vumi', 'test.routing.key')
+        self.assertEqual(msg.routing_headers(), content['headers'])
+        self.assertEqual('hello', content['headers']['keyword'])
+
+    @inlineCallbacks
+    def test_publish_without_routing_headers(self):
+        worker = get_stubbed_worker(Worker, {'routing_headers': False})
+        broker = worker._amqp_client.broker
+        publisher = yield worker.publish_to('test.routing.key')
+        msg = TransportUserMessage(to_addr='+1234', from_addr='5678',
+                                   transport_name='t', transport_type='sms')
+        yield publisher.publish_message(msg)
+        [content] = broker.get_dispatched('vumi', 'test.routing.key')
+        self.assertEqual({'delivery mode': 2}, content.properties)
+
+    @inlineCallbacks
+    def test_publish_batches(self):
+        worker = get_stubbed_worker(Worker, {'publish_batch_size': 3})
+        broker = worker._amqp_client.broker
+        log = []
+        consumer = yield worker.consume('test.routing.key', log.append)
+        publisher = yield worker.publish_to('test.routing.key')
+        msgs = [Message(key=i) for i in range(4)]
+        published = [publisher.publish_message(msg) for msg in msgs]
+        contents = broker.get_dispatched('vumi', 'test.routing.key')
+        self.assertEqual([3], [c['headers']['batch'] for c in contents])
+        self.assertEqual([True, True, True, False],
+                         [d.called for d in published])
+        yield publisher.flush_batch()
+        yield broker.kick_delivery()
+        self.assertEqual(msgs, log)
+        self.assertEqual(msgs, broker.get_messages('vumi', 'test.routing.key'))
+        self.assertEqual(consumer.channel.unacked, [])
+
+    @inlineCallbacks
+    def test_publish_batch_delay(self):
+        worker = get_stubbed_worker(Worker, {
+            'publish_batch_size': 3, 'publish_batch_delay': 0.5})
+        broker = worker._amqp_client.broker
+        publisher = yield worker.publish_to('test.routing.key')
+        publisher.clock = Clock()
+        d1 = publisher.publish_message(Message(key=1))
+        d2 = publisher.publish_message(Message(key=2))
+        publisher.clock.advance(0.4)
+        self.assertEqual([], broker.get_dispatched('vumi', 'test.routing.key'))
+        publisher.clock.advance(0.1)
+        [content] = broker.get_dispatched('vumi', 'test.routing.key')
+        self.assertEqual(2, content['headers']['batch'])
+        self.assertEqual([Message(key=1), Message(key=2)],
+                         Message.decode_batch(content.body))
+        self.assertTrue(d1.called and d2.called)
+
+    @inlineCallbacks
+    def test_stop_publishes_waiting_batch(self):
+        worker = get_stubbed_worker(Worker, {
+            'publish_batch_size': 3, 'publish_batch_delay': 0.5})
+        broker = worker._amqp_client.broker
+        publisher = yield worker.publish_to('test.routing.key')
+        publisher.clock = Clock()
+        d1 = publisher.publish_message(Message(key=1))
+        d2 = publisher.publish_message(Message(key=2))
+        # Stopping the worker stops its publishers.
+        worker.running = True
+        yield worker.stopService()
+        [content] = broker.get_dispatched('vumi', 'test.routing.key')
+        self.assertEqual([Message(key=1), Message(key=2)],
+                         Message.decode_batch(content.body))
+        self.assertTrue(d1.called and d2.called)
+        self.assertEqual([], publisher.clock.getDelayedCalls())
+
+    def mk_partitioned_msgs(self):
+        return [TransportUserMessage(to_addr='1234', from_addr='+2776%d' % i,
+                                     transport_name='t', transport_type='sms')
+                for i in range(20)]
+
+    @inlineCallbacks
+    def test_publish_partitions(self):
+        worker = get_stubbed_worker(Worker, {
+            'publish_partitions': {'t.inbound': 3}})
+        broker = worker._amqp_client.broker
+        publisher = yield worker.publish_to('t.inbound')
+        msgs = self.mk_partitioned_msgs()
+        for msg in msgs:
+            yield publisher.publish_message(msg)
+        self.assertEqual([], broker.get_messages('vumi', 't.inbound'))
+        for partition in range(3):
+            rkey = 't.inbound.%d' % (partition,)
+            self.assertEqual(
+                [msg for msg in msgs
+                 if publisher.partition_routing_key(msg) == rkey],
+                broker.get_messages('vumi', rkey))
+            self.assertNotEqual([], broker.get_messages('vumi', rkey))
+
+    @inlineCallbacks
+    def test_publish_partitions_field(self):
+        worker = get_stubbed_worker(Worker, {
+            'publish_partitions': {'t.inbound': 3},
+            'partition_fields': {'t.inbound': 'to_addr'}})
+        broker = worker._amqp_client.broker
+        publisher = yield worker.publish_to('t.inbound')
+        msgs = self.mk_partitioned_msgs()
+        for msg in msgs:
+            yield publisher.publish_message(msg)
+        rkey = publisher.partition_routing_key(msgs[0])
+        self.assertEqual(msgs, broker.get_messages('vumi', rkey))
+
+    def test_publish_partitions_unknown_field(self):
+        worker = get_stubbed_worker(Worker, {
+            'publish_partitions': {'test.routing.key': 3}})
+        self.assertRaises(VumiError, worker.publish_to, 'test.routing.key')
+
+    @inlineCallbacks
+    def test_publish_partitions_batches(self):
+        worker = get_stubbed_worker(Worker, {
+            'publish_partitions': {'t.inbound': 3},
+            'publish_batch_size': 100})
+        broker = worker._amqp_client.broker
+        publisher = yield worker.publish_to('t.inbound')
+        msgs = self.mk_partitioned_msgs()
+        for msg in msgs:
+            publisher.publish_message(msg)
+        published = yield publisher.flush_batch()
+        self.assertEqual(
+            sorted(msg['from_addr'] for msg in msgs),
+            sorted(msg['from_addr'] for msg in published))
+        for partition in range(3):
+            rkey = 't.inbound.%d' % (partition,)
+            [content] = broker.get_dispatched('vumi', rkey)
+            self.assertEqual(
+                [msg for msg in msgs
+                 if publisher.partition_routing_key(msg) == rkey],
+                Message.decode_batch(content.body))
+
+    @inlineCallbacks
+    def test_consume_batch_requeues_failures(self):
+        worker = get_stubbed_worker(Worker, {'publish_batch_size': 3})
+        broker = worker._amqp_client.broker
+        log = []
+        failed = set()
+
+        def consume(msg):
+            if msg['key'] == 2 and 2 not in failed:
+                failed.add(2)
+                raise ValueError("Failed to consume message.")
+            if msg['key'] == 3 and 3 not in failed:
+                failed.add(3)
+                return False
+            log.append(msg['key'])
+
+        consumer = yield worker.consume('test.routing.key', consume)
+        publisher = yield worker.publish_to('test.routing.key')
+        for i in range(1, 4):
+            publisher.publish_message(Message(key=i))
+        yield broker.kick_delivery()
+        self.assertEqual([1, 2, 3], log)
+        [batch] = broker.get_dispatched('vumi', 'test.routing.key')
+        [msg2, msg3] = broker.get_dispatched('', 'test.routing.key')
+        self.assertEqual(3, batch['headers']['batch'])
+        self.assertEqual(Message(key=2), Message.from_json(msg2.body))
+        self.assertEqual(Message(key=3), Message.from_json(msg3.body))
+        self.assertEqual(1, msg2['headers']['retried'])
+        self.assertEqual(consumer.channel.unacked, [])
+        [err] = self.flushLoggedErrors(ValueError)
+
+    @inlineCallbacks
+    def test_consume_batch_requeues_to_own_queue(self):
+        worker = get_stubbed_worker(Worker, {'publish_batch_size': 2})
+        broker = worker._amqp_client.broker
+        log = []
+
+        def consume_failing(msg):
+            log.append(('failing', msg['key']))
+            if msg['key'] == 2 and ('failing', 2) not in log[:-1]:
+                raise ValueError("Failed to consume message.")
+
+        def consume_other(msg):
+            log.append(('other', msg['key']))
+
+        yield worker.consume('test.routing.key', consume_failing,
+                             queue_name='failing')
+        yield worker.consume('test.routing.key', consume_other,
+                             queue_name='other')
+        publisher = yield worker.publish_to('test.routing.key')
+        for i in range(1, 3):
+            publisher.publish_message(Message(key=i))
+        yield broker.kick_delivery()
+        self.assertEqual(
+            [('failing', 1), ('failing', 2), ('failing', 2)],
+            [entry for entry in log if entry[0] == 'failing'])
+        self.assertEqual(
+            [('other', 1), ('other', 2)],
+            [entry for entry in log if entry[0] == 'other'])
+        [retried] = broker.get_dispatched('', 'failing')
+        self.assertEqual(Message(key=2), Message.from_json(retried.body))
+        self.assertEqual([], broker.get_dispatched('', 'other'))
+        [err] = self.flushLoggedErrors(ValueError)
+
+    @inlineCallbacks
+    def test_consume_batch_retries_once(self):
+        worker = get_stubbed_worker(Worker, {'publish_batch_size': 2})
+        broker = worker._amqp_client.broker
+        log = []
+
+        def consume(msg):
+            log.append(msg['key'])
+            if msg['key'] == 2:
+                raise ValueError("Failed to consume message.")
+
+        yield worker.consume('test.routing.key', consume)
+        publisher = yield worker.publish_to('test.routing.key')
+        for i in range(1, 3):
+            publisher.publish_message(Message(key=i))
+        yield broker.kick_delivery()
+        # Consumed in the batch, then once more on its own.
+        self.assertEqual([1, 2, 2], log)
+        queue = broker.queues['test.routing.key']
+        self.assertEqual([], queue.messages)
+        self.assertEqual({}, queue.unacked_messages)
+        self.assertEqual(2, len(self.flushLoggedErrors(ValueError)))
+
+    @inlineCallbacks
+    def test_publish_json_by_default(self):
+        worker = get_stubbed_worker(Worker)
+        broker = worker._amqp_client.broker
+        publisher = yield worker.publish_to('test.routing.key')
+        msg = Message(key="value")
+        yield publisher.publish_message(msg)
+        [content] = broker.get_dispatched('vumi', 'test.routing.key')
+        self.assertEqual(msg.to_json(), content.body)
+        self.assertEqual({'delivery mode': 2}, content.properties)
+
+    @inlineCallbacks
+    def test_consume_codecs_by_content_type(self):
+        self.use_reversed_codec()
+        worker = get_stubbed_worker(Worker)
+        broker = worker._amqp_client.broker
+        log = []
+        yield worker.consume('test.routing.key', log.append)
+        json_pub = yield worker.publish_to('test.routing.key')
+        reversed_pub = yield worker.publish_to('test.routing.key')
+        reversed_pub.codec = ReversedJSONCodec()
+        yield json_pub.publish_message(Message(codec="json"))
+        yield reversed_pub.publish_message(Message(codec="reversed"))
+        # Older workers don't set a content type.
+        yield broker.publish_raw('vumi', 'test.routing.key',
+                                 Message(codec="none").to_json())
+        yield broker.kick_delivery()
+        self.assertEqual(['json', 'reversed', 'none'],
+                         [m['codec'] for m in log])
+
+    @inlineCallbacks
+    def test_consume_concurrently(self):
+        worker = get_stubbed_worker(Worker)
+        broker = worker._amqp_client.broker
+        pending = []
+
+        def consume(msg):
+            d = Deferred()
+            pending.append((msg, d))
+            return d
+
+        consumer = yield worker.consume('test.routing.key', consume,
+                                        concurrency=3)
+        self.assertEqual(consumer.channel.qos_prefetch_count, 3)
+        for i in range(5):
+            broker.basic_publish('vumi', 'test.routing.key',
+                                 fake_amq_message({"key": i}).content)
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual([0, 1, 2], [m['key'] for m, _d in pending])
+
+        # finishing messages out of order only acks those messages
+        [(_m0, d0), (_m1, d1), (_m2, d2)] = pending
+        d1.callback(None)
+        self.assertEqual(len(consumer.channel.unacked), 2)
+        d2.callback(None)
+        d0.callback(None)
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual([0, 1, 2, 3, 4], [m['key'] for m, _d in pending])
+        for _m, d in pending[3:]:
+            d.callback(None)
+        self.assertEqual(consumer.channel.unacked, [])
+        yield broker.wait_delivery()
+
+    @inlineCallbacks
+    def test_consume_prefetch_count(self):
+        worker = get_stubbed_worker(Worker)
+        consumer = yield worker.consume('test.routing.key', lambda m: None,
+                                        prefetch_count=10)
+        self.assertEqual(consumer.concurrency, 1)
+        self.assertEqual(consumer.channel.qos_prefetch_count, 10)
+
     @inlineCallbacks
     def test_start_publisher(self):
         """The publisher should publish"""
@@ -47,6 +396,545 @@ class ServiceTestCase(TestCase):
         self.assertEquals(published_msg.properties, {'delivery mode': 2})
 
 
+class TestChannelPooling(TestCase):
+
+    def setUp(self):
+        self.worker = get_stubbed_worker(Worker)
+        self.client = self.worker._amqp_client
+        self.broker = self.client.broker
+
+    @inlineCallbacks
+    def test_publishers_share_channel_per_exchange(self):
+        declared = []
+        orig_declare = self.broker.exchange_declare
+
+        def exchange_declare(exchange, exchange_type):
+            declared.append(exchange)
+            return orig_declare(exchange, exchange_type)
+
+        self.broker.exchange_declare = exchange_declare
+        pub1 = yield self.worker.publish_to('foo.inbound')
+        pub2 = yield self.worker.publish_to('bar.inbound')
+        pub3 = yield self.worker.publish_to('foo.rpc', exchange_name='rpc')
+        self.assertTrue(pub1.channel is pub2.channel)
+        self.assertFalse(pub1.channel is pub3.channel)
+        self.assertEqual(declared, ['vumi', 'rpc'])
+
+    @inlineCallbacks
+    def test_concurrent_callers_wait_for_exchange_declare(self):
+        declared = []
+        pending = Deferred()
+        orig_declare = self.broker.exchange_declare
+
+        def exchange_declare(exchange, exchange_type):
+            declared.append(exchange)
+            orig_declare(exchange, exchange_type)
+            return pending
+
+        self.broker.exchange_declare = exchange_declare
+        pub_d = self.worker.publish_to('foo.inbound')
+        cons_d = self.worker.consume('bar', lambda m: None)
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual(declared, ['vumi'])
+        self.assertFalse(pub_d.called)
+        self.assertFalse(cons_d.called)
+        pending.callback(None)
+        yield pub_d
+        yield cons_d
+        self.assertEqual(declared, ['vumi'])
+
+    @inlineCallbacks
+    def test_failed_exchange_declare_retried(self):
+        declared = []
+        orig_declare = self.broker.exchange_declare
+
+        def exchange_declare(exchange, exchange_type):
+            declared.append(exchange)
+            if len(declared) == 1:
+                raise VumiError("declare failed")
+            return orig_declare(exchange, exchange_type)
+
+        self.broker.exchange_declare = exchange_declare
+        yield self.assertFailure(self.worker.publish_to('foo.inbound'),
+                                 VumiError)
+        yield self.worker.publish_to('foo.inbound')
+        yield self.worker.publish_to('bar.inbound')
+        self.assertEqual(declared, ['vumi', 'vumi'])
+
+    @inlineCallbacks
+    def test_consumers_share_channel_in_group(self):
+        cons1 = yield self.worker.consume('foo', lambda m: None,
+                                          channel_group='group')
+        cons2 = yield self.worker.consume('bar', lambda m: None,
+                                          channel_group='group')
+        cons3 = yield self.worker.consume('baz', lambda m: None)
+        cons4 = yield self.worker.consume('quux', lambda m: None,
+                                          channel_group='group',
+                                          paused=True)
+        self.assertTrue(cons1.channel is cons2.channel)
+        self.assertFalse(cons1._acker is cons2._acker)
+        self.assertFalse(cons1.channel is cons3.channel)
+        self.assertFalse(cons1.channel is cons4.channel)
+
+        yield cons1.stop()
+        self.assertTrue(cons1.channel in self.broker.channels)
+        self.assertEqual(cons1.channel.consumers.keys(),
+                         [cons2.consumer_tag])
+        yield cons2.stop()
+        self.assertFalse(cons1.channel in self.broker.channels)
+
+    @inlineCallbacks
+    def test_consumers_per_channel(self):
+        self.client.consumers_per_channel = 2
+        consumers = []
+        for name in ['a', 'b', 'c']:
+            consumer = yield self.worker.consume(
+                name, lambda m: None, channel_group='group')
+            consumers.append(consumer)
+        [cons1, cons2, cons3] = consumers
+        self.assertTrue(cons1.channel is cons2.channel)
+        self.assertFalse(cons1.channel is cons3.channel)
+
+    @inlineCallbacks
+    def test_shared_channel_delivery(self):
+        msgs = []
+        yield self.worker.consume('foo', msgs.append, channel_group='group')
+        yield self.worker.consume('bar', msgs.append, channel_group='group')
+        self.broker.publish_message('vumi', 'foo', Message(key='foo'))
+        self.broker.publish_message('vumi', 'bar', Message(key='bar'))
+        yield self.broker.kick_delivery()
+        self.assertEqual(sorted(m['key'] for m in msgs), ['bar', 'foo'])
+
+    @inlineCallbacks
+    def test_shared_channel_ack_settings(self):
+        cons1 = yield self.worker.consume('foo', lambda m: None,
+                                          channel_group='group')
+        cons2 = yield self.worker.consume('bar', lambda m: None,
+                                          channel_group='group',
+                                          ack_batch_size=10)
+        self.assertTrue(cons1.channel is cons2.channel)
+        self.assertEqual(cons1._acker.batch_size, 1)
+        self.assertEqual(cons2._acker.batch_size, 10)
+
+    @inlineCallbacks
+    def test_shared_channel_interleaved_acks(self):
+        processing = {}
+
+        def consume(msg):
+            processing[msg['key']] = d = Deferred()
+            return d
+
+        yield self.worker.consume('foo', consume, channel_group='group')
+        cons_b = yield self.worker.consume('bar', consume,
+                                           channel_group='group')
+        acks = []
+        orig_basic_ack = cons_b.channel.basic_ack
+
+        def basic_ack(delivery_tag, multiple):
+            acks.append((delivery_tag, multiple))
+            return orig_basic_ack(delivery_tag, multiple)
+        cons_b.channel.basic_ack = basic_ack
+
+        # The first consumer holds a1 while a2 waits behind it, so b1 is
+        # registered for acking before a2 even though it came later.
+        self.broker.publish_message('vumi', 'foo', Message(key='a1'))
+        self.broker.publish_message('vumi', 'foo', Message(key='a2'))
+        self.broker.publish_message('vumi', 'bar', Message(key='b1'))
+        delivered = self.broker.kick_delivery()
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual(sorted(processing), ['a1', 'b1'])
+        processing.pop('a1').callback(None)
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual(sorted(processing), ['a2', 'b1'])
+        # A multiple ack for b1 here would also ack a2.
+        processing.pop('b1').callback(None)
+        processing.pop('a2').callback(None)
+        yield delivered
+
+        self.assertEqual(3, len(acks))
+        self.assertEqual([False] * 3, [multiple for _, multiple in acks])
+        self.assertEqual([], cons_b.channel.unacked)
+
+    @inlineCallbacks
+    def test_shared_channel_pause(self):
+        msgs = []
+        cons1 = yield self.worker.consume('foo', msgs.append,
+                                          channel_group='group')
+        yield self.worker.consume('bar', msgs.append, channel_group='group')
+        yield cons1.pause()
+        self.assertTrue(cons1.paused)
+        self.assertTrue(cons1.channel.flow_active)
+        self.broker.publish_message('vumi', 'foo', Message(key='foo'))
+        self.broker.publish_message('vumi', 'bar', Message(key='bar'))
+        yield self.broker.kick_delivery()
+        self.assertEqual([m['key'] for m in msgs], ['bar'])
+
+        yield cons1.unpause()
+        yield self.broker.kick_delivery()
+        self.assertEqual([m['key'] for m in msgs], ['bar', 'foo'])
+
+    @inlineCallbacks
+    def test_publisher_channel_reopened(self):
+        pub1 = yield self.worker.publish_to('foo.inbound')
+        pub2 = yield self.worker.publish_to('bar.inbound')
+        old_channel = pub1.channel
+        old_channel.close(None)
+        yield pub2.publish_message(Message(key='bar'))
+        self.assertFalse(pub2.channel is old_channel)
+        self.assertFalse(pub2.channel.closed)
+        yield pub1.publish_message(Message(key='foo'))
+        self.assertTrue(pub1.channel is pub2.channel)
+        [msg] = self.broker.get_messages('vumi', 'foo.inbound')
+        self.assertEqual(msg['key'], 'foo')
+
+    def test_new_channel_ids(self):
+        self.client.channels[0] = object()
+        self.assertEqual(self.client.get_new_channel_id(), 1)
+        self.assertEqual(self.client.get_new_channel_id(), 2)
+
+
+class TestBindingCache(TestCase):
+
+    VUMI_OPTIONS = {
+        "username": "vumitest",
+        "password": "vumitest",
+        "vhost": "/test",
+        "management-url": "http://localhost:55672/api/",
+        "bindings-ttl": 10,
+        }
+
+    def get_cache(self, **options):
+        vumi_options = dict(self.VUMI_OPTIONS, **options)
+        cache = BindingCache(vumi_options, 'vumi')
+        cache.clock = Clock()
+        self.fetches = []
+
+        def fetch_bindings():
+            d = Deferred()
+            self.fetches.append(d)
+            return d
+
+        cache.fetch_bindings = fetch_bindings
+        return cache
+
+    def mk_bindings(self, *keys):
+        return dict((key, set([('queue', key)])) for key in keys)
+
+    def test_bindings_url(self):
+        cache = self.get_cache()
+        self.assertEqual(cache.bindings_url(), "http://localhost:55672/api"
+                         "/exchanges/%2Ftest/vumi/bindings/source")
+
+    def test_disabled_without_management_url(self):
+        cache = self.get_cache(**{"management-url": None})
+        cache.start()
+        self.assertEqual(self.fetches, [])
+        self.assertTrue(cache.is_bound('foo'))
+
+    def test_periodic_refresh(self):
+        cache = self.get_cache()
+        cache.start()
+        self.assertEqual(len(self.fetches), 1)
+        self.fetches.pop().callback(self.mk_bindings('foo'))
+        cache.clock.advance(10)
+        self.assertEqual(len(self.fetches), 1)
+        self.fetches.pop().callback(self.mk_bindings('foo', 'bar'))
+        self.assertEqual(cache.bound_routing_keys, set(['foo', 'bar']))
+        cache.stop()
+        cache.clock.advance(10)
+        self.assertEqual(self.fetches, [])
+
+    def test_destinations(self):
+        cache = self.get_cache()
+        self.assertEqual(None, cache.destinations('foo'))
+        cache.start()
+        self.fetches.pop().callback({
+            'foo': set([('queue', 'foo'), ('queue', 'tap')])})
+        self.assertEqual(set([('queue', 'foo'), ('queue', 'tap')]),
+                         cache.destinations('foo'))
+        self.assertEqual(None, cache.destinations('bar'))
+        cache.stop()
+
+    def test_unknown_bindings(self):
+        cache = self.get_cache()
+        cache.start()
+        self.assertTrue(cache.is_bound('foo'))
+        self.fetches.pop().callback(None)
+        self.assertTrue(cache.is_bound('foo'))
+        self.assertEqual(self.fetches, [])
+        cache.stop()
+
+    def test_missing_key_confirmed_in_background(self):
+        cache = self.get_cache()
+        cache.start()
+        self.fetches.pop().callback(self.mk_bindings('foo'))
+        self.assertTrue(cache.is_bound('foo'))
+        self.assertEqual(self.fetches, [])
+        # an unknown key triggers a refresh but is not rejected yet
+        self.assertTrue(cache.is_bound('bar'))
+        self.assertTrue(cache.is_bound('bar'))
+        self.assertEqual(len(self.fetches), 1)
+        self.fetches.pop().callback(self.mk_bindings('foo', 'baz'))
+        self.assertFalse(cache.is_bound('bar'))
+        self.assertTrue(cache.is_bound('baz'))
+        self.assertEqual(self.fetches, [])
+        cache.stop()
+
+    @inlineCallbacks
+    def test_publisher_rejects_unbound_key(self):
+        worker = get_stubbed_worker(Worker)
+        publisher = yield worker.publish_to('test.routing.key')
+        publisher.binding_cache.bound_routing_keys = set(['other.key'])
+        publisher.binding_cache._unbound_keys.add('test.routing.key')
+        d = publisher.publish_message(Message(key="value"))
+        yield self.assertFailure(d, RoutingKeyError)
+        yield publisher.publish_message(Message(key="value"),
+                                        routing_key='other.key')
+
+
+class RecordingChannel(object):
+    def __init__(self):
+        self.acks = []
+        self.rejects = []
+
+    def basic_ack(self, delivery_tag, multiple):
+        self.acks.append((delivery_tag, multiple))
+
+    def basic_reject(self, delivery_tag, requeue):
+        self.rejects.append((delivery_tag, requeue))
+
+
+class TestAckCoalescer(TestCase):
+
+    def get_coalescer(self, batch_size=1, batch_delay=None, tags=()):
+        self.channel = RecordingChannel()
+        coalescer = AckCoalescer(self.channel, batch_size, batch_delay)
+        coalescer.clock = Clock()
+        for tag in tags:
+            coalescer.delivered(tag)
+        return coalescer
+
+    def test_ack_immediately(self):
+        coalescer = self.get_coalescer(tags=[1, 2])
+        coalescer.ack(1)
+        coalescer.ack(2)
+        self.assertEqual(self.channel.acks, [(1, True), (2, True)])
+
+    def test_batch_size(self):
+        coalescer = self.get_coalescer(batch_size=3, tags=[1, 2, 3, 4])
+        coalescer.ack(1)
+        coalescer.ack(2)
+        self.assertEqual(self.channel.acks, [])
+        coalescer.ack(3)
+        self.assertEqual(self.channel.acks, [(3, True)])
+
+    def test_batch_delay(self):
+        coalescer = self.get_coalescer(batch_size=10, batch_delay=0.1,
+                                       tags=[1, 2, 3])
+        coalescer.ack(1)
+        coalescer.ack(2)
+        self.assertEqual(self.channel.acks, [])
+        coalescer.clock.advance(0.1)
+        self.assertEqual(self.channel.acks, [(2, True)])
+        coalescer.ack(3)
+        coalescer.flush()
+        self.assertEqual(self.channel.acks, [(2, True), (3, True)])
+        self.assertEqual(coalescer.clock.getDelayedCalls(), [])
+
+    def test_out_of_order(self):
+        coalescer = self.get_coalescer(batch_size=3, tags=[1, 2, 3, 4, 5])
+        coalescer.ack(1)
+        coalescer.ack(3)
+        coalescer.ack(4)
+        # 2 is still being processed, so 3 and 4 are acked individually
+        self.assertEqual(self.channel.acks, [(1, True), (3, False),
+                                             (4, False)])
+        coalescer.ack(2)
+        coalescer.ack(5)
+        coalescer.flush()
+        self.assertEqual(self.channel.acks[3:], [(5, True)])
+
+    def test_single_acks_only(self):
+        self.channel = RecordingChannel()
+        coalescer = AckCoalescer(self.channel, 3, multiple=False)
+        for tag in [1, 2, 3]:
+            coalescer.delivered(tag)
+            coalescer.ack(tag)
+        self.assertEqual(self.channel.acks, [(1, False), (2, False),
+                                             (3, False)])
+
+    def test_skip(self):
+        coalescer = self.get_coalescer(batch_size=3, tags=[1, 2, 3, 4, 5])
+        coalescer.ack(1)
+        coalescer.skip(2)
+        coalescer.ack(3)
+        coalescer.ack(4)
+        # acking 4 with multiple=True would also ack 2
+        self.assertEqual(self.channel.acks, [(1, True), (3, False),
+                                             (4, False)])
+        coalescer.ack(5)
+        coalescer.flush()
+        self.assertEqual(self.channel.acks[3:], [(5, False)])
+
+    def test_reject(self):
+        coalescer = self.get_coalescer(batch_size=3, tags=[1, 2, 3, 4])
+        coalescer.reject(1, True)
+        coalescer.ack(2)
+        coalescer.reject(3, False)
+        coalescer.ack(4)
+        coalescer.flush()
+        self.assertEqual(self.channel.rejects, [(1, True), (3, False)])
+        # rejected messages are settled, so multiple acks are still safe
+        self.assertEqual(self.channel.acks, [(4, True)])
+
+    def test_unknown_delivery(self):
+        coalescer = self.get_coalescer(batch_size=3, tags=[1])
+        coalescer.ack(7)
+        self.assertEqual(self.channel.acks, [(7, False)])
+
+    @inlineCallbacks
+    def test_consumer_not_acked(self):
+        worker = get_stubbed_worker(Worker)
+        broker = worker._amqp_client.broker
+        results = [True, False, True]
+        consumer = yield worker.consume(
+            'test.routing.key', lambda msg: results.pop(0), ack_batch_size=2)
+        for i in range(3):
+            broker.basic_publish('vumi', 'test.routing.key',
+                                 fake_amq_message({"key": i}).content)
+        yield broker.wait_delivery()
+        [(_dtag, _queue)] = consumer.channel.unacked
+
+
+class TestConsumerFailures(TestCase):
+
+    def setUp(self):
+        self.worker = get_stubbed_worker(Worker)
+        self.broker = self.worker._amqp_client.broker
+        self.attempts = []
+        self.patch(service.log, 'err', lambda *a, **kw: None)
+
+    def publish(self, **fields):
+        self.broker.basic_publish('vumi', 'test.routing.key',
+                                  fake_amq_message(fields).content)
+
+    @inlineCallbacks
+    def test_failed_message_requeued_once(self):
+        def consume(msg):
+            self.attempts.append(msg['key'])
+            raise ValueError("bad message")
+
+        consumer = yield self.worker.consume('test.routing.key', consume,
+                                             concurrency=2)
+        self.publish(key='a')
+        yield self.broker.kick_delivery()
+        self.assertEqual(self.attempts, ['a', 'a'])
+        self.assertEqual(consumer.channel.unacked, [])
+        queue = self.broker.queues['test.routing.key']
+        self.assertEqual(queue.messages, [])
+        self.assertEqual(queue.unacked_messages, {})
+
+    @inlineCallbacks
+    def test_temporary_error_requeued(self):
+        def consume(msg):
+            self.attempts.append(msg['key'])
+            if len(self.attempts) < 3:
+                raise TemporaryError("try again")
+
+        consumer = yield self.worker.consume('test.routing.key', consume)
+        self.publish(key='a')
+        yield self.broker.kick_delivery()
+        self.assertEqual(self.attempts, ['a', 'a', 'a'])
+        self.assertEqual(consumer.channel.unacked, [])
+        queue = self.broker.queues['test.routing.key']
+        self.assertEqual(queue.messages, [])
+        self.assertEqual(queue.unacked_messages, {})
+
+
+class TestLocalDelivery(TestCase):
+
+    def setUp(self):
+        self.worker = get_stubbed_worker(Worker)
+        self.worker.local_bus = LocalMessageBus()
+        self.broker = self.worker._amqp_client.broker
+
+    def bind_locally(self, publisher, routing_key, *queue_names):
+        publisher.binding_cache.bindings = {
+            routing_key: set(('queue', name) for name in queue_names)}
+
+    @inlineCallbacks
+    def test_delivered_locally(self):
+        consumed = []
+        yield self.worker.consume('test.routing.key', consumed.append)
+        publisher = yield self.worker.publish_to('test.routing.key')
+        self.bind_locally(publisher, 'test.routing.key', 'test.routing.key')
+        yield publisher.publish_message(Message(key='a'))
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual([Message(key='a')], consumed)
+        self.assertEqual(
+            self.broker.get_dispatched('vumi', 'test.routing.key'), [])
+
+    @inlineCallbacks
+    def test_unknown_bindings_published_over_amqp(self):
+        consumed = []
+        yield self.worker.consume('test.routing.key', consumed.append)
+        publisher = yield self.worker.publish_to('test.routing.key')
+        yield publisher.publish_message(Message(key='a'))
+        yield self.broker.wait_delivery()
+        self.assertEqual([Message(key='a')], consumed)
+        self.assertEqual([Message(key='a')], self.broker.get_messages(
+            'vumi', 'test.routing.key'))
+
+    @inlineCallbacks
+    def test_broker_only_queue_published_over_amqp(self):
+        consumed = []
+        yield self.worker.consume('test.routing.key', consumed.append)
+        self.broker.queue_declare('tap')
+        self.broker.queue_bind('tap', 'vumi', 'test.routing.key')
+        publisher = yield self.worker.publish_to('test.routing.key')
+        self.bind_locally(
+            publisher, 'test.routing.key', 'test.routing.key', 'tap')
+        yield publisher.publish_message(Message(key='a'))
+        yield self.broker.wait_delivery()
+        self.assertEqual([Message(key='a')], consumed)
+        [tapped] = self.broker.queues['tap'].messages
+        self.assertEqual(Message(key='a'), Message.from_json(
+            tapped['content']))
+
+    @inlineCallbacks
+    def test_failure_published_over_amqp(self):
+        consumed = []
+
+        def consume(msg):
+            consumed.append(msg['key'])
+            if len(consumed) == 1:
+                msg['key'] = 'changed'
+                raise ValueError("bad message")
+
+        yield self.worker.consume('test.routing.key', consume)
+        publisher = yield self.worker.publish_to('test.routing.key')
+        self.bind_locally(publisher, 'test.routing.key', 'test.routing.key')
+        yield publisher.publish_message(Message(key='a'))
+        yield deferLater(reactor, 0, lambda: None)
+        yield self.broker.wait_delivery()
+        # Nothing went to the exchange, the message went straight to
+        # the consumer's queue and was consumed from there.
+        self.assertEqual(
+            self.broker.get_dispatched('vumi', 'test.routing.key'), [])
+        [msg] = self.broker.get_messages('', 'test.routing.key')
+        self.assertEqual(msg['key'], 'a')
+        self.assertEqual(consumed, ['a', 'a'])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    @inlineCallbacks
+    def test_routing_key_checked(self):
+        yield self.worker.consume('test.routing.key', lambda msg: None)
+        publisher = yield self.worker.publish_to('test.routing.key')
+        d = publisher.publish_message(Message(key='a'),
+                                      routing_key='Test.Routing.Key')
+        yield self.assertFailure(d, RoutingKeyError)
+
+
 class LoadableTestWorker(Worker):
     def poke(self):
         return "poke"
@@ -80,3 +968,125 @@ class TestWorkerCreator(TestCase):
                                   LoadableTestWorker.__name__)
         worker = creator.create_worker(worker_class, {})
         self.assertEquals("poke", worker.poke())
+
+
+class TestSpecCache(TestCase):
+    def setUp(self):
+        self.cache_dir = self.mktemp()
+        # Use a copy of the spec so we don't disturb the shared SPECS.
+        self.specfile = os.path.abspath(self.mktemp())
+        shutil.copy(vumi_resource_path("amqp-spec-0-8.xml"), self.specfile)
+
+    def tearDown(self):
+        SPECS.pop(self.specfile, None)
+
+    def test_cache_written(self):
+        spec = get_spec(self.specfile, self.cache_dir)
+        self.assertTrue(os.path.exists(
+            spec_cache_path(self.specfile, self.cache_dir)))
+        self.assertTrue(hasattr(spec.klass, 'basic_qos'))
+
+    def test_cache_loaded(self):
+        parsed = get_spec(self.specfile, self.cache_dir)
+        SPECS.pop(self.specfile)
+
+        def load(specfile):
+            self.fail("Spec parsed instead of loaded from the cache.")
+        self.patch(service.txamqp.spec, 'load', load)
+
+        cached = get_spec(self.specfile, self.cache_dir)
+        self.assertFalse(cached is parsed)
+        self.assertEqual(self.specfile, cached.file)
+        self.assertEqual(parsed.klass.basic_qos.__doc__,
+                         cached.klass.basic_qos.__doc__)
+        qos = cached.classes.byname['basic'].methods.byname['qos']
+        self.assertEqual(['prefetch size', 'prefetch count', 'global'],
+                         [f.name for f in qos.fields])
+
+    def test_cache_keyed_by_hash(self):
+        path = spec_cache_path(self.specfile, self.cache_dir)
+        with open(self.specfile, 'a') as f:
+            f.write('\n')
+        self.assertNotEqual(path,
+                            spec_cache_path(self.specfile, self.cache_dir))
+
+    def test_unreadable_cache(self):
+        os.makedirs(self.cache_dir)
+        with open(spec_cache_path(self.specfile, self.cache_dir), 'wb') as f:
+            f.write('not a pickle')
+        spec = get_spec(self.specfile, self.cache_dir)
+        self.assertTrue(hasattr(spec.klass, 'basic_qos'))
+        self.assertEqual(1, len(self.flushLoggedErrors()))
+
+    def test_cache_dir_private(self):
+        get_spec(self.specfile, self.cache_dir)
+        self.assertEqual(0, os.stat(self.cache_dir).st_mode & 0077)
+
+    def test_shared_cache_dir_ignored(self):
+        get_spec(self.specfile, self.cache_dir)
+        SPECS.pop(self.specfile)
+        os.chmod(self.cache_dir, 0777)
+        parsed = []
+        load_spec = service.txamqp.spec.load
+
+        def load(specfile):
+            parsed.append(specfile)
+            return load_spec(specfile)
+        self.patch(service.txamqp.spec, 'load', load)
+
+        get_spec(self.specfile, self.cache_dir)
+        self.assertEqual([self.specfile], parsed)
+
+    def test_shared_cache_file_ignored(self):
+        get_spec(self.specfile, self.cache_dir)
+        SPECS.pop(self.specfile)
+        os.chmod(spec_cache_path(self.specfile, self.cache_dir), 0666)
+        spec = get_spec(self.specfile, self.cache_dir)
+        self.assertTrue(hasattr(spec.klass, 'basic_qos'))
+        self.assertEqual(1, len(self.flushLoggedErrors(VumiError)))
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def time(self):
+        return self.now
+
+
+class TestStartupTimer(TestCase):
+    def setUp(self):
+        self.timer = StartupTimer()
+        self.timer.clock = FakeClock()
+
+    def test_report(self):
+        self.timer.start('import')
+        self.timer.clock.now = 0.5
+        self.timer.stop('import')
+        self.timer.start('startWorker')
+        self.timer.clock.now = 0.75
+        self.timer.stop('startWorker')
+        self.assertEqual(0.5, self.timer.duration('import'))
+        self.assertEqual("Startup times: import 0.500s,"
+                         " startWorker 0.250s (total 0.750s)",
+                         self.timer.report())
+
+    def test_unfinished_phase(self):
+        self.timer.start('amqp connect')
+        self.assertEqual(None, self.timer.duration('amqp connect'))
+        self.assertEqual("Startup times:  (total 0.000s)",
+                         self.timer.report())
+
+    @inlineCallbacks
+    def test_worker_startup(self):
+        started = []
+        worker = Worker({}, {})
+        worker.startWorker = lambda: started.append(True)
+        worker.startup_timer = self.timer
+        self.timer.start('amqp connect')
+        self.timer.clock.now = 1
+        yield worker._amqp_connected(get_fake_amq_client())
+        self.assertEqual([True], started)
+        self.assertEqual(1, self.timer.duration('amqp connect'))
+        self.assertEqual(0, self.timer.duration('startWorker'))
+        self.assertEqual(None, worker.startup_timer)
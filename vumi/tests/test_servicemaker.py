@@ -27,6 +27,11 @@ class VumiOptionsTestCase(OptionsTestCase):
         self.assertEqual(VumiOptions.default_vumi_options,
                          options.vumi_options)
 
+    def test_binding_checks_off_by_default(self):
+        options = VumiOptions()
+        options.parseOptions([])
+        self.assertEqual(None, options.vumi_options['management-url'])
+
     def test_override(self):
         options = VumiOptions()
         options.parseOptions(['--hostname', 'blah',
@@ -139,6 +144,18 @@ class VumiWorkerServiceMakerTestCase(OptionsTestCase):
         worker = maker.makeService(options)
         self.assertEqual({'transport_name': 'sphex'}, worker.config)
 
+    def test_make_worker_records_startup_times(self):
+        self.mk_config_file('worker', ["transport_name: sphex"])
+        options = StartWorkerOptions()
+        options.parseOptions(['--worker-class', 'vumi.demos.words.EchoWorker',
+                              '--config', self.config_file['worker'],
+                              ])
+        maker = VumiWorkerServiceMaker()
+        worker = maker.makeService(options)
+        self.assertEqual(['import', 'spec load'],
+                         worker.startup_timer.phases)
+        self.assertNotEqual(None, worker.startup_timer.duration('import'))
+
     def test_make_worker_with_sentry(self):
         services = []
         dummy_service = DummyService()
@@ -11,7 +11,8 @@ from twisted.internet.protocol import Protocol, Factory
 
 from vumi.utils import (normalize_msisdn, vumi_resource_path, cleanup_msisdn,
                         get_operator_name, http_request, http_request_full,
-                        get_first_word, redis_from_config)
+                        get_first_word, redis_from_config, LRUCache,
+                        OperatorPrefixTrie, get_partition)
 from vumi.persist.fake_redis import FakeRedis
 from vumi.tests.utils import import_skip
 
@@ -54,6 +55,93 @@ class UtilsTestCase(TestCase):
         self.assertEqual('VODACOM', get_operator_name('27821234567', mapping))
         self.assertEqual('UNKNOWN', get_operator_name('27801234567', mapping))
 
+    def test_operator_prefix_trie(self):
+        trie = OperatorPrefixTrie({
+            27: {2782: 'VODACOM', 2783: 'MTN'},
+            '2771': {'27710': 'MTN', '27711': 'VODACOM'},
+            '2772': 'VODACOM',
+            })
+        self.assertEqual('MTN', trie.get_operator_name('27831234567'))
+        self.assertEqual('VODACOM', trie.get_operator_name('27821234567'))
+        self.assertEqual('UNKNOWN', trie.get_operator_name('27801234567'))
+        self.assertEqual('VODACOM', trie.get_operator_name('27711234567'))
+        self.assertEqual('UNKNOWN', trie.get_operator_name('27718234567'))
+        self.assertEqual('VODACOM', trie.get_operator_name('27721234567'))
+        self.assertEqual('UNKNOWN', trie.get_operator_name('26831234567'))
+        self.assertEqual('UNKNOWN', trie.get_operator_name(''))
+        self.assertEqual(
+            ['MTN', 'VODACOM', 'MTN'],
+            trie.get_operator_names(
+                ['27831234567', '27821234567', '27831234567']))
+
+    def test_operator_prefix_trie_uncached(self):
+        trie = OperatorPrefixTrie({'2783': 'MTN'}, cache_size=0)
+        self.assertEqual('MTN', trie.get_operator_name('27831234567'))
+        self.assertEqual('UNKNOWN', trie.get_operator_name('27821234567'))
+
+    def test_operator_prefix_trie_operator_number(self):
+        trie = OperatorPrefixTrie({'27': {'2782': 'VODACOM'}})
+        numbers = {'VODACOM': '2782000'}
+        self.assertEqual('2782000', trie.get_operator_number(
+            '+27821234567', '27', numbers))
+        self.assertEqual('2782000', trie.get_operator_number(
+            '0821234567', '27', numbers))
+        self.assertEqual(None, trie.get_operator_number(
+            '0831234567', '27', numbers))
+
+    def test_lru_cache(self):
+        cache = LRUCache(4)
+        for i in range(4):
+            cache[i] = str(i)
+        self.assertEqual(4, len(cache))
+        self.assertEqual('0', cache.get(0))
+        cache[4] = '4'
+        cache[5] = '5'
+        self.assertTrue(len(cache) <= 4)
+        self.assertTrue(0 in cache)
+        self.assertTrue(4 in cache)
+        self.assertTrue(5 in cache)
+        self.assertFalse(1 in cache)
+        self.assertEqual(None, cache.get(1))
+        self.assertEqual('x', cache.get(2, 'x'))
+        self.assertEqual('5', cache.pop(5))
+        self.assertFalse(5 in cache)
+
+    def test_lru_cache_size_bound(self):
+        # Odd sizes leave one entry unused, because the generations are
+        # the same size.
+        for max_size, full_size in [(0, 0), (1, 1), (2, 2), (3, 2), (4, 4),
+                                    (5, 4), (100, 100)]:
+            cache = LRUCache(max_size)
+            for i in range(300):
+                cache[i] = str(i)
+                cache.get(i // 2)
+                self.assertTrue(len(cache) <= max_size)
+            cache.clear()
+            for i in range(300):
+                cache[i] = str(i)
+            self.assertEqual(full_size, len(cache))
+
+    def test_get_partition(self):
+        keys = ['+2776%07d' % (i,) for i in range(1000)]
+        partitions = [get_partition(key, 4) for key in keys]
+        self.assertEqual(partitions, [get_partition(key, 4) for key in keys])
+        for partition in range(4):
+            self.assertTrue(200 < partitions.count(partition) < 300)
+        self.assertEqual(get_partition(u'+27761234567', 4),
+                         get_partition('+27761234567', 4))
+        self.assertEqual(0, get_partition(None, 1))
+
+    def test_get_partition_moves_few_keys(self):
+        keys = ['+2776%07d' % (i,) for i in range(1000)]
+        moved = 0
+        for key in keys:
+            old, new = get_partition(key, 4), get_partition(key, 5)
+            if old != new:
+                self.assertEqual(4, new)
+                moved += 1
+        self.assertTrue(150 < moved < 250)
+
     def test_get_first_word(self):
         self.assertEqual('KEYWORD',
                          get_first_word('KEYWORD rest of the message'))
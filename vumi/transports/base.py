@@ -13,7 +13,8 @@ from vumi.errors import ConfigError
 from vumi.message import TransportUserMessage, TransportEvent
 from vumi.service import Worker
 from vumi.transports.failures import FailureMessage
-from vumi.middleware import MiddlewareStack, setup_middlewares_from_config
+from vumi.middleware import (MiddlewareStack, setup_middlewares_from_config,
+                             setup_middleware_metrics_from_config)
 
 
 class Transport(Worker):
@@ -112,7 +113,9 @@ class Transport(Worker):
         middleware setup.
         """
         middlewares = yield setup_middlewares_from_config(self, self.config)
-        self._middlewares = MiddlewareStack(middlewares)
+        metrics = yield setup_middleware_metrics_from_config(
+            self, self.config)
+        self._middlewares = MiddlewareStack(middlewares, metrics)
 
     def teardown_middleware(self):
         """
@@ -133,16 +136,18 @@ class Transport(Worker):
             log.msg("Consumer already exists, not restarting.")
             return
 
+        # `concurrent_sends` only limits the number of unacked messages.
+        # Outbound messages are handled one at a time unless
+        # `outbound_concurrency` says otherwise, because transports may
+        # rely on sending messages in order.
+        concurrency = int(self.config.get('outbound_concurrency', 1))
+
         self.message_consumer = yield self.consume(
             self.get_rkey('outbound'), self._process_message,
-            message_class=TransportUserMessage)
+            message_class=TransportUserMessage, concurrency=concurrency,
+            prefetch_count=self.concurrent_sends)
         self._consumers.append(self.message_consumer)
 
-        # Apply concurrency throttling if we need to.
-        if self.concurrent_sends is not None:
-            yield self.message_consumer.channel.basic_qos(
-                0, int(self.concurrent_sends), False)
-
     def _teardown_message_consumer(self):
         if self.message_consumer is None:
             log.msg("Consumer does not exist, not stopping.")
@@ -13,7 +13,10 @@ from vumi.persist.txredis_manager import TxRedisManager
 
 
 class FailureMessage(TransportMessage):
+    __slots__ = ()
+
     MESSAGE_TYPE = 'failure_message'
+    REQUIRED_FIELDS = ('message', 'failure_code', 'reason')
 
     FC_UNSPECIFIED, FC_PERMANENT, FC_TEMPORARY = (None, 'permanent',
                                                   'temporary')
@@ -22,14 +25,6 @@ class FailureMessage(TransportMessage):
         fields = super(FailureMessage, self).process_fields(fields)
         return fields
 
-    def validate_fields(self):
-        super(FailureMessage, self).validate_fields()
-        self.assert_field_present(
-            'message',
-            'failure_code',
-            'reason',
-            )
-
 
 class FailureCodeException(Exception):
     """Base class for exceptions encoding failure types."""
@@ -1,16 +1,17 @@
 # -*- test-case-name: vumi.transports.httprpc.tests.test_httprpc -*-
 
 import json
+from bisect import bisect_left
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred
 from twisted.internet import reactor
-from twisted.internet.task import LoopingCall
 from twisted.python import log
 from twisted.web import http
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 
 from vumi.transports.base import Transport
+from vumi.message import TransportUserMessage
 
 
 class HttpRpcHealthResource(Resource):
@@ -26,6 +27,29 @@ class HttpRpcHealthResource(Resource):
         return self.transport.get_health_response()
 
 
+class RequestWaitTimes(object):
+    """Histogram of how long requests were pending for.
+
+    :param list buckets:
+        Upper bounds, in seconds, of the histogram's buckets. Requests
+        that took longer than the last bound are counted in a final
+        ``+Inf`` bucket.
+    """
+
+    BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 240)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def record(self, wait_time):
+        self.counts[bisect_left(self.buckets, wait_time)] += 1
+
+    def as_dict(self):
+        labels = ['%g' % (bound,) for bound in self.buckets] + ['+Inf']
+        return dict(zip(labels, self.counts))
+
+
 class HttpRpcResource(Resource):
     isLeaf = True
 
@@ -55,9 +79,21 @@ class HttpRpcTransport(Transport):
 
     Because a reply from an application worker is needed before the HTTP
     response can be completed, a reply needs to be returned to the same
-    transport worker that generated the inbound message. This means that
-    currently there many only be one transport worker for each instance
-    of this transport of a given name.
+    transport worker that generated the inbound message. Without an
+    `instance_id` there may only be one transport worker for each
+    instance of this transport of a given name.
+
+    Several workers with the same transport name can run behind a load
+    balancer if each is given a different `instance_id`. Inbound
+    messages are tagged with the instance id in their
+    `transport_metadata`, which replies carry back. Each worker consumes
+    replies for itself from ``<transport_name>.outbound.instance.<id>``
+    as well as the shared ``<transport_name>.outbound`` queue, and
+    forwards replies it takes from the shared queue to the instance
+    they belong to. An instance queue is deleted when its worker stops,
+    so replies forwarded to a worker that has gone are dropped by the
+    broker. They are only logged if routing key checks are enabled with
+    the `management-url` vumi option.
 
     Takes the following configuration parameters:
 
@@ -67,14 +103,14 @@ class HttpRpcTransport(Transport):
         The port to listen for requests on, defaults to `0`.
     :param str health_path:
         The path to listen for downstream health checks on
-        (useful with HAProxy)
+        (useful with HAProxy). The health check reports the number of
+        pending requests, the number of requests dropped by the client
+        before they were answered, and a histogram of how long answered
+        requests were pending for.
     :param int request_cleanup_interval:
-        How often should we actively look for old connections that should
-        manually be timed out. Anything less than `1` disables the request
-        cleanup meaning that all request objects will be kept in memory until
-        the server is restarted, regardless if the remote side has dropped
-        the connection or not.
-        Defaults to 5 seconds.
+        Anything less than `1` disables request timeouts, meaning that
+        requests are kept in memory until they are answered or the remote
+        side drops the connection. Any other value is ignored.
     :param int request_timeout:
         How long should we wait for the remote side generating the response
         for this synchronous operation to come back. Any connection that has
@@ -89,9 +125,14 @@ class HttpRpcTransport(Transport):
     :param bool noisy:
         Defaults to `False` set to `True` to make this transport log
         verbosely.
+    :param str instance_id:
+        Identifies this worker among the workers with the same transport
+        name. Defaults to `None`, for a single worker.
     """
     content_type = 'text/plain'
 
+    INSTANCE_METADATA_KEY = 'http_rpc_instance'
+
     def validate_config(self):
         self.web_path = self.config['web_path']
         self.web_port = int(self.config['web_port'])
@@ -104,6 +145,9 @@ class HttpRpcTransport(Transport):
 
         self.gc_requests_interval = int(
             self.config.get('request_cleanup_interval', 5))
+        self.instance_id = self.config.get('instance_id')
+        if self.instance_id is not None:
+            self.instance_id = str(self.instance_id).lower()
 
     def get_transport_url(self, suffix=''):
         """
@@ -119,10 +163,22 @@ class HttpRpcTransport(Transport):
     @inlineCallbacks
     def setup_transport(self):
         self._requests = {}
-        self.request_gc = LoopingCall(self.manually_close_requests)
+        # request_id -> DelayedCall. The reactor keeps these in a heap,
+        # so scheduling and cancelling a timeout is O(log n).
+        self._request_timeouts = {}
+        self.request_wait_times = RequestWaitTimes()
+        self.dropped_requests = 0
         self.clock = self.get_clock()
-        self.request_gc.clock = self.clock
-        self.request_gc.start(self.gc_requests_interval)
+
+        self._instance_publishers = {}
+        if self.instance_id is not None:
+            # The queue goes when this worker does, so replies for it
+            # don't pile up after its requests are gone.
+            self.instance_consumer = yield self.consume(
+                self.get_instance_rkey(self.instance_id),
+                self._process_message, message_class=TransportUserMessage,
+                durable=False, auto_delete=True)
+            self._consumers.append(self.instance_consumer)
 
         # start receipt web resource
         self.web_resource = yield self.start_web_resources(
@@ -135,8 +191,10 @@ class HttpRpcTransport(Transport):
     @inlineCallbacks
     def teardown_transport(self):
         yield self.web_resource.loseConnection()
-        if self.request_gc.running:
-            self.request_gc.stop()
+        for timeout in self._request_timeouts.values():
+            if timeout.active():
+                timeout.cancel()
+        self._request_timeouts.clear()
 
     def get_clock(self):
         """
@@ -144,25 +202,114 @@ class HttpRpcTransport(Transport):
         """
         return reactor
 
-    def manually_close_requests(self):
-        for request_id, (timestamp, request) in self._requests.items():
-            if timestamp < self.clock.seconds() - self.request_timeout:
-                self.close_request(request_id)
+    def get_instance_rkey(self, instance_id):
+        # Instance ids read back from message metadata are unicode, but
+        # publishers need routing keys that are byte strings.
+        if isinstance(instance_id, unicode):
+            instance_id = instance_id.encode('utf8')
+        return self.get_rkey('outbound.instance.%s' % (instance_id,))
+
+    def publish_message(self, **kw):
+        if self.instance_id is not None:
+            metadata = dict(kw.get('transport_metadata') or {})
+            metadata[self.INSTANCE_METADATA_KEY] = self.instance_id
+            kw['transport_metadata'] = metadata
+        return super(HttpRpcTransport, self).publish_message(**kw)
+
+    def _process_message(self, message):
+        instance_id = message['transport_metadata'].get(
+            self.INSTANCE_METADATA_KEY)
+        if instance_id is None or instance_id == self.instance_id:
+            return super(HttpRpcTransport, self)._process_message(message)
+        return self.forward_to_instance(instance_id, message)
+
+    def get_instance_publisher(self, instance_id):
+        """
+        Return a Deferred that fires with the publisher for the worker
+        with the given `instance_id`, or None if it couldn't be created.
+
+        The Deferred creating each publisher is cached, so concurrent
+        forwards to an instance share one publisher. Callers are handed
+        Deferreds of their own, because yielding the cached one would
+        take the publisher out of it.
+        """
+        d = self._instance_publishers.get(instance_id)
+        if d is None:
+            d = self.publish_to(self.get_instance_rkey(instance_id))
+            d.addErrback(self._instance_publisher_failed, instance_id)
+            self._instance_publishers[instance_id] = d
+        waiter = Deferred()
+        d.addCallback(self._pass_instance_publisher, waiter)
+        return waiter
+
+    def _pass_instance_publisher(self, publisher, waiter):
+        waiter.callback(publisher)
+        return publisher
+
+    def _instance_publisher_failed(self, failure, instance_id):
+        # Forget it, so that the next forward tries again.
+        del self._instance_publishers[instance_id]
+        log.err(failure, "Failed to publish to instance %s" % (instance_id,))
+        return None
+
+    @inlineCallbacks
+    def forward_to_instance(self, instance_id, message):
+        """
+        Forward `message` to the worker with the given `instance_id`,
+        which holds the request it replies to.
+        """
+        self.emit("Forwarding %s to instance %s" % (
+            message['message_id'], instance_id))
+        publisher = yield self.get_instance_publisher(instance_id)
+        if publisher is None:
+            return
+        try:
+            yield publisher.publish_message(message)
+        except Exception:
+            # Publishing only fails for an instance that has gone away
+            # if routing keys are checked. Its request is gone too.
+            log.err(None, "Failed to forward %s to instance %s" % (
+                message['message_id'], instance_id))
 
     def close_request(self, request_id):
         self.emit('Timing out %s' % (request_id,))
+        self._request_timeouts.pop(request_id, None)
         self.finish_request(request_id, self.request_timeout_body,
             self.request_timeout_status_code)
 
     def get_health_response(self):
         return json.dumps({
-            'pending_requests': len(self._requests)
+            'pending_requests': len(self._requests),
+            'dropped_requests': self.dropped_requests,
+            'request_wait_times': self.request_wait_times.as_dict(),
         })
 
     def set_request(self, request_id, request_object, timestamp=None):
         if timestamp is None:
             timestamp = self.clock.seconds()
+        self._cancel_timeout(request_id)
         self._requests[request_id] = (timestamp, request_object)
+        if self.gc_requests_interval >= 1:
+            delay = max(
+                timestamp + self.request_timeout - self.clock.seconds(), 0)
+            self._request_timeouts[request_id] = self.clock.callLater(
+                delay, self.close_request, request_id)
+        request_object.notifyFinish().addErrback(
+            self._request_lost, request_id, request_object)
+
+    def _request_lost(self, _failure, request_id, request_object):
+        self.emit('Connection lost for %s' % (request_id,))
+        if self.get_request(request_id) is not request_object:
+            # Already answered, or replaced by a request with the same id.
+            return
+        self._cancel_timeout(request_id)
+        del self._requests[request_id]
+        self.dropped_requests += 1
+
+    def _cancel_timeout(self, request_id):
+        timeout = self._request_timeouts.pop(request_id, None)
+        if timeout is not None and timeout.active():
+            timeout.cancel()
 
     def get_request(self, request_id):
         if request_id in self._requests:
@@ -170,7 +317,10 @@ class HttpRpcTransport(Transport):
             return request
 
     def remove_request(self, request_id):
-        del self._requests[request_id]
+        self._cancel_timeout(request_id)
+        if request_id in self._requests:
+            timestamp, _ = self._requests.pop(request_id)
+            self.request_wait_times.record(self.clock.seconds() - timestamp)
 
     def emit(self, msg):
         if self.noisy:
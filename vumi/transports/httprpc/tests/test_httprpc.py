@@ -1,6 +1,6 @@
 import json
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
 from twisted.internet.task import Clock
 
 from vumi.utils import http_request, http_request_full
@@ -25,6 +25,15 @@ class OkTransport(HttpRpcTransport):
                 )
 
 
+class StubRequest(object):
+
+    def __init__(self):
+        self.finished = Deferred()
+
+    def notifyFinish(self):
+        return self.finished
+
+
 class TestTransport(TransportTestCase):
 
     transport_class = OkTransport
@@ -51,9 +60,27 @@ class TestTransport(TransportTestCase):
         result = yield http_request(self.transport_url + "health", "",
                                     method='GET')
         self.assertEqual(json.loads(result), {
-            'pending_requests': 0
+            'pending_requests': 0,
+            'dropped_requests': 0,
+            'request_wait_times': dict.fromkeys(
+                ['0.1', '0.5', '1', '2', '5', '10', '30', '60', '120', '240',
+                 '+Inf'], 0),
         })
 
+    @inlineCallbacks
+    def test_health_wait_times(self):
+        d = http_request(self.transport_url + "foo", '', method='GET')
+        [msg] = yield self.wait_for_dispatched_messages(1)
+        self.clock.advance(1.5)
+        rep = TransportUserMessage(**msg.payload).reply("OK")
+        yield self.dispatch(rep)
+        yield d
+        result = yield http_request(self.transport_url + "health", "",
+                                    method='GET')
+        wait_times = json.loads(result)['request_wait_times']
+        self.assertEqual(1, wait_times['2'])
+        self.assertEqual(1, sum(wait_times.values()))
+
     @inlineCallbacks
     def test_inbound(self):
         d = http_request(self.transport_url + "foo", '', method='GET')
@@ -64,15 +91,121 @@ class TestTransport(TransportTestCase):
         yield self.dispatch(rep)
         response = yield d
         self.assertEqual(response, 'OK')
+        self.assertEqual([], self.clock.getDelayedCalls())
 
     @inlineCallbacks
     def test_timeout(self):
         d = http_request_full(self.transport_url + "foo", '', method='GET')
         [msg] = yield self.wait_for_dispatched_messages(1)
-        self.clock.advance(10.1)  # .1 second after timeout
+        self.clock.advance(9.9)
+        self.assertEqual(1, len(self.transport._requests))
+        self.clock.advance(0.2)  # .1 second after timeout
         response = yield d
         self.assertEqual(response.delivered_body, 'I am a teapot')
         self.assertEqual(response.code, 418)
+        self.assertEqual({}, self.transport._requests)
+        self.assertEqual({}, self.transport._request_timeouts)
+
+    @inlineCallbacks
+    def test_connection_lost(self):
+        d = http_request_full(self.transport_url + "foo", '', method='GET')
+        [msg] = yield self.wait_for_dispatched_messages(1)
+        [(_, request)] = self.transport._requests.values()
+        request.channel.transport.loseConnection()
+        yield self.assertFailure(d, Exception)
+        self.assertEqual({}, self.transport._requests)
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.assertEqual(1, self.transport.dropped_requests)
+        self.assertEqual(
+            0, sum(self.transport.request_wait_times.counts))
+
+    def test_set_request_replaces_timeout(self):
+        first, second = StubRequest(), StubRequest()
+        self.transport.set_request('1', first)
+        self.clock.advance(5)
+        self.transport.set_request('1', second)
+        [timeout] = self.clock.getDelayedCalls()
+        self.assertEqual(15, timeout.getTime())
+        # Losing the replaced request's connection leaves the new one.
+        first.finished.errback(Exception("Connection lost"))
+        self.assertTrue(self.transport.get_request('1') is second)
+        self.assertEqual(0, self.transport.dropped_requests)
+        second.finished.errback(Exception("Connection lost"))
+        self.assertEqual(None, self.transport.get_request('1'))
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.assertEqual(1, self.transport.dropped_requests)
+
+
+class TestTransportInstances(TransportTestCase):
+
+    transport_class = OkTransport
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestTransportInstances, self).setUp()
+        config = {
+            'web_path': "foo",
+            'web_port': 0,
+            'instance_id': 'A',
+            }
+        self.transport = yield self.get_transport(config)
+        self.transport_url = self.transport.get_transport_url()
+
+    @inlineCallbacks
+    def get_reply(self, content):
+        [msg] = yield self.wait_for_dispatched_messages(1)
+        tum = TransportUserMessage(**msg.payload)
+        returnValue(tum.reply(content))
+
+    @inlineCallbacks
+    def test_inbound_tagged_with_instance(self):
+        d = http_request(self.transport_url + "foo", '', method='GET')
+        rep = yield self.get_reply("OK")
+        self.assertEqual('a', rep['transport_metadata']['http_rpc_instance'])
+        yield self.dispatch(rep)
+        response = yield d
+        self.assertEqual(response, 'OK')
+
+    @inlineCallbacks
+    def test_reply_on_instance_queue(self):
+        d = http_request(self.transport_url + "foo", '', method='GET')
+        rep = yield self.get_reply("OK")
+        yield self.dispatch(rep, self.rkey('outbound.instance.a'))
+        response = yield d
+        self.assertEqual(response, 'OK')
+
+    def test_instance_queue_auto_deleted(self):
+        queue = self._amqp.queues[self.rkey('outbound.instance.a')]
+        self.assertTrue(queue.auto_delete)
+        self.assertFalse(self._amqp.queues[self.rkey('outbound')].auto_delete)
+
+    @inlineCallbacks
+    def test_reply_forwarded_to_other_instance(self):
+        rep = self.mkmsg_out(transport_metadata={'http_rpc_instance': 'b'},
+                             in_reply_to='1', content='OK')
+        yield self.dispatch(rep)
+        self.assertEqual([rep], self._amqp.get_messages(
+            'vumi', self.rkey('outbound.instance.b')))
+        self.assertEqual([], self.get_dispatched_events())
+
+    @inlineCallbacks
+    def test_concurrent_forwards_share_publisher(self):
+        d1 = self.transport.get_instance_publisher(u'b')
+        d2 = self.transport.get_instance_publisher(u'b')
+        publisher1 = yield d1
+        publisher2 = yield d2
+        self.assertTrue(publisher1 is not None)
+        self.assertTrue(publisher1 is publisher2)
+        publisher3 = yield self.transport.get_instance_publisher(u'b')
+        self.assertTrue(publisher1 is publisher3)
+
+    def test_instance_rkey(self):
+        self.assertEqual(self.rkey('outbound.instance.b'),
+                         self.transport.get_instance_rkey(u'b'))
+        self.assertEqual(self.rkey('outbound.instance.caf\xc3\xa9'),
+                         self.transport.get_instance_rkey(u'caf\xe9'))
+        self.assertEqual(self.rkey('outbound.instance.caf\xc3\xa9'),
+                         self.transport.get_instance_rkey('caf\xc3\xa9'))
 
 
 class JSONTransport(HttpRpcTransport):
@@ -7,7 +7,7 @@ from twisted.python import log
 from twisted.internet.defer import inlineCallbacks
 
 from vumi.transports.httprpc import HttpRpcTransport
-from vumi.utils import http_request_full, get_operator_name
+from vumi.utils import http_request_full, OperatorPrefixTrie
 
 
 class MediaEdgeGSMTransport(HttpRpcTransport):
@@ -46,7 +46,8 @@ class MediaEdgeGSMTransport(HttpRpcTransport):
         self._outbound_url = self.config.get('outbound_url')
         self._outbound_url_username = self.config.get('outbound_username', '')
         self._outbound_url_password = self.config.get('outbound_password', '')
-        self._operator_mappings = self.config.get('operator_mappings', {})
+        self._operator_prefixes = OperatorPrefixTrie(
+            self.config.get('operator_mappings', {}))
         return super(MediaEdgeGSMTransport, self).setup_transport()
 
     def get_field_values(self, request):
@@ -74,7 +75,7 @@ class MediaEdgeGSMTransport(HttpRpcTransport):
                 "PWD": self._outbound_url_password,
                 "SmsID": message['message_id'],
                 "PhoneNumber": msisdn,
-                "Operator": get_operator_name(msisdn, self._operator_mappings),
+                "Operator": self._operator_prefixes.get_operator_name(msisdn),
                 "SmsBody": message['content'],
             }
 
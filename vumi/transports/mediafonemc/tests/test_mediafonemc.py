@@ -66,7 +66,7 @@ class TestMediafoneTransport(TransportTestCase):
     def test_health(self):
         result = yield http_request(
             self.transport_url + "health", "", method='GET')
-        self.assertEqual(json.loads(result), {'pending_requests': 0})
+        self.assertEqual(json.loads(result)['pending_requests'], 0)
 
     @inlineCallbacks
     def test_inbound(self):
@@ -6,7 +6,7 @@ from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi import log
-from vumi.utils import get_operator_number
+from vumi.utils import OperatorPrefixTrie
 from vumi.transports.base import Transport
 from vumi.transports.smpp.clientserver.client import (
     EsmeTransceiverFactory, EsmeTransmitterFactory, EsmeReceiverFactory,
@@ -153,6 +153,9 @@ class SmppTransport(Transport):
         self.r_message_prefix = "message_json"
         self.throttled = False
 
+        self.operator_prefixes = OperatorPrefixTrie(
+            self.config.get('OPERATOR_PREFIX', {}))
+
         self.esme_callbacks = EsmeCallbacks(
             connect=self.esme_connected,
             disconnect=self.esme_disconnected,
@@ -399,9 +402,8 @@ class SmppTransport(Transport):
         text = message['content']
         continue_session = (
             message['session_event'] != TransportUserMessage.SESSION_CLOSE)
-        route = get_operator_number(to_addr,
+        route = self.operator_prefixes.get_operator_number(to_addr,
                 self.config.get('COUNTRY_CODE', ''),
-                self.config.get('OPERATOR_PREFIX', {}),
                 self.config.get('OPERATOR_NUMBER', {})) or from_addr
         return self.esme_client.submit_sm(
                 short_message=text.encode('utf-8'),
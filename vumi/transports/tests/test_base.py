@@ -84,3 +84,17 @@ class BaseTransportTestCase(TransportTestCase):
             ('mw1', 'outbound', self.transport_name),
             ('mw2', 'outbound', self.transport_name),
             ])
+
+    @inlineCallbacks
+    def test_concurrent_sends(self):
+        transport = yield self.get_transport({'concurrent_sends': 5})
+        consumer = transport.message_consumer
+        self.assertEqual(consumer.channel.qos_prefetch_count, 5)
+        self.assertEqual(consumer.concurrency, 1)
+
+    @inlineCallbacks
+    def test_outbound_concurrency(self):
+        transport = yield self.get_transport({'outbound_concurrency': 3})
+        consumer = transport.message_consumer
+        self.assertEqual(consumer.concurrency, 3)
+        self.assertEqual(consumer.channel.qos_prefetch_count, 3)
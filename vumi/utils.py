@@ -1,9 +1,10 @@
 # -*- test-case-name: vumi.tests.test_utils -*-
 
 import os.path
-import re
 import sys
 import base64
+import hashlib
+import struct
 import pkg_resources
 import warnings
 from functools import wraps
@@ -287,8 +288,9 @@ def get_first_word(content, delimiter=' '):
 
 
 def cleanup_msisdn(number, country_code):
-    number = re.sub('\+', '', number)
-    number = re.sub('^0', country_code, number)
+    number = number.replace('+', '')
+    if number.startswith('0'):
+        number = country_code + number[1:]
     return number
 
 
@@ -308,6 +310,184 @@ def get_operator_number(msisdn, country_code, mapping, numbers):
     return number
 
 
+class LRUCache(object):
+    """
+    A bounded mapping that keeps recently used entries.
+
+    Entries live in two generations. New and recently read entries go
+    into the current generation. When it fills up, it becomes the old
+    generation and the previous old generation is dropped, along with
+    any entry that hasn't been used since. Reading an entry from the old
+    generation moves it back to the current one.
+
+    This approximates least-recently-used eviction with plain dict
+    operations, which is much cheaper than keeping an exact usage order
+    in Python. Each generation holds up to half of `max_size` entries, so
+    there are never more than `max_size` entries. A cache smaller than
+    two entries only has the current generation.
+
+    :param int max_size:
+        Maximum number of entries to keep.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._generation_size = max(max_size // 2, 1)
+        self.clear()
+
+    def clear(self):
+        self._current = {}
+        self._old = {}
+
+    def __len__(self):
+        return len(self._current) + len(self._old)
+
+    def __contains__(self, key):
+        return key in self._current or key in self._old
+
+    def get(self, key, default=None):
+        try:
+            return self._current[key]
+        except KeyError:
+            pass
+        try:
+            value = self._old.pop(key)
+        except KeyError:
+            return default
+        self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if self.max_size < 1:
+            return
+        if len(self._current) >= self._generation_size:
+            self._old = self._current
+            self._current = {}
+            if len(self._old) >= self.max_size:
+                # Too small for two generations.
+                self._old = {}
+        self._old.pop(key, None)
+        self._current[key] = value
+
+    def pop(self, key, default=None):
+        value = self._current.pop(key, default)
+        return self._old.pop(key, value)
+
+
+class OperatorPrefixTrie(object):
+    """
+    Look up the operator for an MSISDN by longest matching prefix.
+
+    The trie is built once from a nested prefix mapping in the form
+    used by :func:`get_operator_name` and the ``OPERATOR_PREFIX`` config
+    below. Nested prefixes are expected to extend the prefix they are
+    nested under. An MSISDN that matches a nested mapping's prefix but
+    none of its entries gets the `default` operator, as it does with
+    :func:`get_operator_name`. Where prefixes overlap, the longest one
+    wins.
+
+    Recent lookups are kept in an :class:`LRUCache`.
+
+    :param dict mapping:
+        Nested mapping from MSISDN prefixes to operator names.
+    :param int cache_size:
+        Number of lookups to cache. Set to 0 to disable caching.
+    :param str default:
+        Operator name returned for MSISDNs that match no prefix.
+    """
+
+    def __init__(self, mapping, cache_size=10000, default='UNKNOWN'):
+        self.default = default
+        # Each node is a [children, operator] pair, where children maps
+        # the next digit to a node and operator is None unless a prefix
+        # ends here.
+        self._root = [{}, None]
+        self._add_mapping('', mapping)
+        self._cache = LRUCache(cache_size) if cache_size else None
+
+    def _add_mapping(self, parent_prefix, mapping):
+        for key, value in mapping.items():
+            prefix = str(key)
+            if not prefix.startswith(parent_prefix):
+                # get_operator_name() could never reach this entry.
+                continue
+            if isinstance(value, dict):
+                self._add_prefix(prefix, self.default)
+                self._add_mapping(prefix, value)
+            else:
+                self._add_prefix(prefix, value)
+
+    def _add_prefix(self, prefix, operator):
+        node = self._root
+        for digit in prefix:
+            node = node[0].setdefault(digit, [{}, None])
+        if node[1] is None or operator != self.default:
+            node[1] = operator
+
+    def _lookup(self, msisdn):
+        operator = self.default
+        node = self._root
+        for digit in msisdn:
+            node = node[0].get(digit)
+            if node is None:
+                break
+            if node[1] is not None:
+                operator = node[1]
+        return operator
+
+    def get_operator_name(self, msisdn):
+        """Return the operator name for `msisdn`."""
+        if self._cache is None:
+            return self._lookup(msisdn)
+        operator = self._cache.get(msisdn)
+        if operator is None:
+            operator = self._lookup(msisdn)
+            self._cache[msisdn] = operator
+        return operator
+
+    def get_operator_names(self, msisdns):
+        """Return a list of operator names, one for each of `msisdns`."""
+        return [self.get_operator_name(msisdn) for msisdn in msisdns]
+
+    def get_operator_number(self, msisdn, country_code, numbers):
+        """
+        Return the entry in `numbers` for the operator of `msisdn`, or
+        `None` if there isn't one. `msisdn` is cleaned up with
+        :func:`cleanup_msisdn` first.
+        """
+        operator = self.get_operator_name(cleanup_msisdn(msisdn, country_code))
+        return numbers.get(operator)
+
+
+def get_partition(key, partitions):
+    """
+    Return the partition, from 0 to `partitions` - 1, that `key` belongs in.
+
+    This is a jump consistent hash (Lamping and Veach, 2014) of the MD5
+    of `key`. When the number of partitions grows from N to N + 1, only
+    about 1 / (N + 1) of keys move, and they all move to the new
+    partition.
+
+    :param key:
+        A string, or None (which is treated as an empty string).
+    :param int partitions:
+        The number of partitions.
+    """
+    if key is None:
+        key = ''
+    elif isinstance(key, unicode):
+        key = key.encode('utf-8')
+    else:
+        key = str(key)
+    [h] = struct.unpack('>Q', hashlib.md5(key).digest()[:8])
+    b, j = -1, 0
+    while j < partitions:
+        b = j
+        h = (h * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((h >> 33) + 1)))
+    return b
+
+
 def safe_routing_key(routing_key):
     """
     >>> safe_routing_key(u'*32323#')